@@ -11,8 +11,8 @@ Arguments:
     <func.dtseries.nii>        A dtseries file to feed into
                                ciftify_PINT_vertices.py map
     <subject>                  Subject ID for HCP surfaces
-    <PINT_summary.csv>         The output csv (*_summary.csv) from the PINT
-                               analysis step
+    <PINT_summary.csv>         The output summary (*_summary.csv, or .npy,
+                               .parquet or .h5) from the PINT analysis step
 
 Options:
   --qcdir PATH             Full path to location of QC directory
@@ -60,7 +60,6 @@ import seaborn as sns
 sns.set(context="paper", font="monospace")
 import pandas as pd
 import numpy as np
-import nibabel as nib
 from docopt import docopt
 
 import ciftify
@@ -91,7 +90,7 @@ class UserSettings(VisSettings):
             self.subject = arguments['<subject>']
             self.func = self.__get_input_file(arguments['<func.dtseries.nii>'])
             self.pint_summary = self.__get_input_file(
-                    arguments['<PINT_summary.csv>'])
+                    ciftify.io.find_pint_output(arguments['<PINT_summary.csv>']))
             self.left_surface = self.__get_surface('L')
             self.right_surface = self.__get_surface('R')
         else:
@@ -114,44 +113,53 @@ class UserSettings(VisSettings):
             sys.exit(1)
         return file_path
 
-class FakeNifti(object):
-    def __init__(self, func_path, tmp_dir):
-        self.__func_fnifti = self.__make_fake_nifti(func_path, tmp_dir)
-        self.data, self.affine, self.header, \
-                self.dims = ciftify.io.load_nifti(self.__func_fnifti)
-        self.template = self.__get_template(func_path, tmp_dir)
-
-    def __make_fake_nifti(self, func_path, tmp_dir):
-        nifti_path = os.path.join(tmp_dir, 'func.nii.gz')
-        command_list = ['wb_command', '-cifti-convert', '-to-nifti', func_path,
-                        nifti_path]
-        run(command_list)
-        if not os.path.exists(nifti_path):
-            logger.critical("Failed to generate file critical file: {} failed "
-                    "command: {}".format(nifti_path, " ".join(command_list)))
-            sys.exit(1)
-        return nifti_path
-
-    def __get_template(self, func_path, tmp_dir):
-        template_path = os.path.join(tmp_dir, 'template.dscalar.nii')
-        command_list = ['wb_command', '-cifti-reduce', func_path, 'MIN',
-                        template_path]
-        run(command_list)
-        if not os.path.exists(template_path):
-            logger.critical("Failed to generate critical file: {} failed"
-                    "command: {}".format(template_path, " ".format(
-                    command_list)))
-            sys.exit(1)
-        return template_path
+class FuncData(object):
+    '''
+    The func dtseries read directly from the cifti, with each greyordinate's
+    timeseries z-scored in place (in the precision dtype) so a seed
+    correlation map is a single product. Greyordinates with a constant or
+    zero mean timeseries are set to zero, so their correlation is zero.
+    '''
+    def __init__(self, func_path):
+        self.dense_array = ciftify.io.DenseArray(func_path)
+        data = self.dense_array.dense()
+        self.zscores = np.array(data,
+                dtype=ciftify.io.precision_dtype(data.dtype))
+        self.__zscore(self.zscores)
+
+    def __zscore(self, data, block_rows=10000):
+        ## z-score a block of greyordinates at a time so the float64
+        ## temporaries of np.std stay small
+        for start in range(0, data.shape[0], block_rows):
+            block = data[start:start + block_rows, :]
+            std_array = np.std(block, axis=1, dtype=np.float64)
+            m_array = np.mean(block, axis=1, dtype=np.float64)
+            brainmask = (std_array > 0) & (m_array != 0)
+            std_array[~brainmask] = 1
+            block -= m_array[:, np.newaxis]
+            block /= std_array[:, np.newaxis]
+            block[~brainmask, :] = 0
+
+    def correlate(self, meants, block_rows=10000):
+        '''returns the correlation of meants with every greyordinate'''
+        meants = np.asarray(meants, dtype=np.float64)
+        meants = (meants - meants.mean()) / meants.std()
+        ## accumulate in float64, a block of greyordinates at a time
+        out = np.zeros([self.zscores.shape[0], 1])
+        for start in range(0, self.zscores.shape[0], block_rows):
+            block = self.zscores[start:start + block_rows, :]
+            out[start:start + block_rows, 0] = np.dot(
+                    block.astype(np.float64), meants)
+        return out / len(meants)
 
 @add_metaclass(ABCMeta)
 class PDDataframe(object):
 
     dataframe = None
 
-    def make_dataframe(self, csv_path, header='infer'):
+    def make_dataframe(self, csv_path, loader=ciftify.io.load_pint_table):
         try:
-            data_frame = pd.read_csv(csv_path, header=header)
+            data_frame = loader(csv_path)
         except:
             logger.critical("Cannot make dataframe from file {}".format(
                     csv_path))
@@ -179,7 +187,8 @@ class Vertex(PDDataframe):
     def __get_dataframe_type(self, csv_path):
         new_path = csv_path.replace('_summary',
                 '_{}_meants'.format(self.vert_type))
-        data_frame = self.make_dataframe(new_path, header=None)
+        data_frame = self.make_dataframe(new_path, loader=lambda path:
+                pd.DataFrame(ciftify.io.load_pint_meants(path)))
         return data_frame.transpose()
 
     def make_heat_map(self, summary_dataframe, output_dir):
@@ -259,34 +268,15 @@ class Vertex(PDDataframe):
             sys.exit(1)
         return rois
 
-    def make_seed_corr(self, summary_df, network, func_fnifti, temp_dir):
+    def make_seed_corr(self, summary_df, network, func_data, temp_dir):
         self.seed_corr = os.path.join(temp_dir, 'scorr{}{}.dscalar.nii'.format(
                 self.vert_type, network))
         meants = self.dataframe.loc[:, summary_df.loc[:, 'NETWORK'] ==
                 network].mean(axis=1)
 
-        temp_nifti_seed = os.path.join(temp_dir, 'seedcorr{}.nii.gz'.format(
-                network))
         ## correlated the mean timeseries with the func data
-        out = np.zeros([func_fnifti.dims[0]*func_fnifti.dims[1]*func_fnifti.dims[2],
-                1])
-        ## determine brainmask bits..
-        std_array = np.std(func_fnifti.data, axis=1)
-        m_array = np.mean(func_fnifti.data, axis=1)
-        std_nonzero = np.where(std_array > 0)[0]
-        m_nonzero = np.where(m_array != 0)[0]
-        mask_indices = np.intersect1d(std_nonzero, m_nonzero)
-        for i in mask_indices:
-            out[i] = np.corrcoef(meants, func_fnifti.data[i, :])[0][1]
-        ## reshape data and write it out to a fake nifti file
-        out = out.reshape([func_fnifti.dims[0], func_fnifti.dims[1],
-                func_fnifti.dims[2], 1])
-        out = nib.nifti1.Nifti1Image(out, func_fnifti.affine)
-        out.to_filename(temp_nifti_seed)
-
-        ## convert back
-        run(['wb_command','-cifti-convert','-from-nifti',
-                temp_nifti_seed, func_fnifti.template, self.seed_corr])
+        out = func_data.correlate(meants.values)
+        ciftify.io.save_cifti(out, func_data.dense_array, self.seed_corr)
 
         run(['wb_command', '-cifti-palette', self.seed_corr,
                 'MODE_AUTO_SCALE_PERCENTAGE', self.seed_corr,
@@ -342,7 +332,7 @@ def run_snaps(settings, qc_config, scene_dir, temp_dir):
 
     ciftify.utils.make_dir(qc_subdir, dry_run=DRYRUN)
 
-    func_nifti = FakeNifti(settings.func, temp_dir)
+    func_data = FuncData(settings.func)
     summary_data = SummaryData(settings.pint_summary)
 
     qc_sub_html = os.path.join(qc_subdir, 'qc_sub.html')
@@ -375,7 +365,7 @@ def run_snaps(settings, qc_config, scene_dir, temp_dir):
                         settings.left_surface, settings.right_surface,
                         settings.roi_radius, temp_dir)
                 vertex.make_seed_corr(summary_data.dataframe, NETWORK,
-                        func_nifti, temp_dir)
+                        func_data, temp_dir)
 
                 scene_file = personalize_template(qc_config, settings,
                         scene_dir, network, vertex)
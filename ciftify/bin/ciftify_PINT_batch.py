@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""
+Runs PINT (see ciftify_PINT_vertices) for many subjects, on a pool of workers
+
+Usage:
+  ciftify_PINT_batch [options] <manifest.csv> <input-vertices.csv>
+
+Arguments:
+    <manifest.csv>         Table of subjects to run, with the columns func,
+                           surfL, surfR and outputprefix (see details)
+    <input-vertices.csv>   Table of template vertices from which to Start
+
+Options:
+  --n-workers N          Number of subjects to run at once [default: 1]
+  --report CSV           Where to write the summary report
+                         (default <manifest>_report.csv)
+  --pcorr                Use maximize partial correlation within network
+                         (instead of pearson).
+  --outputall            Output vertices from each iteration.
+  --output-format FORMAT The format of the summary and meants outputs, csv,
+                         npy, parquet or hdf5 [default: csv]
+  --sampling-radius MM   Radius [default: 6] in mm of sampling rois
+  --search-radius MM     Radius [default: 6] in mm of search rois
+  --padding-radius MM    Radius [default: 12] in mm for min distance between roi centers
+  --roi-limits ROIFILE   To limit rois, input a 4D dscalar file with one roi per roiidx
+  --precision TYPE       Read the func data as float32, float16 or float64
+                         (overrides the CIFTIFY_PRECISION environment variable,
+                         default float32)
+  --update-mode MODE     How the vertices of an iteration are moved,
+                         sequential or jacobi [default: sequential]
+  --n-threads N          Number of threads (per subject) for --update-mode
+                         jacobi [default: 1]
+  --resume               Continue each subject from its checkpoint (see
+                         ciftify_PINT_vertices)
+  -v,--verbose           Verbose logging
+  --debug                Debug logging in Erin's very verbose style
+  -h,--help              Print help
+
+DETAILS
+Each row of the manifest is one run of ciftify_PINT_vertices, with the
+arguments:
+    func            the <func.dtseries.nii>
+    surfL, surfR    the <left-surface.gii> and <right-surface.gii>
+    outputprefix    the <outputprefix>
+
+The template vertices are read once, and the geodesic rois of every distinct
+surface are built before the workers start, so subjects that share a mesh
+(e.g. all on the HCP S1200 average) share them.
+
+A subject that fails does not stop the others, even if its worker process is
+killed (i.e. by the out of memory killer). The report lists, for every
+subject, its outputprefix, whether it finished ("done" or "failed"), how
+long it took (in seconds) and the error of a failed subject. The exit status
+is 1 if any subject failed.
+"""
+import os
+import sys
+import time
+import logging
+import multiprocessing
+
+import pandas as pd
+from docopt import docopt
+
+import ciftify
+import ciftify.bin.ciftify_PINT_vertices as PINT
+
+logger = logging.getLogger('ciftify')
+logger.setLevel(logging.DEBUG)
+
+MANIFEST_COLUMNS = ['func', 'surfL', 'surfR', 'outputprefix']
+
+def read_manifest(manifest_csv):
+    '''reads the manifest, exits if a column is missing'''
+    manifest = pd.read_csv(manifest_csv)
+    missing = [col for col in MANIFEST_COLUMNS if col not in manifest.columns]
+    if missing:
+        logger.error("Manifest {} is missing the column(s): {}".format(
+                manifest_csv, ', '.join(missing)))
+        sys.exit(1)
+    return manifest
+
+def preload_surfaces(manifest, radii):
+    '''
+    builds the geodesic neighbourhoods of each distinct surface in the
+    manifest for each radius, so the worker processes inherit them
+    '''
+    surfaces = pd.unique(manifest.loc[:, ['surfL', 'surfR']].values.ravel())
+    radii = sorted(set(float(radius) for radius in radii), reverse = True)
+    for surf in surfaces:
+        if not os.path.exists(surf):
+            logger.warning('Surface {} does not exist'.format(surf))
+            continue
+        for radius in radii:
+            ciftify.io.geodesic_neighbourhoods(surf, radius)
+
+def subject_arguments(subject, settings):
+    '''the ciftify_PINT_vertices arguments of one manifest row'''
+    arguments = dict(settings['arguments'])
+    arguments['<func.dtseries.nii>'] = subject['func']
+    arguments['<left-surface.gii>'] = subject['surfL']
+    arguments['<right-surface.gii>'] = subject['surfR']
+    arguments['<outputprefix>'] = subject['outputprefix']
+    return arguments
+
+def run_subject(job):
+    '''
+    runs PINT for one subject (a manifest row), logging to its own
+    <outputprefix>_pint.log, returns its row of the report
+    '''
+    subject, settings = job
+    output_prefix = subject['outputprefix']
+    start = time.time()
+    result = {'outputprefix': output_prefix, 'status': 'done', 'error': ''}
+    fh = None
+    try:
+        local_logpath = os.path.dirname(output_prefix)
+        if local_logpath and not os.path.exists(local_logpath):
+            os.makedirs(local_logpath)
+        fh = logging.FileHandler('{}_pint.log'.format(output_prefix))
+        fh.setLevel(logging.INFO)
+        fh.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(fh)
+        logger.info(PINT.pint_logo())
+        logger.info(ciftify.utils.section_header(
+                "Personalized Intrinsic Network Topolography (PINT)"))
+        with ciftify.utils.TempDir() as tmpdir:
+            PINT.run_PINT(subject_arguments(subject, settings), tmpdir,
+                          template_df = settings['template_df'])
+    except (Exception, SystemExit) as err:
+        logger.error('PINT failed for {}: {}'.format(output_prefix, err))
+        result['status'] = 'failed'
+        if isinstance(err, SystemExit):
+            result['error'] = 'exited with status {}, see {}_pint.log'.format(
+                    err.code, output_prefix)
+        else:
+            result['error'] = str(err) or repr(err)
+    finally:
+        if fh is not None:
+            logger.removeHandler(fh)
+            fh.close()
+    result['seconds'] = round(time.time() - start, 1)
+    return result
+
+def run_batch(manifest, settings, n_workers):
+    '''runs all subjects in the manifest, returns the report dataframe'''
+    jobs = [(subject, settings) for subject in manifest.to_dict('records')]
+    if n_workers > 1:
+        results = run_in_processes(jobs, n_workers)
+    else:
+        results = [run_subject(job) for job in jobs]
+    return pd.DataFrame(results,
+            columns = ['outputprefix', 'status', 'seconds', 'error'])
+
+def run_in_processes(jobs, n_workers, poll_seconds = 0.1):
+    '''
+    runs each job (with run_subject) in its own child process, n_workers at
+    a time, returns their report rows in order. A child that dies without
+    sending its row back (i.e. killed by the OOM killer) is reported as
+    failed, with its exit code.
+    '''
+    results = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    running = {}
+    while pending or running:
+        while pending and len(running) < n_workers:
+            idx = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex = False)
+            process = multiprocessing.Process(target = send_subject_result,
+                                              args = (jobs[idx], sender))
+            process.start()
+            sender.close()
+            running[idx] = (process, receiver, time.time())
+        for idx, (process, receiver, start) in list(running.items()):
+            ## a finished child has sent everything it ever will
+            alive = process.is_alive()
+            if receiver.poll():
+                try:
+                    results[idx] = receiver.recv()
+                except EOFError:
+                    ## the pipe was closed by a child that died
+                    results[idx] = died_subject_result(jobs[idx], process,
+                                                       start)
+            elif not alive:
+                results[idx] = died_subject_result(jobs[idx], process, start)
+            else:
+                continue
+            process.join()
+            receiver.close()
+            del running[idx]
+        if running:
+            time.sleep(poll_seconds)
+    return results
+
+def send_subject_result(job, sender):
+    '''runs one subject in a child process and sends its report row back'''
+    sender.send(run_subject(job))
+    sender.close()
+
+def died_subject_result(job, process, start):
+    '''the report row of a subject whose process died without a result'''
+    process.join()
+    output_prefix = job[0]['outputprefix']
+    if process.exitcode < 0:
+        error = 'worker process was killed by signal {}'.format(-process.exitcode)
+    else:
+        error = 'worker process exited with status {}'.format(process.exitcode)
+    logger.error('PINT failed for {}: {}'.format(output_prefix, error))
+    return {'outputprefix': output_prefix, 'status': 'failed',
+            'seconds': round(time.time() - start, 1), 'error': error}
+
+def main():
+    arguments = docopt(__doc__)
+    manifest_csv = arguments['<manifest.csv>']
+    origcsv = arguments['<input-vertices.csv>']
+    n_workers = int(arguments['--n-workers'])
+    report_csv = arguments['--report']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.WARNING)
+    if verbose:
+        ch.setLevel(logging.INFO)
+    if debug:
+        ch.setLevel(logging.DEBUG)
+    ch.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(ch)
+
+    if not report_csv:
+        report_csv = '{}_report.csv'.format(os.path.splitext(manifest_csv)[0])
+    if arguments['--precision']:
+        ciftify.io.set_precision(arguments['--precision'])
+
+    manifest = read_manifest(manifest_csv)
+    settings = {'template_df': pd.read_csv(origcsv),
+                'arguments': {
+                    '<input-vertices.csv>': origcsv,
+                    '--pcorr': arguments['--pcorr'],
+                    '--outputall': arguments['--outputall'],
+                    '--output-format': arguments['--output-format'],
+                    '--sampling-radius': arguments['--sampling-radius'],
+                    '--search-radius': arguments['--search-radius'],
+                    '--padding-radius': arguments['--padding-radius'],
+                    '--roi-limits': arguments['--roi-limits'],
+                    '--precision': arguments['--precision'],
+                    '--update-mode': arguments['--update-mode'],
+                    '--n-threads': arguments['--n-threads'],
+                    '--resume': arguments['--resume']}}
+
+    logger.info(ciftify.utils.section_header('Building geodesic rois'))
+    preload_surfaces(manifest, [arguments['--sampling-radius'],
+                                arguments['--search-radius'],
+                                arguments['--padding-radius']])
+
+    logger.info(ciftify.utils.section_header(
+            'Running PINT for {} subjects'.format(len(manifest))))
+    report = run_batch(manifest, settings, n_workers)
+    report.to_csv(report_csv, index = False)
+
+    num_failed = (report.status == 'failed').sum()
+    logger.warning('PINT finished for {} of {} subjects, report written to {}'.format(
+            len(report) - num_failed, len(report), report_csv))
+    if num_failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
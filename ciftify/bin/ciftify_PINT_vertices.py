@@ -16,25 +16,69 @@ Options:
   --pcorr                Use maximize partial correlation within network
                          (instead of pearson).
   --outputall            Output vertices from each iteration.
+  --output-format FORMAT The format of the summary and meants outputs, csv,
+                         npy, parquet or hdf5 (see details) [default: csv]
   --sampling-radius MM   Radius [default: 6] in mm of sampling rois
   --search-radius MM     Radius [default: 6] in mm of search rois
   --padding-radius MM    Radius [default: 12] in mm for min distance between roi centers
   --roi-limits ROIFILE   To limit rois, input a 4D dscalar file with one roi per roiidx
+  --precision TYPE       Read the func data as float32, float16 or float64
+                         (overrides the CIFTIFY_PRECISION environment variable,
+                         default float32)
+  --update-mode MODE     How the vertices of an iteration are moved,
+                         sequential or jacobi (see details) [default: sequential]
+  --n-threads N          Number of threads for --update-mode jacobi
+                         (default: the number of cores)
+  --resume               Continue from the <outputprefix>_pint_state
+                         checkpoint of an interrupted run
+  --profile              Write a cProfile dump of the run to
+                         <outputprefix>_pint.prof
   -v,--verbose           Verbose logging
   --debug                Debug logging in Erin's very verbose style
   -h,--help              Print help
 
 DETAILS
-TBA
+The summary and meants are written as <outputprefix>_summary.<ext>,
+<outputprefix>_tvertex_meants.<ext> and <outputprefix>_ivertex_meants.<ext>,
+where ext is csv, npy, parquet or h5 (hdf5). parquet needs pyarrow (or
+fastparquet) and hdf5 needs pytables installed. cifti_vis_PINT and the
+postPINT tools read any of them.
+
+Every vertex of an iteration is moved using the rois and meants from the
+start of that iteration, so the order they are moved in does not matter. In
+sequential mode they are moved one at a time, in the order of
+<input-vertices.csv>. In jacobi mode they are all scored at once, on a pool
+of threads. Both modes give the same vertices.
+
+After every iteration the vertices so far and the iteration count are written
+to <outputprefix>_pint_state. With --resume, PINT continues from there (and gives the same results as an
+uninterrupted run) instead of starting again from the template vertices. If
+there is no checkpoint, PINT starts from the beginning. A checkpoint from a
+run with other inputs or settings is not resumed, and
+the checkpoint is removed once the outputs are written.
+
+The time spent in each step of the run, and in each phase of every iteration
+(building the rois, the meants, the correlations and the distances), along
+with the number of subprocesses run, vertices scored and moved and the peak
+memory use are written to <outputprefix>_pint_timings.csv (one row per
+iteration) and <outputprefix>_pint_timings.json (the whole run).
 
 Written by Erin W Dickie, April 2016
 """
-import random
 import os
 import sys
+import json
+import time
+import resource
+import cProfile
+import contextlib
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import logging
 import pandas as pd
 import nibabel.gifti.giftiio
+import scipy.sparse
 from scipy import stats, linalg
 import numpy as np
 import nibabel as nib
@@ -46,11 +90,19 @@ import ciftify
 logger = logging.getLogger('ciftify')
 logger.setLevel(logging.DEBUG)
 
+## the inputs and settings of this run, recorded in the checkpoint
+PINT_SETTINGS = None
+
 ############################## maub starts here ######################
-def run_PINT(arguments, tmpdir):
+def run_PINT(arguments, tmpdir, template_df = None):
+    '''
+    runs PINT for one subject, template_df is the already read
+    <input-vertices.csv> (when running many subjects)
+    '''
     global RADIUS_SAMPLING
     global RADIUS_SEARCH
     global RADIUS_PADDING
+    global PINT_SETTINGS
 
     func          = arguments['<func.dtseries.nii>']
     surfL         = arguments['<left-surface.gii>']
@@ -63,9 +115,23 @@ def run_PINT(arguments, tmpdir):
     RADIUS_SEARCH = arguments['--search-radius']
     RADIUS_PADDING = arguments['--padding-radius']
     roi_limits_file = arguments['--roi-limits']
+    precision     = arguments['--precision']
+    resume        = arguments['--resume']
+    update_mode   = arguments['--update-mode']
+    n_threads     = arguments['--n-threads']
+    output_format = arguments['--output-format']
 
     logger.debug(arguments)
 
+    if precision:
+        ciftify.io.set_precision(precision)
+    if update_mode not in ('sequential', 'jacobi'):
+        logger.error('--update-mode {} is not sequential or jacobi'.format(update_mode))
+        sys.exit(1)
+    n_threads = int(n_threads) if n_threads else multiprocessing.cpu_count()
+    ciftify.io.check_pint_output_format(output_format)
+    output_ext = ciftify.io.PINT_OUTPUT_FORMATS[output_format]
+
     logger.info("Arguments: ")
     logger.info('    functional data: {}'.format(func))
     logger.info('    left surface: {}'.format(surfL))
@@ -85,28 +151,63 @@ def run_PINT(arguments, tmpdir):
     logger.info(ciftify.utils.section_header('Starting PINT'))
 
     ## loading the dataframe
-    df = pd.read_csv(origcsv)
+    if template_df is not None:
+        df = template_df.copy()
+    else:
+        df = pd.read_csv(origcsv)
     if 'roiidx' not in df.columns:
         df.loc[:,'roiidx'] = pd.Series(np.arange(1,len(df.index)+1), index=df.index)
 
+    ## the checkpoint, and the run it belongs to
+    checkpoint = '{}_pint_state'.format(output_prefix)
+    PINT_SETTINGS = {'func': func, 'surfL': surfL, 'surfR': surfR,
+                'input_vertices': origcsv, 'pcorr': pcorr,
+                'sampling_radius': RADIUS_SAMPLING,
+                'search_radius': RADIUS_SEARCH,
+                'padding_radius': RADIUS_PADDING,
+                'roi_limits': roi_limits_file}
+    state = None
+    if resume:
+        state = read_pint_state(checkpoint, PINT_SETTINGS)
+
+    profile = PintProfile()
+
     ## load the func data
-    func_dataL, func_dataR = ciftify.io.load_surfaces(func, suppress_echo = True)
-    num_Lverts = func_dataL.shape[0]
-    func_data = np.vstack((func_dataL, func_dataR))
-    func_zeros = np.where(func_data[:,5]<5)[0]
-
-    ## cp the surfaces to the tmpdir - this will cut down on i-o is tmpdir is ramdisk
-    tmp_surfL = os.path.join(tmpdir, 'surface.L.surf.gii')
-    tmp_surfR = os.path.join(tmpdir, 'surface.R.surf.gii')
-    docmd(['cp', surfL, tmp_surfL])
-    docmd(['cp', surfR ,tmp_surfR])
-    surfL = tmp_surfL
-    surfR = tmp_surfR
-
-    ## run the main iteration
-    df, max_distance, distance_outcol, iter_num = iterate_pint(df, 'tvertex', func_data,
-                                                                func_zeros, pcorr,
-                                                                surfL, surfR, num_Lverts)
+    with profile.phase('load_func'):
+        func_dataL, func_dataR = ciftify.io.load_surfaces(func, suppress_echo = True)
+        num_Lverts = func_dataL.shape[0]
+        func_data = np.vstack((func_dataL, func_dataR))
+        func_zeros = np.where(func_data[:,5]<5)[0]
+
+    ## the surfaces are read once (see ciftify.io.load_surface_mesh), so
+    ## they are no longer copied to the tmpdir
+
+    ## build the largest neighbourhood index first, the indices for the
+    ## smaller radii are cut from it
+    with profile.phase('neighbourhoods'):
+        for surf in [surfL, surfR]:
+            ciftify.io.geodesic_neighbourhoods(surf, max(float(RADIUS_SAMPLING),
+                    float(RADIUS_SEARCH), float(RADIUS_PADDING)))
+
+    ## the func data is z-scored (as needed) once for the whole run
+    corr_kernel = CorrelationKernel(func_data)
+
+    ## run the main iteration (unless the checkpoint is from after it)
+    if state is None or state['start_iter'] == 0:
+        df, max_distance, distance_outcol, iter_num = iterate_pint(df, 'tvertex', func_data,
+                                                                    func_zeros, pcorr,
+                                                                    surfL, surfR, num_Lverts,
+                                                                    corr_kernel = corr_kernel,
+                                                                    update_mode = update_mode,
+                                                                    n_threads = n_threads,
+                                                                    checkpoint = checkpoint,
+                                                                    state = state,
+                                                                    profile = profile)
+    else:
+        df = pint_state_dataframe(state)
+        max_distance = state['max_distance']
+        distance_outcol = state['distance_outcol']
+        iter_num = state['iter_num']
 
     ## if roi limits file is given... then test to see if any of the vertices are outside the roi limits
     if roi_limits_file:
@@ -131,8 +232,15 @@ def run_PINT(arguments, tmpdir):
         if not all_good:
             df, max_distance, distance_outcol, iter_num = iterate_pint(df, 'avertex',
                                                                         func_data, func_zeros,
-                                                                        pcorr, num_Lverts,
-                                                                        start_iter = 50)
+                                                                        pcorr, surfL, surfR,
+                                                                        num_Lverts,
+                                                                        start_iter = 50,
+                                                                        corr_kernel = corr_kernel,
+                                                                        update_mode = update_mode,
+                                                                        n_threads = n_threads,
+                                                                        checkpoint = checkpoint,
+                                                                        state = state,
+                                                                        profile = profile)
 
     if outputall:
         cols_to_export = list(df.columns.values)
@@ -141,20 +249,26 @@ def run_PINT(arguments, tmpdir):
         if max_distance > 1:
             cols_to_export.extend([distance_outcol, 'vertex_{}'.format(iter_num - 2)])
 
-    df.to_csv('{}_summary.csv'.format(output_prefix), columns = cols_to_export, index = False)
-    ## load the sampling data
+    with profile.phase('outputs'):
+        ciftify.io.save_pint_table(df, '{}_summary{}'.format(output_prefix, output_ext),
+                                   columns = cols_to_export)
+        ## load the sampling data
 
-    ## output the tvertex meants
-    sampling_rois = rois_bilateral(df, 'tvertex', RADIUS_SAMPLING, surfL, surfR)
-    sampling_rois[func_zeros] = 0
-    calc_sampling_meants(func_data, sampling_rois,
-    outputcsv_name="{}_tvertex_meants.csv".format(output_prefix))
-    ## output the ivertex meants
-    sampling_rois = rois_bilateral(df, 'ivertex', RADIUS_SAMPLING, surfL, surfR)
-    sampling_rois[func_zeros] = 0
-    calc_sampling_meants(func_data, sampling_rois,
-    outputcsv_name="{}_ivertex_meants.csv".format(output_prefix))
+        ## output the tvertex meants
+        sampling_rois = rois_bilateral(df, 'tvertex', RADIUS_SAMPLING, surfL, surfR)
+        sampling_rois[func_zeros] = 0
+        calc_sampling_meants(func_data, sampling_rois,
+        outputcsv_name="{}_tvertex_meants{}".format(output_prefix, output_ext))
+        ## output the ivertex meants
+        sampling_rois = rois_bilateral(df, 'ivertex', RADIUS_SAMPLING, surfL, surfR)
+        sampling_rois[func_zeros] = 0
+        calc_sampling_meants(func_data, sampling_rois,
+        outputcsv_name="{}_ivertex_meants{}".format(output_prefix, output_ext))
 
+    profile.write(output_prefix)
+    ## the run is finished, so there is nothing left to resume
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
     logger.info(ciftify.utils.section_header('Done'))
 
 ### Erin's little function for running things in the shell
@@ -185,55 +299,39 @@ def log_build_environment():
 
 def calc_surf_distance(surf, orig_vertex, target_vertex, radius_search):
     '''
-    uses wb_command -surface-geodesic-distance command to measure
+    uses ciftify.io.get_surf_distances to measure the geodesic
     distance between two vertices on the surface
     '''
     if int(orig_vertex) == int(target_vertex):
         distance = 0
     else:
         distances = ciftify.io.get_surf_distances(surf, orig_vertex,
-                                                         radius_search = radius_search,
-                                                         suppress_echo = True)
+                                                         radius_search = radius_search)
         distance = distances[target_vertex,0]
     return(distance)
 
 def calc_distance_column(df, orig_vertex_col, target_vertex_col,distance_outcol,
                          radius_search, surfL, surfR):
-    df.loc[:,distance_outcol] = -99.9
-    for idx in df.index.tolist():
-        orig_vertex = df.loc[idx, orig_vertex_col]
-        target_vertex = df.loc[idx, target_vertex_col]
-        hemi = df.loc[idx,'hemi']
-        if hemi == "L":
-            df.loc[idx, distance_outcol] = calc_surf_distance(surfL, orig_vertex,
-                                            target_vertex, radius_search)
-        if hemi == "R":
-            df.loc[idx, distance_outcol] = calc_surf_distance(surfR, orig_vertex,
-                                            target_vertex, radius_search)
+    '''
+    measures the distance from the orig to the target vertex of every row,
+    the distinct orig vertices of each hemisphere are measured together
+    '''
+    df.loc[:,distance_outcol] = ciftify.io.geodesic_distance_pairs(
+            {'L': surfL, 'R': surfR}, df.hemi.values,
+            df.loc[:, orig_vertex_col].values,
+            df.loc[:, target_vertex_col].values, limit = radius_search)
     return df
 
 def roi_surf_data(df, vertex_colname, surf, hemisphere, roi_radius):
     '''
-    uses wb_command -surface-geodesic-rois to build rois (3D files)
-    then load and collasp that into 1D array
+    builds non-overlapping geodesic rois (see ciftify.io.geodesic_rois)
+    around this hemisphere's vertices, collapsed into a 1D array of roiidx
+    labels
     '''
-    ## right the L and R hemisphere vertices from the table out to temptxt
-    with ciftify.utils.TempDir() as lil_tmpdir:
-        ## write a temp vertex list file
-        vertex_list = os.path.join(lil_tmpdir, 'vertex_list.txt')
-        df.loc[df.hemi == hemisphere, vertex_colname].to_csv(vertex_list,sep='\n',index=False)
-
-        ## from the temp text build - func masks and target masks
-        roi_surf = os.path.join(lil_tmpdir,'roi_surf.func.gii')
-        docmd(['wb_command', '-surface-geodesic-rois', surf,
-            str(roi_radius),  vertex_list, roi_surf,
-            '-overlap-logic', 'EXCLUDE'])
-        rois_data = ciftify.io.load_gii_data(roi_surf)
-
-    ## multiply by labels and reduce to 1 vector
-    vlabels = df[df.hemi == hemisphere].roiidx.tolist()
-    rois_data = np.multiply(rois_data, vlabels)
-    rois_data1D = np.max(rois_data, axis=1)
+    hemi_df = df[df.hemi == hemisphere]
+    rois_data1D = ciftify.io.geodesic_roi_labels(surf,
+            hemi_df.loc[:, vertex_colname].values, roi_radius,
+            hemi_df.roiidx.values, overlap_logic = 'EXCLUDE')
 
     return rois_data1D
 
@@ -261,22 +359,164 @@ def calc_network_meants(sampling_meants, df):
 def calc_sampling_meants(func_data, sampling_roi_mask, outputcsv_name=None):
     '''
     output a np.arrary of the meants for every index in the sampling_roi_mask
+    (written to outputcsv_name, in the format of its extension, if given)
     '''
-    # init output vector
+    # get mean seed dataistic from each roi (in one sparse product)
     rois = np.unique(sampling_roi_mask)[1:]
-    out_data = np.zeros((len(rois), func_data.shape[1]))
-
-    # get mean seed dataistic from each, append to output
-    for i, roi in enumerate(rois):
-        idx = np.where(sampling_roi_mask == roi)[0]
-        out_data[i,:] = np.mean(func_data[idx, :], axis=0)
+    out_data = ciftify.io.LabelMeans(sampling_roi_mask, rois = rois).reduce(func_data)
 
     ## if the outputfile argument was given, then output the file
     if outputcsv_name:
-        np.savetxt(outputcsv_name, out_data, delimiter=",")
+        ciftify.io.save_pint_meants(out_data, outputcsv_name)
 
     return(out_data)
 
+class RoiLabels(object):
+    '''
+    The label vector of non-overlapping geodesic rois (as rois_bilateral)
+    around the vertices in df, kept up to date as the vertices move.
+
+    For every vertex it keeps the number of rois covering it and the sum of
+    their (row position + 1), so a vertex covered by exactly one roi knows
+    which one it is. Moving a vertex only touches the old and new
+    neighbourhoods of that roi.
+    '''
+    def __init__(self, df, radius, surfL, surfR, num_Lverts, num_vertices,
+                 exclude = None):
+        self.neighbours = {'L': ciftify.io.geodesic_neighbourhoods(surfL, radius),
+                           'R': ciftify.io.geodesic_neighbourhoods(surfR, radius)}
+        self.offsets = {'L': 0, 'R': num_Lverts}
+        self.hemis = df.hemi.values
+        self.roiidx = df.roiidx.values
+        self.centres = np.zeros(len(df), dtype=np.int64) - 1
+        self.coverage = np.zeros(num_vertices, dtype=np.int64)
+        self.owners = np.zeros(num_vertices, dtype=np.int64)
+        self.allowed = np.ones(num_vertices, dtype=bool)
+        if exclude is not None:
+            self.allowed[exclude] = False
+        self.data = np.zeros(num_vertices)
+
+    def members(self, pos, centre):
+        '''the (bilateral) indices of the vertices in roi pos around centre'''
+        neighbours = self.neighbours[self.hemis[pos]]
+        start, stop = neighbours.indptr[centre], neighbours.indptr[centre + 1]
+        return neighbours.indices[start:stop] + self.offsets[self.hemis[pos]]
+
+    def move(self, centres):
+        '''
+        moves the rois to centres (one per row of df), returns the vertices
+        whose label changed with their old and new labels
+        '''
+        centres = np.asarray(centres, dtype=np.int64)
+        touched = [np.zeros(0, dtype=np.int64)]
+        for pos in np.where(centres != self.centres)[0]:
+            if self.centres[pos] >= 0:
+                old = self.members(pos, self.centres[pos])
+                self.coverage[old] -= 1
+                self.owners[old] -= pos + 1
+                touched.append(old)
+            new = self.members(pos, centres[pos])
+            self.coverage[new] += 1
+            self.owners[new] += pos + 1
+            touched.append(new)
+            self.centres[pos] = centres[pos]
+        touched = np.unique(np.concatenate(touched))
+
+        single = (self.coverage[touched] == 1) & self.allowed[touched]
+        new_labels = np.zeros(len(touched))
+        new_labels[single] = self.roiidx[self.owners[touched[single]] - 1]
+        old_labels = self.data[touched]
+        changed = new_labels != old_labels
+        self.data[touched] = new_labels
+        return touched[changed], old_labels[changed], new_labels[changed]
+
+class PintRois(object):
+    '''
+    The sampling, search and padding rois of PINT, and the sampling and
+    network meants, carried from one iteration to the next.
+
+    Only the rois whose vertex moved are rebuilt (see RoiLabels). The
+    sampling meants are kept as running sums, updated with the timeseries of
+    the vertices that joined or left each roi, and only the networks of the
+    rois that changed have their mean recalculated. The meants match
+    calc_sampling_meants and calc_network_meants of the same rois.
+    '''
+    def __init__(self, df, vertex_col, func_data, func_zeros, surfL, surfR,
+                 num_Lverts):
+        num_vertices = func_data.shape[0]
+        self.func_data = func_data
+        self.df = df
+        self.sampling = RoiLabels(df, RADIUS_SAMPLING, surfL, surfR,
+                                  num_Lverts, num_vertices, exclude = func_zeros)
+        self.search = RoiLabels(df, RADIUS_SEARCH, surfL, surfR,
+                                num_Lverts, num_vertices, exclude = func_zeros)
+        self.padding = RoiLabels(df, RADIUS_PADDING, surfL, surfR,
+                                 num_Lverts, num_vertices)
+        num_rois = int(df.roiidx.max())
+        self.sums = np.zeros((num_rois, func_data.shape[1]))
+        self.counts = np.zeros(num_rois)
+        self.__netmeants = pd.DataFrame(np.nan,
+                                        index = list(range(func_data.shape[1])),
+                                        columns = df['NETWORK'].unique())
+        self.__stale_networks = set(self.__netmeants.columns)
+        self.move(df, vertex_col)
+
+    def move(self, df, vertex_col):
+        '''moves the rois to the vertices in vertex_col, returns the number
+        of rois that moved'''
+        num_moved, changes = self.move_rois(df, vertex_col)
+        self.update_meants(*changes)
+        return num_moved
+
+    def move_rois(self, df, vertex_col):
+        '''
+        moves the rois (but not the meants) to the vertices in vertex_col,
+        returns the number of rois that moved and the sampling roi changes
+        for update_meants
+        '''
+        centres = df.loc[:, vertex_col].values.astype(np.int64)
+        num_moved = np.sum(centres != self.sampling.centres)
+        self.search.move(centres)
+        self.padding.move(centres)
+        return num_moved, self.sampling.move(centres)
+
+    def update_meants(self, vertices, old_labels, new_labels):
+        '''updates the sampling sums with the sampling roi changes'''
+        if not len(vertices):
+            return
+
+        ## add the timeseries of the vertices to the roi they joined and
+        ## take them away from the roi they left, as one sparse product
+        num_rois = self.sums.shape[0]
+        left, joined = old_labels > 0, new_labels > 0
+        rows = np.concatenate((old_labels[left], new_labels[joined])).astype(int) - 1
+        cols = np.concatenate((np.where(left)[0], np.where(joined)[0]))
+        signs = np.concatenate((-np.ones(left.sum()), np.ones(joined.sum())))
+        change = scipy.sparse.csr_matrix((signs, (rows, cols)),
+                                         shape = (num_rois, len(vertices)))
+        self.sums += change.dot(self.func_data[vertices, :].astype(np.float64))
+        self.counts += np.asarray(change.sum(axis=1)).ravel()
+
+        changed_rois = np.unique(rows) + 1
+        self.__stale_networks.update(
+                self.df.loc[self.df.roiidx.isin(changed_rois), 'NETWORK'])
+
+    @property
+    def sampling_meants(self):
+        '''the mean timeseries of each sampling roi (row roiidx - 1)'''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums / self.counts[:, np.newaxis]
+
+    def network_meants(self):
+        '''the network meants (as calc_network_meants)'''
+        if self.__stale_networks:
+            sampling_meants = self.sampling_meants
+            for network in self.__stale_networks:
+                netlabels = self.df[self.df.NETWORK == network].roiidx.values
+                self.__netmeants.loc[:, network] = np.mean(
+                        sampling_meants[netlabels - 1, :], axis=0)
+            self.__stale_networks = set()
+        return self.__netmeants.copy()
 
 def partial_corr(X,Y,Z):
     """
@@ -333,10 +573,106 @@ def partial_corr(X,Y,Z):
     ## return the partial correlation
     return pcorr
 
+class CorrelationKernel(object):
+    '''
+    Pearson correlations of a timeseries with many rows of func_data at once.
+
+    Each row is centred and scaled to unit length (a z-score over
+    sqrt(timepoints)) the first time it is asked for, and kept for the rest
+    of the run, so scoring a set of candidate vertices is one matrix-vector
+    product. The scaled rows are stored compactly, in the order they were
+    first asked for and in the dtype of func_data, so the kernel only grows
+    to the size of the search rois. Rows with no variance score nan (as
+    np.corrcoef).
+    '''
+    def __init__(self, func_data):
+        self.func_data = func_data
+        if np.issubdtype(func_data.dtype, np.floating):
+            self.dtype = func_data.dtype
+        else:
+            self.dtype = np.dtype(np.float64)
+        self.__slots = np.full(func_data.shape[0], -1, dtype=np.intp)
+        self.__zscores = np.empty((0, func_data.shape[1]), dtype=self.dtype)
+        self.num_cached = 0
+
+    def zscores(self, rows):
+        '''the scaled rows, computing any that are not cached yet'''
+        rows = np.asarray(rows)
+        todo = np.unique(rows[self.__slots[rows] < 0])
+        if todo.size:
+            self.__reserve(self.num_cached + todo.size)
+            slots = np.arange(self.num_cached, self.num_cached + todo.size)
+            self.__zscores[slots] = unit_scale(self.func_data[todo, :])
+            self.__slots[todo] = slots
+            self.num_cached += todo.size
+        return self.__zscores[self.__slots[rows]]
+
+    def __reserve(self, num_rows):
+        '''grows the buffer (by at least doubling it) to hold num_rows'''
+        if num_rows <= self.__zscores.shape[0]:
+            return
+        capacity = min(max(num_rows, 2 * self.__zscores.shape[0]),
+                self.func_data.shape[0])
+        grown = np.empty((capacity, self.func_data.shape[1]), dtype=self.dtype)
+        grown[:self.num_cached] = self.__zscores[:self.num_cached]
+        self.__zscores = grown
+
+    def correlate(self, timeseries, rows):
+        '''returns the correlation of timeseries with each of rows'''
+        return self.zscores(rows).dot(unit_scale(timeseries))
+
+def unit_scale(data):
+    '''centres the rows of data (or a 1D timeseries) and scales them to unit
+    length, in float64'''
+    data = np.array(data, dtype=np.float64)
+    data -= data.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        data /= np.sqrt((data ** 2).sum(axis=-1, keepdims=True))
+    return data
+
+class PartialCorrelationKernel(object):
+    '''
+    Partial correlations (as partial_corr) of a network's meants with many
+    rows of func_data at once, controlling for the meants of the other
+    networks.
+
+    The other-network covariates are factorised (SVD) once per network and
+    kept, so that regressing them out of all candidate timeseries is two
+    matrix products. As in partial_corr the regression has no intercept.
+    '''
+    def __init__(self, netmeants):
+        self.netmeants = netmeants
+        self.__bases = {}
+
+    def basis(self, network):
+        '''an orthonormal basis for the other networks' meants'''
+        if network not in self.__bases:
+            o_networks = [net for net in self.netmeants.columns if net != network]
+            covariates = self.netmeants.loc[:, o_networks].values.astype(np.float64)
+            if not covariates.size:
+                self.__bases[network] = np.zeros((covariates.shape[0], 0))
+            else:
+                U, s, _ = np.linalg.svd(covariates, full_matrices=False)
+                rank = np.sum(s > s.max() * max(covariates.shape) *
+                        np.finfo(np.float64).eps)
+                self.__bases[network] = U[:, :rank]
+        return self.__bases[network]
+
+    def correlate(self, timeseries, network, data):
+        '''returns the partial correlation of timeseries with each row of
+        data'''
+        basis = self.basis(network)
+        timeseries = np.asarray(timeseries, dtype=np.float64)
+        res_x = timeseries - basis.dot(basis.T.dot(timeseries))
+        data = np.asarray(data, dtype=np.float64)
+        res_y = data - data.dot(basis).dot(basis.T)
+        return unit_scale(res_y).dot(unit_scale(res_x))
+
 def pint_move_vertex(df, idx, vertex_incol, vertex_outcol,
                      func_data, sampling_meants,
                      search_rois, padding_rois, pcorr,
-                     num_Lverts, netmeants = None):
+                     num_Lverts, netmeants = None, corr_kernel = None,
+                     pcorr_kernel = None):
     '''
     move one vertex in the pint algorithm
     inputs:
@@ -347,6 +683,24 @@ def pint_move_vertex(df, idx, vertex_incol, vertex_outcol,
       padding_rois: the padding rois (the mask that prevent search spaces from overlapping)
       pcorr : wether or not to use partial corr
       netmeants: netmeants object if running pcorr (if set to None, regular correlation is run)
+      corr_kernel: the CorrelationKernel of func_data (made here if not given)
+      pcorr_kernel: the PartialCorrelationKernel of netmeants (made here if not given)
+    '''
+    df.loc[idx,vertex_outcol] = pint_best_vertex(df, idx, vertex_incol,
+                                                 func_data, sampling_meants,
+                                                 search_rois, padding_rois,
+                                                 pcorr, num_Lverts, netmeants,
+                                                 corr_kernel, pcorr_kernel)
+
+    ## return the df
+    return df
+
+def pint_best_vertex(df, idx, vertex_incol, func_data, sampling_meants,
+                     search_rois, padding_rois, pcorr, num_Lverts,
+                     netmeants = None, corr_kernel = None, pcorr_kernel = None):
+    '''
+    the vertex this vertex moves to (see pint_move_vertex), without changing
+    df, so many vertices can be scored at once
     '''
     vlabel = df.loc[idx,'roiidx']
     network = df.loc[idx,'NETWORK']
@@ -366,32 +720,60 @@ def pint_move_vertex(df, idx, vertex_incol, vertex_outcol,
     # if there padding mask and the search mask have no overlap - size is 0
     # there is nowhere for this vertex to move to so return the orig vertex id
     if not idx_mask.size:
-        df.loc[idx,vertex_outcol] = orig_vertex
+        return orig_vertex
 
     else:
         # create output array
         seed_corrs = np.zeros(func_data.shape[0]) - 1
 
-        # loop through each time series, calculating r
-        for i in np.arange(len(idx_mask)):
-            if pcorr:
-                o_networks = set(netmeants.columns.tolist()) - set([network])
-                seed_corrs[idx_mask[i]] = partial_corr(meants,
-                                          func_data[idx_mask[i], :],
-                                          netmeants.loc[:,o_networks].as_matrix())
-            else:
-                seed_corrs[idx_mask[i]] = np.corrcoef(meants,
-                                                      func_data[idx_mask[i], :])[0][1]
+        if pcorr:
+            # score the whole search mask at once
+            if pcorr_kernel is None:
+                pcorr_kernel = PartialCorrelationKernel(netmeants)
+            seed_corrs[idx_mask] = pcorr_kernel.correlate(meants, network,
+                                                          func_data[idx_mask, :])
+        else:
+            # score the whole search mask at once
+            if corr_kernel is None:
+                corr_kernel = CorrelationKernel(func_data)
+            seed_corrs[idx_mask] = corr_kernel.correlate(meants, idx_mask)
         ## record the vertex with the highest correlation in the mask
         peakvert = np.argmax(seed_corrs, axis=0)
         if hemi =='R': peakvert = peakvert - num_Lverts
-        df.loc[idx,vertex_outcol] = peakvert
+        return peakvert
 
-    ## return the df
-    return df
+def pint_best_vertices(df, indices, vertex_incol, func_data, sampling_meants,
+                       search_rois, padding_rois, pcorr, num_Lverts,
+                       netmeants, corr_kernel, pcorr_kernel, n_threads):
+    '''
+    runs pint_best_vertex for all of indices on a pool of n_threads threads
+    (numpy releases the GIL for the matrix products), returns their new
+    vertices in the same order
+    '''
+    ## fill the kernel caches first, so the threads only read them
+    if pcorr:
+        for network in netmeants.columns:
+            pcorr_kernel.basis(network)
+    else:
+        corr_kernel.zscores(np.where(search_rois > 0)[0])
+
+    def best_vertex(idx):
+        return pint_best_vertex(df, idx, vertex_incol, func_data,
+                                sampling_meants, search_rois, padding_rois,
+                                pcorr, num_Lverts, netmeants, corr_kernel,
+                                pcorr_kernel)
+
+    pool = ThreadPool(n_threads)
+    try:
+        return pool.map(best_vertex, indices)
+    finally:
+        pool.close()
+        pool.join()
 
 def iterate_pint(df, vertex_incol, func_data, func_zeros, pcorr,
-                 surfL, surfR, num_Lverts, start_iter = 0):
+                 surfL, surfR, num_Lverts, start_iter = 0, corr_kernel = None,
+                 pint_rois = None, update_mode = 'sequential', n_threads = 1,
+                 checkpoint = None, state = None, profile = None):
     '''
     The main bit of pint
     inputs:
@@ -400,10 +782,33 @@ def iterate_pint(df, vertex_incol, func_data, func_zeros, pcorr,
       func_data: the numpy array of the data
       func_data_mask: a mask of non-zero values from the func data
       pcorr: wether or not to use partial correlation
+      corr_kernel: the CorrelationKernel of func_data (to share it between calls)
+      pint_rois: the PintRois (made here if not given), moved to vertex_incol
+      update_mode: sequential (one vertex at a time) or jacobi (all at once,
+                   on a pool of n_threads threads)
+      checkpoint: if given, the state is written here after every iteration
+      state: a checkpoint (see read_pint_state) to continue from, if it was
+             written by a call with the same start_iter
+      profile: the PintProfile that times each iteration
     return the summary dataframe
     '''
     iter_num = start_iter
     max_distance = 10
+    if profile is None:
+        profile = PintProfile()
+    if state is not None and state['start_iter'] == start_iter:
+        df = pint_state_dataframe(state)
+        vertex_incol = state['vertex_incol']
+        vertex_outcol = state['vertex_outcol']
+        distance_outcol = state['distance_outcol']
+        iter_num = state['iter_num']
+        max_distance = state['max_distance']
+        logger.info('Resuming from iteration {}'.format(iter_num))
+    if corr_kernel is None:
+        corr_kernel = CorrelationKernel(func_data)
+    if pint_rois is None:
+        pint_rois = PintRois(df, vertex_incol, func_data, func_zeros,
+                             surfL, surfR, num_Lverts)
 
     while iter_num < (start_iter + 50) and max_distance > 1:
         vertex_outcol = 'vertex_{}'.format(iter_num)
@@ -411,38 +816,53 @@ def iterate_pint(df, vertex_incol, func_data, func_zeros, pcorr,
         df.loc[:,vertex_outcol] = -999
         df.loc[:,distance_outcol] = -99.9
 
-        ## load the sampling data
-        sampling_rois = rois_bilateral(df, vertex_incol, RADIUS_SAMPLING, surfL, surfR)
-        sampling_rois[func_zeros] = 0
-
-        ## load the search data
-        search_rois = rois_bilateral(df, vertex_incol, RADIUS_SEARCH, surfL, surfR)
-        search_rois[func_zeros] = 0
+        profile.start_iteration(iter_num)
 
-        ## load the padding-radius data
-        padding_rois = rois_bilateral(df, vertex_incol, RADIUS_PADDING, surfL, surfR)
+        ## move the sampling, search and padding rois (and the sampling
+        ## meants) to this iteration's vertices, only the rois that moved
+        ## are updated
+        with profile.phase('rois'):
+            roi_changes = pint_rois.move_rois(df, vertex_incol)[1]
+            search_rois = pint_rois.search.data
+            padding_rois = pint_rois.padding.data
 
-        ## calculate the sampling meants array
-        sampling_meants = calc_sampling_meants(func_data, sampling_rois)
+        with profile.phase('meants'):
+            pint_rois.update_meants(*roi_changes)
+            sampling_meants = pint_rois.sampling_meants
 
-        ## if we are doing partial corr create a matrix of the network
-        if pcorr:
-            netmeants = calc_network_meants(sampling_meants, df)
-        else:
-            netmeants = None
+            ## if we are doing partial corr create a matrix of the network
+            if pcorr:
+                netmeants = pint_rois.network_meants()
+                pcorr_kernel = PartialCorrelationKernel(netmeants)
+            else:
+                netmeants = None
+                pcorr_kernel = None
 
         ## run the pint_move_vertex function for each vertex
-        thisorder = df.index.tolist()
-        random.shuffle(thisorder)
-        for idx in thisorder:
-            df = pint_move_vertex(df, idx, vertex_incol, vertex_outcol,
-                                  func_data, sampling_meants,
-                                  search_rois, padding_rois, pcorr,
-                                  num_Lverts, netmeants)
+        with profile.phase('correlation'):
+            thisorder = df.index.tolist()
+            if update_mode == 'jacobi':
+                df.loc[thisorder, vertex_outcol] = pint_best_vertices(df, thisorder,
+                                      vertex_incol, func_data, sampling_meants,
+                                      search_rois, padding_rois, pcorr,
+                                      num_Lverts, netmeants, corr_kernel,
+                                      pcorr_kernel, n_threads)
+            else:
+                for idx in thisorder:
+                    df = pint_move_vertex(df, idx, vertex_incol, vertex_outcol,
+                                          func_data, sampling_meants,
+                                          search_rois, padding_rois, pcorr,
+                                          num_Lverts, netmeants, corr_kernel,
+                                          pcorr_kernel)
 
         ## calc the distances
-        df = calc_distance_column(df, vertex_incol, vertex_outcol, distance_outcol, RADIUS_SEARCH, surfL, surfR)
+        with profile.phase('distances'):
+            df = calc_distance_column(df, vertex_incol, vertex_outcol, distance_outcol, RADIUS_SEARCH, surfL, surfR)
         numNotDone = df.loc[df.loc[:,distance_outcol] > 0, 'roiidx'].count()
+        ## every vertex in both its search and padding roi is scored
+        profile.end_iteration(
+                vertices_scored = np.sum((search_rois > 0) & (search_rois == padding_rois)),
+                vertices_moved = numNotDone)
 
         ## print the max distance as things continue..
         max_distance = max(df[distance_outcol])
@@ -450,6 +870,14 @@ def iterate_pint(df, vertex_incol, func_data, func_zeros, pcorr,
         vertex_incol = vertex_outcol
         iter_num += 1
 
+        if checkpoint:
+            write_pint_state(checkpoint, {'start_iter': start_iter,
+                                          'iter_num': iter_num,
+                                          'vertex_incol': vertex_incol,
+                                          'vertex_outcol': vertex_outcol,
+                                          'distance_outcol': distance_outcol,
+                                          'max_distance': float(max_distance)}, df)
+
     ## calc a final distance column
     df.loc[:,"ivertex"] = df.loc[:,vertex_outcol]
     df  = calc_distance_column(df, 'tvertex', 'ivertex', 'distance', 150, surfL, surfR)
@@ -457,6 +885,122 @@ def iterate_pint(df, vertex_incol, func_data, func_zeros, pcorr,
     ## return the df
     return df, max_distance, distance_outcol, iter_num
 
+class PintProfile(object):
+    '''
+    Wall time and counters of a PINT run, for each step of run_PINT and for
+    each phase of every iteration of iterate_pint.
+    '''
+    ITERATION_PHASES = ['rois', 'meants', 'correlation', 'distances']
+
+    def __init__(self):
+        self.start = time.time()
+        self.steps = collections.OrderedDict()
+        self.iterations = []
+        self.__current = None
+        self.__subprocesses = ciftify.utils.subprocess_count()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''times the block, as a phase of the current iteration if one is
+        started or else as a step of the run'''
+        timings = self.steps if self.__current is None else self.__current
+        key = '{}_seconds'.format(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            timings[key] = timings.get(key, 0.0) + time.time() - start
+
+    def start_iteration(self, iter_num):
+        self.__current = collections.OrderedDict([('iteration', iter_num)])
+        for name in self.ITERATION_PHASES:
+            self.__current['{}_seconds'.format(name)] = 0.0
+        self.__iteration_start = time.time()
+        self.__iteration_subprocesses = ciftify.utils.subprocess_count()
+
+    def end_iteration(self, vertices_scored, vertices_moved):
+        row = self.__current
+        row['wall_seconds'] = time.time() - self.__iteration_start
+        row['subprocesses'] = (ciftify.utils.subprocess_count() -
+                               self.__iteration_subprocesses)
+        row['vertices_scored'] = int(vertices_scored)
+        row['vertices_moved'] = int(vertices_moved)
+        row['max_rss_mb'] = max_rss_mb()
+        self.iterations.append(row)
+        self.__current = None
+
+    def summary(self):
+        '''the totals for the whole run'''
+        run = collections.OrderedDict()
+        run['wall_seconds'] = time.time() - self.start
+        run.update(self.steps)
+        for name in self.ITERATION_PHASES:
+            key = '{}_seconds'.format(name)
+            run[key] = sum(row[key] for row in self.iterations)
+        run['iterations'] = len(self.iterations)
+        run['subprocesses'] = (ciftify.utils.subprocess_count() -
+                               self.__subprocesses)
+        run['vertices_scored'] = sum(row['vertices_scored'] for row in self.iterations)
+        run['vertices_moved'] = sum(row['vertices_moved'] for row in self.iterations)
+        run['max_rss_mb'] = max_rss_mb()
+        return run
+
+    def write(self, output_prefix):
+        '''writes <output_prefix>_pint_timings.csv and .json'''
+        columns = (['iteration'] +
+                   ['{}_seconds'.format(name) for name in self.ITERATION_PHASES] +
+                   ['wall_seconds', 'subprocesses', 'vertices_scored',
+                    'vertices_moved', 'max_rss_mb'])
+        pd.DataFrame(self.iterations, columns = columns).to_csv(
+                '{}_pint_timings.csv'.format(output_prefix), index = False)
+        with open('{}_pint_timings.json'.format(output_prefix), 'w') as timings:
+            json.dump({'run': self.summary(), 'iterations': self.iterations},
+                      timings, indent = 2)
+
+def max_rss_mb():
+    '''the peak memory use (resident set size) of this process so far in MB'''
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## ru_maxrss is in bytes on macOS, and in kilobytes on linux
+    if sys.platform == 'darwin':
+        return max_rss / (1024.0 * 1024.0)
+    return max_rss / 1024.0
+
+def write_pint_state(checkpoint, state, df):
+    '''
+    writes the iteration state and the dataframe so far to the checkpoint,
+    through a temporary file so an interrupted write never replaces it
+    '''
+    state = dict(state)
+    state['settings'] = PINT_SETTINGS
+    state['df'] = json.loads(df.to_json(orient = 'split', double_precision = 15))
+    state['dtypes'] = {col: str(dtype) for col, dtype in df.dtypes.items()}
+    tmp_checkpoint = '{}.{}.tmp'.format(checkpoint, os.getpid())
+    with open(tmp_checkpoint, 'w') as state_file:
+        json.dump(state, state_file)
+    os.rename(tmp_checkpoint, checkpoint)
+
+def read_pint_state(checkpoint, settings):
+    '''
+    reads the checkpoint, or returns None if there is none, exits if it
+    was written by a run with different inputs or settings
+    '''
+    if not os.path.exists(checkpoint):
+        logger.info('No checkpoint found at {}, starting from the beginning'.format(checkpoint))
+        return None
+    with open(checkpoint) as state_file:
+        state = json.load(state_file)
+    if state['settings'] != json.loads(json.dumps(settings)):
+        logger.error('Checkpoint {} is from a run with different inputs or '
+                     'settings, remove it to start again'.format(checkpoint))
+        sys.exit(1)
+    return state
+
+def pint_state_dataframe(state):
+    '''the dataframe of a checkpoint, with its original column types'''
+    df = pd.DataFrame(state['df']['data'], index = state['df']['index'],
+                      columns = state['df']['columns'])
+    return df.astype(state['dtypes'])
+
 def main():
     arguments  = docopt(__doc__)
     verbose      = arguments['--verbose']
@@ -486,7 +1030,12 @@ def main():
     logger.info(pint_logo())
     logger.info(ciftify.utils.section_header("Personalized Intrinsic Network Topolography (PINT)"))
     with ciftify.utils.TempDir() as tmpdir:
-        ret = run_PINT(arguments, tmpdir)
+        if arguments['--profile']:
+            profiler = cProfile.Profile()
+            ret = profiler.runcall(run_PINT, arguments, tmpdir)
+            profiler.dump_stats('{}_pint.prof'.format(output_prefix))
+        else:
+            ret = run_PINT(arguments, tmpdir)
     sys.exit(ret)
 
 
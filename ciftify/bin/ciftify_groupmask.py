@@ -23,6 +23,11 @@ a mask, for each subject, of valid voxels (i.e. voxels of signal above the perce
 Then, for each voxel/vertex we take the minimum value across the population.
 Therefore our mask contains 1 for each vertex that is valid for all participants and 0 otherwise.
 
+The percentile is found the way wb_command -cifti-stats -percentile finds it
+(linear interpolation between the sorted values). It is no longer rounded to
+the digits wb_command prints, so a value right at the threshold of a mask
+made with an older version can fall on the other side of it.
+
 Written by Erin W Dickie, April 15, 2016
 """
 import sys
@@ -32,6 +37,7 @@ import glob
 import logging
 import logging.config
 
+import numpy as np
 from docopt import docopt
 
 import ciftify
@@ -45,12 +51,23 @@ logger = logging.getLogger(os.path.basename(__file__))
 
 ## function for getting a percentile value from a cifti file
 def get_cifti_percentile(ciftifile, percentile, column):
-    pctl = ciftify.utils.get_stdout(['wb_command', '-cifti-stats',
-                      ciftifile,
-                      '-percentile', str(percentile),
-                      '-column', str(column)])
-    pctl = pctl.replace('\n','')
-    return pctl
+    '''
+    returns the given percentile of one column (map) of a cifti file, as
+    wb_command -cifti-stats -percentile does
+    '''
+    return calc_percentile(read_cifti_column(ciftifile, column), percentile)
+
+def read_cifti_column(ciftifile, column):
+    '''reads one column (map, counted from 1) of a cifti file'''
+    return ciftify.io.DenseArray(ciftifile).dense(
+            trs=[int(column) - 1])[:, 0]
+
+def calc_percentile(column_data, percentile):
+    '''
+    the percentile of column_data, by linear interpolation between the
+    sorted values (the method of wb_command -cifti-stats -percentile)
+    '''
+    return np.percentile(column_data, float(percentile))
 
 def main():
 
@@ -67,31 +84,28 @@ def main():
 
     ciftify.utils.log_arguments(arguments)
 
-    with ciftify.utils.TempDir() as tempdir:
-        logger.info('Creating tempdir:{} on host:{}'.format(tempdir,
-                    os.uname()[1]))
-
-        ## start the merge command
-        merge_cmd = ['wb_command', '-cifti-merge',
-           os.path.join(tempdir, 'mergedfile.dscalar.nii')]
-
-        for i in range(len(filelist)):
-            '''
-            for each file, threshold and binarize then add to the merge_cmd filelist
-            '''
-            ciftifile = filelist[i]
-            pctl = get_cifti_percentile(ciftifile, percentile, column)
-            ciftify.utils.run(['wb_command', '-cifti-math', 'x > {}'.format(pctl),
-                   os.path.join(tempdir, 'tmp{}.dscalar.nii'.format(i)),
-                   '-var','x',ciftifile, '-select', '1', str(column)])
-            merge_cmd.append('-cifti')
-            merge_cmd.append(os.path.join(tempdir, 'tmp{}.dscalar.nii'.format(i)))
-
-        ## merge the files and take the minimum (i.e. 100 good voxels = mask)
-        ciftify.utils.run(merge_cmd)
-        ciftify.utils.run(['wb_command', '-cifti-reduce',
-              os.path.join(tempdir, 'mergedfile.dscalar.nii'),
-              'MIN', outputmask])
+    group_mask = None
+    for ciftifile in filelist:
+        '''
+        for each file, threshold and binarize then take the running minimum
+        (i.e. 100 good voxels = mask)
+        '''
+        column_data = read_cifti_column(ciftifile, column)
+        pctl = calc_percentile(column_data, percentile)
+        logger.info('{} percentile of {} is {}'.format(percentile, ciftifile, pctl))
+        file_mask = (column_data > pctl).astype(np.float32)
+        if group_mask is None:
+            group_mask = file_mask
+            brain_models = ciftify.io.DenseArray(ciftifile).brain_models
+        elif file_mask.shape != group_mask.shape:
+            logger.error('{} does not have the same greyordinates as {}'
+                ''.format(ciftifile, filelist[0]))
+            sys.exit(1)
+        else:
+            group_mask = np.minimum(group_mask, file_mask)
+
+    ciftify.io.save_cifti(group_mask, brain_models, outputmask,
+            map_names = ['MIN'])
 
 if __name__ == "__main__":
     main()
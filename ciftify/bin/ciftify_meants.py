@@ -17,6 +17,8 @@ Options:
     --roi-label INT      Specify the numeric label of the ROI you want a seedmap for
     --weighted           Compute weighted average timeseries from the seed map
     --hemi HEMI          If the seed is a gifti file, specify the hemisphere (R or L) here
+    --precision TYPE     Read the func data as float32, float16 or float64 (overrides
+                         the CIFTIFY_PRECISION environment variable, default float32)
     --debug              Debug logging
     -h, --help           Prints this message
 
@@ -35,8 +37,14 @@ flag is given.
 
 If a mask is given, the intersection of this mask and the seed mask will be taken.
 
-If a nifti seed if given for a cifti functional file, wb_command -cifti separate will
-try extract the subcortical cifti data and try to work with that.
+The func data is read in float32 (or the --precision given), the means are always
+accumulated in float64. Seeds and masks are read in float64 so labels are exact.
+
+If a nifti seed is given for a cifti functional file, the subcortical voxels of
+the cifti are read directly, laid out as the full volume of the cifti, so the seed
+needs to be in the same voxel space.
+
+The func data is read in blocks of TRs, so files larger than memory can be used.
 
 Written by Erin W Dickie, March 17, 2016
 """
@@ -72,6 +80,9 @@ def run_ciftify_meants(tempdir):
 
     ciftify.utils.log_arguments(arguments)
 
+    if arguments['--precision']:
+        ciftify.io.set_precision(arguments['--precision'])
+
     settings = UserSettings(arguments)
 
     ## if seed is dlabel - convert to dscalar
@@ -95,8 +106,8 @@ def run_ciftify_meants(tempdir):
 
     else:
         ## calculated the meants using numpy
-        func_data, seed_data, mask_data = load_data_as_numpy_arrays(settings, tempdir)
-        calc_meants_with_numpy(func_data, seed_data, mask_data, settings)
+        func_chunks, seed_data, mask_data = load_data_as_numpy_arrays(settings, tempdir)
+        calc_meants_with_numpy(func_chunks, seed_data, mask_data, settings)
 
 def cifti_parcellate_to_meants(settings, tempdir):
     ''' use wb_command -cifti-parcellate to create meants..much faster '''
@@ -117,7 +128,13 @@ def cifti_parcellate_to_meants(settings, tempdir):
 
 
 def load_data_as_numpy_arrays(settings, tempdir):
-    '''loads the data using ciftify.io tools according to their type'''
+    '''
+    loads the seed and mask using ciftify.io tools according to their type.
+    The func data is not loaded, instead a FuncChunks reader is returned that
+    streams it in blocks of TRs laid out to match the seed. For a nifti func
+    only the voxels inside the seed are read, so the seed and mask are cut
+    down to those voxels too.
+    '''
 
     if not settings.mask_path: mask_data = None
 
@@ -125,123 +142,185 @@ def load_data_as_numpy_arrays(settings, tempdir):
         seed_info = ciftify.io.cifti_info(settings.seed_path)
         func_info = ciftify.io.cifti_info(settings.func_path)
         if not all((seed_info['maps_to_volume'], func_info['maps_to_volume'])):
-            seed_data = ciftify.io.load_concat_cifti_surfaces(settings.seed_path)
+            seed_data = ciftify.io.load_concat_cifti_surfaces(settings.seed_path, dtype = np.float64)
             if settings.func_type == "cifti":
-                func_data = ciftify.io.load_concat_cifti_surfaces(settings.func_path)
+                func_chunks = FuncChunks(settings.func_path, layout='surfaces')
             else:
                 sys.exit('If <seed> is in cifti, func file needs to match.')
             if settings.mask_path:
                 if settings.mask_type == "cifti":
-                    mask_data = ciftify.io.load_concat_cifti_surfaces(settings.mask_path)
+                    mask_data = ciftify.io.load_concat_cifti_surfaces(settings.mask_path, dtype = np.float64)
                 else:
                     sys.exit('If <seed> is in cifti, func file needs to match.')
         else:
-            seed_data = ciftify.io.load_cifti(settings.seed_path)
+            seed_data = ciftify.io.load_cifti(settings.seed_path, dtype = np.float64)
             if settings.func_type == "cifti":
-                func_data = ciftify.io.load_cifti(settings.func_path)
+                func_chunks = FuncChunks(settings.func_path, layout='stacked')
             else:
                 sys.exit('If <seed> is in cifti, func file needs to match.')
             if settings.mask_path:
                 if settings.mask_type == "cifti":
-                     mask_data = ciftify.io.load_cifti(settings.mask_path)
+                     mask_data = ciftify.io.load_cifti(settings.mask_path, dtype = np.float64)
                 else:
                   sys.exit('If <seed> is in cifti, mask file needs to match.')
 
     elif settings.seed_type == "gifti":
-        seed_data = ciftify.io.load_gii_data(settings.seed_path)
+        seed_data = ciftify.io.load_gii_data(settings.seed_path, dtype = np.float64)
         if settings.func_type == "gifti":
-            func_data = ciftify.io.load_gii_data(settings.func_path)
+            func_chunks = FuncChunks(settings.func_path)
             if settings.mask_path:
                 if settings.mask_type == "gifti":
-                    mask_data = ciftify.io.load_gii_data(settings.mask_path)
+                    mask_data = ciftify.io.load_gii_data(settings.mask_path, dtype = np.float64)
                 else:
                     sys.exit('If <seed> is in gifti, mask file needs to match.')
         elif settings.func_type == "cifti":
             if settings.hemi == 'L':
-                func_data = ciftify.io.load_hemisphere_data(settings.func_path, 'CORTEX_LEFT')
+                func_chunks = FuncChunks(settings.func_path, layout='CORTEX_LEFT')
             elif settings.hemi == 'R':
-                func_data = ciftify.io.load_hemisphere_data(settings.func_path, 'CORTEX_RIGHT')
+                func_chunks = FuncChunks(settings.func_path, layout='CORTEX_RIGHT')
             ## also need to apply this change to the mask if it matters
             if settings.mask_type == "cifti":
                  if settings.hemi == 'L':
-                     mask_data = ciftify.io.load_hemisphere_data(settings.mask_path, 'CORTEX_LEFT')
+                     mask_data = ciftify.io.load_hemisphere_data(settings.mask_path, 'CORTEX_LEFT', dtype = np.float64)
                  elif settings.hemi == 'R':
-                     mask_data = ciftify.io.load_hemisphere_data(settings.mask_path, 'CORTEX_RIGHT')
+                     mask_data = ciftify.io.load_hemisphere_data(settings.mask_path, 'CORTEX_RIGHT', dtype = np.float64)
         else:
             sys.exit('If <seed> is in gifti, <func> must be gifti or cifti')
 
     elif settings.seed_type == "nifti":
-        seed_data, _, _, _ = ciftify.io.load_nifti(settings.seed_path)
+        seed_data, _, _, _ = ciftify.io.load_nifti(settings.seed_path, dtype = np.float64)
         if settings.func_type == "nifti":
-            func_data, _, _, _ = ciftify.io.load_nifti(settings.func_path)
+            ## only the voxels inside the seed are read from the func
+            seed_voxels = seed_data.any(axis=1)
+            func_chunks = FuncChunks(settings.func_path, mask=seed_voxels)
         elif settings.func_type == 'cifti':
-            subcort_func = os.path.join(tempdir, 'subcort_func.nii.gz')
-            ciftify.utils.run(['wb_command',
-              '-cifti-separate', settings.func_path, 'COLUMN',
-              '-volume-all', subcort_func])
-            func_data, _, _, _ = ciftify.io.load_nifti(subcort_func)
+            ## the subcortical data is read in the -cifti-separate -volume-all layout
+            func_chunks = FuncChunks(settings.func_path, layout='volume')
         else:
             sys.exit('If <seed> is in nifti, func file needs to match.')
         if settings.mask_path:
             if settings.mask_type == "nifti":
-                mask_data, _, _, _ = ciftify.io.load_nifti(settings.mask_path)
+                mask_data, _, _, _ = ciftify.io.load_nifti(settings.mask_path, dtype = np.float64)
             elif settings.mask_type == 'cifti':
-                subcort_mask = os.path.join(tempdir, 'subcort_mask.nii.gz')
-                ciftify.utils.run(['wb_command',
-                  '-cifti-separate', settings.mask_path, 'COLUMN',
-                  '-volume-all', subcort_mask])
-                mask_data, _, _, _ = ciftify.io.load_nifti(subcort_mask)
+                mask_data = ciftify.io.DenseArray(settings.mask_path).volume()
             else:
                 sys.exit('If <seed> is in nifti, <mask> file needs to match.')
-
-    ## check that dim 0 of both seed and func
-    if func_data.shape[0] != seed_data.shape[0]:
-        logger.error("<func> and <seed> images have different number of voxels")
-        sys.exit(1)
+        if settings.func_type == "nifti":
+            seed_data = seed_data[seed_voxels]
+            if settings.mask_path and mask_data.shape[0] == seed_voxels.shape[0]:
+                mask_data = mask_data[seed_voxels]
 
     if seed_data.shape[1] != 1:
-        logger.WARNING("your seed volume has more than one timepoint")
+        logger.warning("your seed volume has more than one timepoint")
+
+    return(func_chunks, seed_data, mask_data)
+
+class FuncChunks(object):
+    '''
+    Streams the func data in blocks of TRs (see ciftify.io.iter_timeseries).
+    Can be iterated over more than once, each pass re-reads the file.
+    calc_meants_with_numpy makes two passes (one for the non-zero rows, one
+    for the means), so a streamed func file is read from disk twice. This
+    trades I/O for memory, as only one block of TRs is held at a time.
+
+    If a mask is given (nifti func only) just the voxels inside it are read,
+    once, with ciftify.io.load_nifti_voxels and handed out as a single block.
+    '''
+    chunk_trs = 100
+
+    def __init__(self, func_path, layout='dense', mask=None):
+        self.func_path = func_path
+        self.layout = layout
+        self.mask = mask
+        self.__voxel_data = None
+
+    def __iter__(self):
+        if self.mask is None:
+            return ciftify.io.iter_timeseries(self.func_path, self.chunk_trs,
+                    layout=self.layout)
+        if self.__voxel_data is None:
+            self.__voxel_data = ciftify.io.load_nifti_voxels(self.func_path,
+                    mask=self.mask)
+        return iter([self.__voxel_data])
+
+def calc_nonzero_indices(func_chunks, num_rows):
+    '''
+    one pass over the func data to find the rows (voxels/vertices) that have
+    a non-zero mean and standard deviation over time
+    '''
+    row_sums = np.zeros(num_rows)
+    shifted_sums = np.zeros(num_rows)
+    shifted_sumsq = np.zeros(num_rows)
+    num_trs = 0
+    for block in func_chunks:
+        if block.shape[0] != num_rows:
+            logger.error("<func> and <seed> images have different number of voxels")
+            sys.exit(1)
+        block = block.astype(np.float64)
+        if not num_trs:
+            ## shifting each row by its first value keeps the variance exact
+            shift = block[:, 0].copy()
+        row_sums += block.sum(axis=1)
+        block -= shift[:, np.newaxis]
+        shifted_sums += block.sum(axis=1)
+        shifted_sumsq += (block ** 2).sum(axis=1)
+        num_trs += block.shape[1]
+    if not num_trs:
+        logger.error("<func> has no timepoints")
+        sys.exit(1)
+    variance = shifted_sumsq / num_trs - (shifted_sums / num_trs) ** 2
+    std_nonzero = np.where(variance > 0)[0]
+    m_nonzero = np.where(row_sums != 0)[0]
+    return np.intersect1d(std_nonzero, m_nonzero), num_trs
 
-    return(func_data, seed_data, mask_data)
+def seed_labels(seed_data):
+    '''the ROI labels in the seed, i.e. its unique non-zero values'''
+    labels = np.unique(seed_data)
+    return labels[labels != 0]
 
-def calc_meants_with_numpy(func_data, seed_data, mask_data, settings):
+def calc_meants_with_numpy(func_chunks, seed_data, mask_data, settings):
     '''calculate the meants using numpy and write to file '''
     ## even if no mask given, mask out all zero elements..
-    std_array = np.std(func_data, axis=1)
-    m_array = np.mean(func_data, axis=1)
-    std_nonzero = np.where(std_array > 0)[0]
-    m_nonzero = np.where(m_array != 0)[0]
-    mask_indices = np.intersect1d(std_nonzero, m_nonzero)
+    mask_indices, num_trs = calc_nonzero_indices(func_chunks, seed_data.shape[0])
 
     if settings.mask_path:
         # attempt to mask out non-brain regions in ROIs
-        n_seeds = len(np.unique(seed_data))
         if seed_data.shape[0] != mask_data.shape[0]:
             sys.exit('ERROR: at the mask and seed images have different number of voxels')
         mask_idx = np.where(mask_data > 0)[0]
         mask_indices = np.intersect1d(mask_indices, mask_idx)
-        if len(np.unique(np.multiply(seed_data,mask_data))) != n_seeds:
-            sys.exit('ERROR: At least 1 ROI completely outside mask for {}.'.format(outputcsv))
+        seeds_in_mask = np.unique(np.multiply(seed_data, mask_data > 0))
+        if np.setdiff1d(seed_labels(seed_data), seeds_in_mask).size:
+            sys.exit('ERROR: At least 1 ROI completely outside mask for {}.'.format(settings.outputcsv))
 
+    ## each block of TRs is reduced to the roi means in one sparse product
     if settings.weighted:
-        out_data = np.average(func_data[mask_indices,:], axis=0,
-                              weights=np.ravel(seed_data[mask_indices]))
+        out_data = np.zeros(num_trs)
+        label_means = ciftify.io.LabelMeans(np.ones(seed_data.shape[0]),
+                                            rows = mask_indices,
+                                            weights = seed_data)
     else:
         # init output vector
         if settings.roi_label:
-            if float(settings.roi_label) not in np.unique(seed_data)[1:]:
-               sys.exit('ROI {}, not in seed map labels: {}'.format(settings.roi_label, np.unique(seed)[1:]))
+            if float(settings.roi_label) not in seed_labels(seed_data):
+               sys.exit('ROI {}, not in seed map labels: {}'.format(settings.roi_label, seed_labels(seed_data)))
             else:
                rois = [float(settings.roi_label)]
         else:
-            rois = np.unique(seed_data)[1:]
-        out_data = np.zeros((len(rois), func_data.shape[1]))
-
-        # get mean seed dataistic from each, append to output
-        for i, roi in enumerate(rois):
-            idx = np.where(seed_data == roi)[0]
-            idxx = np.intersect1d(mask_indices, idx)
-            out_data[i,:] = np.mean(func_data[idxx, :], axis=0)
+            rois = seed_labels(seed_data)
+        out_data = np.zeros((len(rois), num_trs))
+        label_means = ciftify.io.LabelMeans(seed_data, rois = rois,
+                                            rows = mask_indices)
+
+    # get mean seed dataistic from each block of TRs
+    start = 0
+    for block in func_chunks:
+        stop = start + block.shape[1]
+        if settings.weighted:
+            out_data[start:stop] = label_means.reduce(block)[0, :]
+        else:
+            out_data[:, start:stop] = label_means.reduce(block)
+        start = stop
 
     # write out csv
     np.savetxt(settings.outputcsv, out_data, delimiter=",")
@@ -405,9 +405,10 @@ def define_surface_settings(arguments, tmpdir):
             for hemi in ['L','R']:
                 surf_settings[hemi]['vertex_areas'] = os.path.join(tmpdir,
                         'surf{}_va.shape.gii'.format(hemi))
-                run(['wb_command', '-surface-vertex-areas',
-                        surf_settings[hemi]['surface'],
-                        surf_settings[hemi]['vertex_areas']])
+                surface = ciftify.io.SurfaceMesh.load(
+                        surf_settings[hemi]['surface'])
+                ciftify.io.save_gii_data(surface.vertex_areas,
+                        surf_settings[hemi]['vertex_areas'])
         else:
             logger.error("Need both left and right surface area arguments - only one given")
             sys.exit(1)
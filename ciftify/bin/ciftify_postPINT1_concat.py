@@ -7,13 +7,18 @@ Usage:
   ciftify_postPINT1_concat [options] <concatenated-pint> <PINT_summary.csv>...
 
 Arguments:
-    <concatenated-pint>    The concatenated PINT output to write
-    <PINT_summary.csv>     The PINT summary files (repeatable)
+    <concatenated-pint>    The concatenated PINT output to write (csv, or
+                           .npy, .parquet or .h5 by its extension)
+    <PINT_summary.csv>     The PINT summary files (repeatable, in any of the
+                           ciftify_PINT_vertices output formats)
 
 Options:
   --surfL SURFACE            The left surface on to measure distances on (see details)
   --surfR SURFACE            The right surface to to measure distances on (see details)
   --no-distance-calc         Will not calculate the distance from the template vertex
+  --append                   Add the subjects that are not in the
+                             <concatenated-pint> yet to it (see details)
+  --n-workers N              Number of summaries to read at once [default: 1]
   --debug                    Debug logging in Erin's very verbose style
   -n,--dry-run               Dry run
   --help                     Print help
@@ -22,12 +27,21 @@ DETAILS
 If surfL and surfR are not given, measurements will be done on the
 HCP s900 Average mid-surface.
 
+The distance field of each distinct template vertex is measured once, and
+shared by all the subjects.
+
+With --append, summaries of subjects already in the <concatenated-pint> are
+not read, and only the new subjects are added to it (a csv is appended to in
+place). The new rows need the same columns, so give (or leave out) the
+option --no-distance-calc as for the run that made it.
+
 Written by Erin W Dickie, April 28, 2017
 """
 import os
 import sys
 import logging
 import logging.config
+import multiprocessing
 
 import pandas as pd
 from docopt import docopt
@@ -48,7 +62,9 @@ def main():
     summary_csvs = arguments['<PINT_summary.csv>']
     surfL = arguments['--surfL']
     surfR = arguments['--surfR']
-    NO_TVERTEX_MM = ['--no-distance-calc']
+    NO_TVERTEX_MM = arguments['--no-distance-calc']
+    append = arguments['--append']
+    n_workers = int(arguments['--n-workers'])
     DEBUG = arguments['--debug']
     DRYRUN = arguments['--dry-run']
 
@@ -59,16 +75,34 @@ def main():
 
     ciftify.utils.log_arguments(arguments)
 
-    ## read all the dfs into a tupley thing
-    all_dfs = (read_process_PINT_summary(f) for f in summary_csvs)
+    ## when appending, skip the subjects that are already concatenated
+    append = append and os.path.exists(allvertices_csv)
+    if append:
+        done_subids = set(read_concatenated_subids(allvertices_csv))
+        summary_csvs = [f for f in summary_csvs
+                        if summary_subid(f) not in done_subids]
+        if not summary_csvs:
+            logger.info('All subjects are already in {}'.format(allvertices_csv))
+            return
+
+    ## read all the dfs, on a pool of workers if asked
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            all_dfs = pool.map(read_process_PINT_summary, summary_csvs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        all_dfs = [read_process_PINT_summary(f) for f in summary_csvs]
     ## concatenate all the summarycvs
     concatenated_df = pd.concat(all_dfs, ignore_index=True)
     concat_df_columns = ['subid', 'hemi','NETWORK', 'roiidx','tvertex','ivertex',
                             'dist_49','vertex_48']
 
-    if not NO_TVERTEX_MM:
+    if NO_TVERTEX_MM:
         ## if done, write to file
-        concatenated_df.to_csv(allvertices_csv, index = False, columns = concat_df_columns)
+        write_concatenated(concatenated_df, allvertices_csv, concat_df_columns, append)
     else:
         ## define the surface fo measuring..
         distance_col = 'std_distance'
@@ -78,23 +112,60 @@ def main():
             surfR = os.path.join(ciftify.config.find_HCP_S1200_GroupAvg(),
                 'S1200.R.midthickness_MSMAll.32k_fs_LR.surf.gii')
 
-        ## for each roi, calculated the distance from the tvertex to the ivertex
-        concatenated_df[distance_col] = -99.0
-        for roi in concatenated_df.roiidx.unique():
-            hemi = concatenated_df.hemi[concatenated_df.roiidx==roi].unique()[0]
-            orig_vertex = concatenated_df.tvertex[concatenated_df.roiidx==roi].unique()[0]
-            if hemi == "L": surf = surfL
-            if hemi == "R": surf = surfR
-            roi_distances =  ciftify.io.get_surf_distances(surf, orig_vertex)
-            roi_idx = concatenated_df.loc[concatenated_df.roiidx==roi].index
-            concatenated_df.loc[roi_idx,distance_col] = roi_distances[concatenated_df.loc[roi_idx,'ivertex'].values]
+        ## calculate the distance from the tvertex to the ivertex of every row,
+        ## (the few distinct tvertices are measured in one pass per hemisphere)
+        concatenated_df[distance_col] = ciftify.io.geodesic_distance_pairs(
+                {'L': surfL, 'R': surfR}, concatenated_df.hemi.values,
+                concatenated_df.tvertex.values, concatenated_df.ivertex.values,
+                limit = 100)
 
         ## replace any values where ivertex == tvertex with a 0 (tends to be -1)
         concatenated_df.loc[concatenated_df.ivertex == concatenated_df.tvertex,distance_col] = 0
 
         ## write to file
         concat_df_columns.append(distance_col)
-        concatenated_df.to_csv(allvertices_csv, index = False, columns = concat_df_columns)
+        write_concatenated(concatenated_df, allvertices_csv, concat_df_columns, append)
+
+def summary_subid(inputcsv):
+    '''the subid of a PINT summary (its output prefix, the file name without
+    its extension and a trailing _summary)'''
+    this_subid = os.path.splitext(os.path.basename(inputcsv))[0]
+    if this_subid.endswith('_summary'):
+        this_subid = this_subid[:-len('_summary')]
+    return this_subid
+
+def read_concatenated_subids(allvertices_csv):
+    '''the subids in a concatenated file (only that column of a csv is read)'''
+    if ciftify.io.pint_output_format(allvertices_csv) == 'csv':
+        subids = pd.read_csv(allvertices_csv, usecols = ['subid']).subid
+    else:
+        subids = ciftify.io.load_pint_table(allvertices_csv).subid
+    return subids.astype(str).unique()
+
+def write_concatenated(concatenated_df, allvertices_csv, columns, append):
+    '''
+    writes the concatenated df, or adds it to the end of the existing one
+    '''
+    if not append:
+        ciftify.io.save_pint_table(concatenated_df, allvertices_csv, columns = columns)
+        return
+    if ciftify.io.pint_output_format(allvertices_csv) == 'csv':
+        existing_columns = pd.read_csv(allvertices_csv, nrows = 0).columns.tolist()
+    else:
+        existing_df = ciftify.io.load_pint_table(allvertices_csv)
+        existing_columns = existing_df.columns.tolist()
+    if existing_columns != columns:
+        logger.critical("Cannot append to {}, its columns ({}) are not {}".format(
+                allvertices_csv, ', '.join(existing_columns), ', '.join(columns)))
+        sys.exit(1)
+    if ciftify.io.pint_output_format(allvertices_csv) == 'csv':
+        ## a csv is appended to in place
+        concatenated_df.to_csv(allvertices_csv, columns = columns, mode = 'a',
+                               header = False, index = False)
+    else:
+        ciftify.io.save_pint_table(pd.concat([existing_df,
+                concatenated_df.loc[:, columns]], ignore_index = True),
+                allvertices_csv)
 
 
 def read_process_PINT_summary(inputcsv):
@@ -102,9 +173,8 @@ def read_process_PINT_summary(inputcsv):
     reads in one PINT summary csv and does a little cleaning of the result..
     add an extra column that is only the PINT output prefix
     '''
-    thisdf = pd.read_csv(inputcsv)
-    this_subid = os.path.basename(inputcsv)
-    this_subid = this_subid.replace('_summary.csv','')
+    thisdf = ciftify.io.load_pint_table(inputcsv)
+    this_subid = summary_subid(inputcsv)
     thisdf['subid'] = this_subid
     if 'dist_49' not in thisdf.columns:
         thisdf['dist_49'] = 0
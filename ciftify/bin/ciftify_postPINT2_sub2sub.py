@@ -6,13 +6,19 @@ Usage:
   ciftify_postPINT2_sub2sub [options] <concatenated-pint> <output_sub2sub.csv>
 
 Arguments:
-    <concatenated-pint>    The concatenated PINT outputs (csv file)
-    <output_sub2sub.csv>   The outputfile name
+    <concatenated-pint>    The concatenated PINT outputs (csv, or .npy,
+                           .parquet or .h5 file)
+    <output_sub2sub.csv>   The outputfile name (written as csv, or npy,
+                           parquet or hdf5 by its extension, must end in .npz
+                           with --condensed)
 
 Options:
   --surfL SURFACE     The left surface on to measure distances on (see details)
   --surfR SURFACE     The right surface to to measure distances on (see details)
   --roiidx INT        Measure distances for only this roi (default will loop over all ROIs)
+  --n-workers N       Number of ROIs to measure at once [default: 1]
+  --condensed         Write condensed distance matrices, one per roi, to an
+                      npz file instead of the table (see details)
   --debug             Debug logging in Erin's very verbose style
   -n,--dry-run        Dry run
   --help              Print help
@@ -26,6 +32,16 @@ HCP S1200 Average mid-surface.
 
 Will output a csv with four columns. 'subid1', 'subid2', 'roiidx', 'distance'
 
+For each roi, the distances between the distinct ivertices are measured
+once and shared by all pairs of subjects with those ivertices. Distances
+over 100mm are given as -1.
+
+With --condensed the output is a numpy npz file (its name must end in .npz)
+holding, for each roi, the arrays roi<roiidx>_subids and
+roi<roiidx>_distances. The distances are the condensed (upper triangle)
+subject by subject matrix, in the order of the subids, and can be expanded
+with scipy.spatial.distance.squareform.
+
 Written by Erin W Dickie, May 5, 2017
 """
 import random
@@ -33,6 +49,7 @@ import os
 import sys
 import logging
 import logging.config
+import multiprocessing
 
 import pandas as pd
 import numpy as np
@@ -55,6 +72,8 @@ def main():
     surfL = arguments['--surfL']
     surfR = arguments['--surfR']
     roiidx = arguments['--roiidx']
+    n_workers = int(arguments['--n-workers'])
+    condensed = arguments['--condensed']
     DEBUG = arguments['--debug']
     DRYRUN = arguments['--dry-run']
 
@@ -64,6 +83,11 @@ def main():
 
     ciftify.utils.log_arguments(arguments)
 
+    if condensed and not output_sub2sub.endswith('.npz'):
+        logger.error("With --condensed the output is an npz file, its name "
+                "({}) must end in .npz".format(output_sub2sub))
+        sys.exit(1)
+
     if not surfL:
         surfL = os.path.join(ciftify.config.find_HCP_S1200_GroupAvg(),
             'S1200.L.midthickness_MSMAll.32k_fs_LR.surf.gii')
@@ -71,52 +95,55 @@ def main():
             'S1200.R.midthickness_MSMAll.32k_fs_LR.surf.gii')
 
     ## read in the concatenated results
-    vertices_df = pd.read_csv(allvertices_csv)
+    vertices_df = ciftify.io.load_pint_table(allvertices_csv)
     vertices_df = vertices_df.loc[:,['subid','hemi','roiidx','ivertex']]
 
     if roiidx:
         roiidx = int(roiidx)
-        if roiidx in vertices_df.loc[:,'roiidx']:
-            result = calc_allroiidx_distances(vertices_df, roiidx, surfL, surfR)
+        if roiidx in vertices_df.loc[:,'roiidx'].values:
+            all_rois = [roiidx]
         else:
             logger.critical("roiidx argument given is not in the concatenated df")
             sys.exit(1)
     else:
         all_rois = vertices_df.roiidx.unique()
-        all_sub2sub = (calc_allroiidx_distances(vertices_df, roi, surfL, surfR) for roi in all_rois)
-        result = pd.concat(all_sub2sub, ignore_index=True)
-
-    ### write out the resutls to a csv
-    result.to_csv(output_sub2sub,
-                  columns = ['subid1','subid2','roiidx','distance'],
-                  index = False)
-
-def calc_subdistances_distances(roidf, surf, subid):
-    '''
-    calculates all distances from one subject to the rest for one roi
-    returns a dataframe with columns: subid1, subid2, roiidx, distances'
-    '''
-    ## read the subids vertex from the roidf
-    ivertex1 = int(roidf.loc[roidf.loc[:,'subid']==subid,'ivertex'])
-
-    ## set up a new df
-    thisdf = roidf.rename(columns={'subid': 'subid2', 'ivertex': 'ivertex2'})
-    thisdf['subid1'] = subid
-    thisdf['ivertex1'] = ivertex1
 
-    ## calculate the distances
-    distances = ciftify.io.get_surf_distances(surf, ivertex1)
-    thisdf.loc[:,'distance'] =  distances[thisdf.loc[:,'ivertex2'],0]
-    ## set cases were ivertices are the same to distance 0
-    thisdf.loc[thisdf.loc[:,'ivertex2'] == thisdf.loc[:,'ivertex1'],'distance'] = 0
-
-    ## trim and return the result
-    result = thisdf.loc[:,['subid1','subid2','roiidx','distance']]
-    return(result)
+    ## measure the rois, on a pool of workers if asked, handling the
+    ## results of each roi as it is finished
+    jobs = [(vertices_df.loc[vertices_df.roiidx==roi,:], roi, surfL, surfR)
+            for roi in all_rois]
+    pool = None
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+        roi_matrices = pool.imap(calc_roi_matrix_job, jobs)
+    else:
+        roi_matrices = (calc_roi_matrix_job(job) for job in jobs)
 
-def calc_allroiidx_distances(vertices_df, roi, surfL, surfR):
+    try:
+        if condensed:
+            write_condensed_matrices(output_sub2sub, all_rois, roi_matrices)
+        else:
+            ### write out the resutls to a csv
+            all_sub2sub = (matrix_to_table(subids, subject_ivertex,
+                    unique_distances, roi) for roi, (subids, ivertices,
+                    subject_ivertex, unique_distances) in zip(all_rois,
+                    roi_matrices))
+            write_sub2sub_table(output_sub2sub, all_sub2sub)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def calc_roi_distance_matrix(vertices_df, roi, surfL, surfR):
     '''
-    loop over all subjects calculating distances for one roi
+    calculates the distances between all subjects for one roi
+    returns the subids, the distinct ivertices, the index into ivertices of
+    each subject and the ivertices x ivertices array of distances
+
+    the distances between the distinct ivertices are measured once, and
+    shared by every pair of subjects with those ivertices, so the distance
+    between subjects i and j is
+    unique_distances[subject_ivertex[i], subject_ivertex[j]]
     '''
     ## determine the surface for measurment
     hemi = vertices_df.loc[vertices_df.roiidx==roi,'hemi'].values[0]
@@ -125,13 +152,81 @@ def calc_allroiidx_distances(vertices_df, roi, surfL, surfR):
 
     ## subset the dataframe
     roidf = vertices_df.loc[vertices_df.roiidx==roi,:]
+    ivertices, subject_ivertex = np.unique(roidf.loc[:,'ivertex'].values.astype(int),
+                                           return_inverse = True)
+
+    unique_distances = ciftify.io.geodesic_distance_matrix(surf, ivertices,
+            ivertices, limit = 100)
+    ## set cases were ivertices are the same to distance 0
+    np.fill_diagonal(unique_distances, 0)
 
-    ## run all the subjects and return into a tupley thing of results
-    all_dfs = (calc_subdistances_distances(roidf, surf, subid) for subid in vertices_df.subid.unique())
-    ## concatenate all the results
-    roi_sub2sub = pd.concat(all_dfs, ignore_index=True)
-    return(roi_sub2sub)
+    return(roidf.loc[:,'subid'].values, ivertices, subject_ivertex,
+           unique_distances)
 
+def calc_roi_matrix_job(job):
+    '''runs calc_roi_distance_matrix for one (roidf, roi, surfL, surfR) job
+    on a pool worker'''
+    return calc_roi_distance_matrix(*job)
+
+def matrix_to_table(subids, subject_ivertex, unique_distances, roi):
+    '''
+    the long table (columns subid1, subid2, roiidx, distance) of the subject
+    by subject distances of one roi
+    '''
+    num_subjects = len(subids)
+    distances = unique_distances[np.ix_(subject_ivertex, subject_ivertex)]
+    return pd.DataFrame({'subid1': np.repeat(subids, num_subjects),
+                         'subid2': np.tile(subids, num_subjects),
+                         'roiidx': roi,
+                         'distance': distances.ravel()},
+                        columns = ['subid1','subid2','roiidx','distance'])
+
+def condensed_distances(subject_ivertex, unique_distances):
+    '''
+    the condensed (upper triangle) subject by subject distance matrix of one
+    roi, read from the distances between its distinct ivertices
+    '''
+    subject1, subject2 = np.triu_indices(len(subject_ivertex), k = 1)
+    return unique_distances[subject_ivertex[subject1], subject_ivertex[subject2]]
+
+def write_sub2sub_table(output_sub2sub, tables):
+    '''
+    writes the tables of each roi to one output, a csv is written one roi at
+    a time (the other formats are written once all rois are read)
+    '''
+    columns = ['subid1','subid2','roiidx','distance']
+    if ciftify.io.pint_output_format(output_sub2sub) != 'csv':
+        result = pd.concat(tables, ignore_index=True)
+        ciftify.io.save_pint_table(result, output_sub2sub, columns = columns)
+        return
+    header = True
+    for table in tables:
+        table.loc[:, columns].to_csv(output_sub2sub, index = False,
+                header = header, mode = 'w' if header else 'a')
+        header = False
+
+def write_condensed_matrices(output_npz, rois, matrices):
+    '''
+    writes the subids and condensed (upper triangle) distance matrix of each
+    roi (from calc_roi_distance_matrix) to one npz file
+    '''
+    arrays = {}
+    for roi, (subids, ivertices, subject_ivertex, unique_distances) in zip(
+            rois, matrices):
+        arrays['roi{}_subids'.format(roi)] = np.asarray(subids).astype(np.str_)
+        arrays['roi{}_distances'.format(roi)] = condensed_distances(
+                subject_ivertex, unique_distances)
+    with open(output_npz, 'wb') as npz_file:
+        np.savez_compressed(npz_file, **arrays)
+
+def calc_allroiidx_distances(vertices_df, roi, surfL, surfR):
+    '''
+    calculates the distances between all subjects for one roi
+    returns a dataframe with columns: subid1, subid2, roiidx, distances
+    '''
+    subids, ivertices, subject_ivertex, unique_distances = \
+            calc_roi_distance_matrix(vertices_df, roi, surfL, surfR)
+    return(matrix_to_table(subids, subject_ivertex, unique_distances, roi))
 
 if __name__ == "__main__":
     main()
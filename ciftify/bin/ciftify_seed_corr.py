@@ -19,6 +19,8 @@ Options:
     --fisher-z         Apply the fisher-z transform (arctanh) to the correlation map
     --weighted         compute weighted average timeseries from the seed map
     --use-TRs FILE     Only use the TRs listed in the file provided (TR's in file starts with 1)
+    --precision TYPE   Read the func data as float32, float16 or float64 (overrides
+                       the CIFTIFY_PRECISION environment variable, default float32)
     --debug            Debug logging
     -h, --help         Prints this message
 
@@ -80,6 +82,7 @@ def main():
     TR_file = arguments['--use-TRs']
     output_ts = arguments['--output-ts']
     hemi = arguments['--hemi']
+    precision = arguments['--precision']
     debug = arguments['--debug']
 
     if debug:
@@ -94,6 +97,10 @@ def main():
         ciftify.utils.section_header('Starting ciftify_seed_corr')))
     ciftify.utils.log_arguments(arguments)
 
+    ## the precision is passed on to ciftify_meants through the environment
+    if precision:
+        ciftify.io.set_precision(precision)
+
     ## make the tempdir
     tempdir = tempfile.mkdtemp()
 
@@ -135,20 +142,27 @@ def main():
     # load the file we just made
     seed_ts = np.loadtxt(ts_tmpfile, delimiter=',')
 
-    ## convert to nifti
+    ## the cifti data is read directly, in the order of its greyordinates
     if func_type == "cifti":
-        func_fnifti = os.path.join(tempdir,'func.nii.gz')
-        run(['wb_command','-cifti-convert','-to-nifti',func, func_fnifti])
-        func_data, outA, header, dims = ciftify.io.load_nifti(func_fnifti)
+        func_dense = ciftify.io.DenseArray(func)
+        num_rows = func_dense.num_greyordinates
+        num_timepoints = func_dense.num_timepoints
 
     # import template, store the output paramaters
     if func_type == "nifti":
-        func_data, outA, header, dims = ciftify.io.load_nifti(func)
+        func_nib = nib.load(func)
+        outA = func_nib.affine
+        dims = list(func_nib.shape)
+        if len(dims) == 3: dims.append(1)
+        num_rows = dims[0]*dims[1]*dims[2]
+        num_timepoints = dims[3]
 
     if mask_type == "cifti":
-        mask_fnifti = os.path.join(tempdir,'mask.nii.gz')
-        run(['wb_command','-cifti-convert','-to-nifti', mask, mask_fnifti])
-        mask_data, _, _, _ = ciftify.io.load_nifti(mask_fnifti)
+        mask_data = ciftify.io.DenseArray(mask).dense()[:, 0]
+        if mask_data.shape[0] != num_rows:
+            logger.error('{} and {} do not have the same greyordinates. Exiting'
+                ''.format(func, mask))
+            sys.exit(1)
 
     if mask_type == "nifti":
         if ciftify.io.voxel_spacing(func) != ciftify.io.voxel_spacing(mask):
@@ -156,66 +170,59 @@ def main():
                 ''.format(func, mask))
             sys.exit(1)
         mask_data, _, _, _ = ciftify.io.load_nifti(mask)
+        if mask_data.shape[0] != num_rows:
+            logger.error('{} and {} do not have the same number of voxels. '
+                'Exiting'.format(func, mask))
+            sys.exit(1)
 
     # decide which TRs go into the correlation
     if TR_file:
         TR_file = np.loadtxt(TR_file, int)
         TRs = TR_file - 1 # shift TR-list to be zero-indexed
     else:
-        TRs = np.arange(dims[3])
+        TRs = np.arange(num_timepoints)
+
+    ## for a nifti func and mask only the voxels inside the mask are read,
+    ## otherwise the func data is streamed in blocks of TRs
+    if func_type == "nifti" and mask_type == "nifti":
+        rows = np.where(mask_data > 0)[0]
+        func_blocks = [ciftify.io.load_nifti_voxels(func, voxels = rows)]
+    else:
+        rows = np.arange(num_rows)
+        func_blocks = ciftify.io.iter_timeseries(func, chunk_trs = 100)
+
+    ## accumulate the sums needed for the brain mask and the correlations
+    ## with the seed timeseries
+    corr_sums = SeedCorrSums(len(rows), seed_ts[TRs])
+    start = 0
+    for block in func_blocks:
+        corr_sums.add(block, start, TRs)
+        start += block.shape[1]
 
     # get mean seed timeseries
     ## even if no mask given, mask out all zero elements..
-    std_array = np.std(func_data, axis=1)
-    m_array = np.mean(func_data, axis=1)
-    std_nonzero = np.where(std_array > 0)[0]
-    m_nonzero = np.where(m_array != 0)[0]
-    idx_mask = np.intersect1d(std_nonzero, m_nonzero)
-    if mask:
+    idx_mask = corr_sums.nonzero_indices()
+    if mask_type == "cifti":
         idx_of_mask = np.where(mask_data > 0)[0]
         idx_mask = np.intersect1d(idx_mask, idx_of_mask)
 
     # create output array
-    out = np.zeros([dims[0]*dims[1]*dims[2], 1])
-
-    # look through each time series, calculating r
-    for i in np.arange(len(idx_mask)):
-        out[idx_mask[i]] = np.corrcoef(seed_ts[TRs], func_data[idx_mask[i], TRs])[0][1]
-
-    # create the 3D volume and export
-    out = out.reshape([dims[0], dims[1], dims[2], 1])
-    out = nib.nifti1.Nifti1Image(out, outA)
-
-    ## determine nifti filenames for the next two steps
-    if func_type == "nifti":
-        if fisher_z:
-            nifti_corr_output = os.path.join(tempdir, 'corr_out.nii.gz')
-            nifti_Zcorr_output = '{}.nii.gz'.format(output_prefix)
-        else:
-           nifti_corr_output = '{}.nii.gz'.format(output_prefix)
-    if func_type == "cifti":
-        nifti_corr_output = os.path.join(tempdir, 'corr_out.nii.gz')
-        if fisher_z:
-            nifti_Zcorr_output = os.path.join(tempdir, 'corrZ_out.nii.gz')
-        else:
-            nifti_Zcorr_output = nifti_corr_output
-
-    # write out nifti
-    out.to_filename(nifti_corr_output)
+    out = np.zeros([num_rows, 1])
+    out[rows[idx_mask], 0] = corr_sums.correlations(idx_mask)
 
     # do fisher-z transform on values
     if fisher_z:
-        run(['wb_command', "-volume-math 'atanh(x)'", nifti_Zcorr_output,
-            '-var', 'x', nifti_corr_output])
+        out = np.arctanh(out)
 
-    if func_type == "cifti":
-        run(['wb_command', '-cifti-reduce', func, 'MIN', os.path.join(tempdir, 'template.dscalar.nii')])
+    if func_type == "nifti":
+        # create the 3D volume and export
+        out = out.reshape([dims[0], dims[1], dims[2], 1])
+        out = nib.nifti1.Nifti1Image(out, outA)
+        out.to_filename('{}.nii.gz'.format(output_prefix))
 
-        ## convert back
-        run(['wb_command','-cifti-convert','-from-nifti',
-            nifti_Zcorr_output,
-            os.path.join(tempdir, 'template.dscalar.nii'),
-            '{}.dscalar.nii'.format(output_prefix)])
+    if func_type == "cifti":
+        ciftify.io.save_cifti(out, func_dense,
+            '{}.dscalar.nii'.format(output_prefix), map_names = [outbase])
 
     # write out the ts if asked
     if output_ts:
@@ -226,5 +233,60 @@ def main():
 
     logger.debug(ciftify.utils.section_header('Done'))
 
+class SeedCorrSums(object):
+    '''
+    Running sums over blocks of TRs for correlating every voxel with the seed
+    timeseries, without holding the whole func file in memory.
+
+    Rows are shifted by their first value before squaring, so the sums of
+    squares stay exact for voxels with large means (and zero for constant
+    voxels).
+    '''
+    def __init__(self, num_voxels, seed_ts):
+        self.seed = seed_ts - np.mean(seed_ts)
+        self.seed_ss = np.sum(self.seed ** 2)
+        self.num_trs = 0
+        self.shift = None
+        self.row_sums = np.zeros(num_voxels)
+        self.all_sums = np.zeros(num_voxels)
+        self.all_sumsq = np.zeros(num_voxels)
+        self.tr_sums = np.zeros(num_voxels)
+        self.tr_sumsq = np.zeros(num_voxels)
+        self.cross_sums = np.zeros(num_voxels)
+
+    def add(self, block, start, TRs):
+        '''adds a voxels x TRs block whose first column is TR start'''
+        block = block.astype(np.float64)
+        if self.shift is None:
+            self.shift = block[:, 0].copy()
+        self.row_sums += block.sum(axis=1)
+        block -= self.shift[:, np.newaxis]
+        self.all_sums += block.sum(axis=1)
+        self.all_sumsq += (block ** 2).sum(axis=1)
+        self.num_trs += block.shape[1]
+
+        ## the TRs (and the matching seed values) that fall in this block
+        in_block = np.where((TRs >= start) & (TRs < start + block.shape[1]))[0]
+        if not in_block.size:
+            return
+        used = block[:, TRs[in_block] - start]
+        self.tr_sums += used.sum(axis=1)
+        self.tr_sumsq += (used ** 2).sum(axis=1)
+        self.cross_sums += used.dot(self.seed[in_block])
+
+    def nonzero_indices(self):
+        '''voxels with a non-zero mean and standard deviation over all TRs'''
+        variance = self.all_sumsq / self.num_trs - \
+                (self.all_sums / self.num_trs) ** 2
+        std_nonzero = np.where(variance > 0)[0]
+        m_nonzero = np.where(self.row_sums != 0)[0]
+        return np.intersect1d(std_nonzero, m_nonzero)
+
+    def correlations(self, idx):
+        '''the pearson correlation of voxels idx with the seed'''
+        num_used = len(self.seed)
+        voxel_ss = self.tr_sumsq[idx] - self.tr_sums[idx] ** 2 / num_used
+        return self.cross_sums[idx] / np.sqrt(voxel_ss * self.seed_ss)
+
 if __name__ == '__main__':
     main()
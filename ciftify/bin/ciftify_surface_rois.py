@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 """
-Runs wb_command -surface-geodesic-rois to make rois on left and right surfaces then combines
-them into one dscalar file.
+Makes geodesic rois (like wb_command -surface-geodesic-rois) on left and right surfaces
+then combines them into one dscalar file.
 
 Usage:
     ciftify_surface_rois [options] <inputcsv> <radius> <L.surf.gii> <R.surf.gii> <output.dscalar.nii>
@@ -17,7 +17,7 @@ Options:
     --vertex-col COLNAME   Column name [default: vertex] for column with vertices
     --hemi-col COLNAME     Column name [default: hemi] where hemisphere is given as L or R
     --labels-col COLNAME   Values in this column will be multiplied by the roi
-    --overlap-logic LOGIC  Overlap logic [default: ALLOW] for wb_command
+    --overlap-logic LOGIC  Overlap logic [default: ALLOW] for the rois
     --gaussian             Build a gaussian instead of a circular ROI.
     --probmap              Divide the map by the number to inputs so that the sum is meaningful.
     --debug                Debug logging
@@ -38,7 +38,7 @@ The column (header) names can be indicated with the (--vertex-col, and --hemi-co
 arguments. Additionally, a third column can be given of interger labels to apply to
 these ROIs, indicated by the "--labels-col" option.
 
-The  argument to -overlap-logic must be one of ALLOW, CLOSEST, or EXCLUDE.
+The  argument to --overlap-logic must be one of ALLOW, CLOSEST, or EXCLUDE.
  ALLOW is the default, and means that ROIs are treated independently and may overlap.
  CLOSEST means that ROIs may not overlap, and that no ROI contains vertices that are closer to a different seed vertex.
  EXCLUDE means that ROIs may not overlap, and that any vertex within range of more than one ROI does not belong to any ROI.
@@ -61,7 +61,6 @@ import pandas as pd
 from docopt import docopt
 
 import ciftify
-from ciftify.utils import run
 
 config_path = os.path.join(os.path.dirname(ciftify.config.find_ciftify_global()), 'bin', "logging.conf")
 logging.config.fileConfig(config_path, disable_existing_loggers=False)
@@ -87,62 +86,39 @@ def run_ciftify_surface_rois(arguments, tmpdir):
     ## check that vertex-col and hemi-col exist
 
 
+    hemi_data = []
     for hemisphere in ['L','R']:
 
         surf = surfL if hemisphere == 'L' else surfR
 
-        ## from the temp text build - func masks and target masks
-        rois_2D = os.path.join(tmpdir,'rois_{}_2D.func.gii'.format(hemisphere))
-        rois_1D = os.path.join(tmpdir, 'rois_{}_1D.shape.gii'.format(hemisphere))
-
-        ## right the L and R hemisphere vertices from the table out to temptxt
-        vertex_list = os.path.join(tmpdir, 'vertex_list.txt')
         vertices = df.loc[df[hemi_col] == hemisphere, vertex_col]
         logger.info('{} vertices are: {}'.format(hemisphere, vertices))
-        if len(vertices) > 0:
-            vertices.to_csv(vertex_list,sep='\n',index=False)
-
-            if gaussian:
-                run(['wb_command', '-surface-geodesic-rois', surf,
-                       str(radius), vertex_list, rois_2D, '-gaussian',
-                       str(radius)])
-            else:
-                run(['wb_command', '-surface-geodesic-rois', surf,
-                    str(radius),  vertex_list, rois_2D,
-                    '-overlap-logic', overlap_logic])
-
-            if labels_col:
-                run(['wb_command -metric-math "x*0"', rois_1D,
-                       '-var', 'x', rois_2D, '-column', '1'], suppress_stdout=True)
-
-                for i, label in enumerate(df.loc[df[hemi_col] == hemisphere, labels_col]):
-                    run(['wb_command -metric-math "((x*{}) + y)"'.format(label), rois_1D,
-                           '-var', 'x', rois_2D, '-column', '{}'.format(i + 1),
-                          '-var', 'y', rois_1D], suppress_stdout=True)
-            else:
-                run(['wb_command', '-metric-reduce',
-                      rois_2D, 'SUM', rois_1D])
 
+        ## build the rois as a vertices x rois matrix
+        if gaussian:
+            rois = ciftify.io.geodesic_rois(surf, vertices.values, radius,
+                    gaussian = radius)
         else:
-            pd.Series([1]).to_csv(vertex_list,sep='\n',index=False)
-            run(['wb_command', '-surface-geodesic-rois', surf,
-                str(radius),  vertex_list, rois_2D])
-            run(['wb_command -metric-math "x*0"', rois_1D,
-                   '-var', 'x', rois_2D, '-column', '1'], suppress_stdout=True)
+            rois = ciftify.io.geodesic_rois(surf, vertices.values, radius,
+                    overlap_logic = overlap_logic)
 
-    if probmap:
-        mergedoutput = os.path.join(tmpdir,"mergedoutput.dscalar.nii")
-    else:
-        mergedoutput = output_dscalar
-    # combine result surfaces into a cifti file
-    run(['wb_command', '-cifti-create-dense-scalar', mergedoutput,
-           '-left-metric', os.path.join(tmpdir,'rois_L_1D.shape.gii'),
-           '-right-metric', os.path.join(tmpdir,'rois_R_1D.shape.gii')])
+        ## sum them into one map, weighting each roi by its label if given
+        if labels_col:
+            weights = df.loc[df[hemi_col] == hemisphere, labels_col].values
+        else:
+            weights = np.ones(rois.shape[1])
+        hemi_data.append(rois.dot(weights.astype(np.float64)))
 
+    rois_data = np.concatenate(hemi_data)
     if probmap:
-        run(['wb_command -cifti-math "(x/{})"'.format(len(df)),
-                output_dscalar,
-                '-var', 'x', mergedoutput ], suppress_stdout=True)
+        rois_data = rois_data / len(df)
+
+    # combine result surfaces into a cifti file
+    brain_models = nib.cifti2.BrainModelAxis.from_mask(
+            np.ones(len(hemi_data[0]), dtype=bool), name = 'CORTEX_LEFT') + \
+            nib.cifti2.BrainModelAxis.from_mask(
+            np.ones(len(hemi_data[1]), dtype=bool), name = 'CORTEX_RIGHT')
+    ciftify.io.save_cifti(rois_data, brain_models, output_dscalar)
 
 def main():
     arguments  = docopt(__doc__)
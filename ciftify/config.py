@@ -95,6 +95,48 @@ def find_ciftify_global():
 
     return dir_templates
 
+def find_cache_dir():
+    """
+    Returns the directory for ciftify's on-disk array cache, taken from the
+    shell variable CIFTIFY_CACHE_DIR. Returns None (caching is off) if it
+    is not set.
+    """
+    cache_dir = os.getenv('CIFTIFY_CACHE_DIR')
+    if not cache_dir:
+        return None
+    return os.path.abspath(os.path.expanduser(cache_dir))
+
+def find_cache_size():
+    """
+    Returns the size cap of the on-disk array cache in bytes, from the shell
+    variable CIFTIFY_CACHE_SIZE (in MB, default is 10000 MB).
+    """
+    cache_size = os.getenv('CIFTIFY_CACHE_SIZE')
+    try:
+        cache_mb = float(cache_size) if cache_size else 10000
+    except ValueError:
+        logger = logging.getLogger(__name__)
+        logger.warning("CIFTIFY_CACHE_SIZE={} is not a number, using the "
+                "default of 10000 MB".format(cache_size))
+        cache_mb = 10000
+    return int(cache_mb * 1024 * 1024)
+
+def find_precision():
+    """
+    Returns the name of the floating point precision ciftify.io loaders read
+    data in, from the shell variable CIFTIFY_PRECISION (float32, float16 or
+    float64, default is float32).
+    """
+    precision = os.getenv('CIFTIFY_PRECISION')
+    if not precision:
+        return 'float32'
+    if precision not in ('float32', 'float16', 'float64'):
+        logger = logging.getLogger(__name__)
+        logger.warning("CIFTIFY_PRECISION={} is not one of float32, float16 "
+                "or float64, using float32".format(precision))
+        return 'float32'
+    return precision
+
 def find_HCP_S900_GroupAvg():
     """return path to HCP_S900_GroupAvg which should be in ciftify"""
     s900 = os.path.join(find_ciftify_global(), 'HCP_S900_GroupAvg_v1')
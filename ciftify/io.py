@@ -6,25 +6,89 @@ loading data into numpy arrays
 
 import os
 import sys
+import copy
+import glob
+import colorsys
+import hashlib
 import logging
+import collections
 import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.sparse.csgraph
 import nibabel as nib
 import nibabel.gifti.giftiio
 
-from ciftify.utils import run, get_stdout, TempDir
+import ciftify.config
+from ciftify.utils import make_dir
+
+## cifti_info results, keyed by the (path, mtime, size) of the file
+_CIFTI_INFO_CACHE = {}
+## SurfaceMesh objects, keyed by the (path, mtime, size) of the surface
+_SURFACE_MESH_CACHE = {}
+## geodesic neighbourhood indices, keyed by the (content hash, radius) of
+## the surface
+_NEIGHBOURHOOD_CACHE = {}
 
 def cifti_info(filename):
-    '''runs wb_command -file-information" to try to figure out what the file is made off'''
-    c_info = get_stdout(['wb_command', '-file-information', filename, '-no-map-info'])
+    '''
+    reads the cifti header (not the data) to figure out what the file is made
+    of. The result is cached for as long as the file is unchanged, so
+    repeated calls are free.
+
+    Returns a dict with:
+        has_LSurf, has_RSurf:  if there is left/right cortical surface data
+        maps_to_surf, maps_to_volume:  if any data is on a surface/in a volume
+        structures:  the structures in the file (wb_command names)
+        num_maps:  the number of maps (i.e. TRs) in the file
+        volume_dims:  the dimensions of the volume (None without one)
+        surface_vertices:  the number of vertices of each surface structure
+    '''
+    logger = logging.getLogger(__name__)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        logger.error("Cannot read {}".format(filename))
+        sys.exit(1)
+    key = (os.path.realpath(filename), stat.st_mtime, stat.st_size)
+    if key not in _CIFTI_INFO_CACHE:
+        _CIFTI_INFO_CACHE[key] = read_cifti_info(filename)
+    return copy.deepcopy(_CIFTI_INFO_CACHE[key])
+
+def read_cifti_info(filename):
+    '''parses the cifti header of filename for cifti_info'''
+    logger = logging.getLogger(__name__)
+    cifti = read_cifti(filename)
+    try:
+        greyordinates = cifti.header.get_axis(1)
+    except:
+        logger.error("Cannot read the cifti header of {}".format(filename))
+        sys.exit(1)
+
+    surface_vertices = {}
+    for cifti_name, num_vertices in getattr(greyordinates, 'nvertices',
+            {}).items():
+        surface_vertices[cifti_name.replace('CIFTI_STRUCTURE_', '')] = \
+                int(num_vertices)
+    volume_shape = getattr(greyordinates, 'volume_shape', None)
+    if isinstance(greyordinates, nib.cifti2.BrainModelAxis):
+        structures = [name.replace('CIFTI_STRUCTURE_', '') for name, _, _ in
+                greyordinates.iter_structures()]
+        has_volume = bool(greyordinates.volume_mask.any())
+    else:
+        structures = sorted(surface_vertices.keys())
+        has_volume = volume_shape is not None
+
     cinfo = {}
-    for line in c_info.split(os.linesep):
-        if 'Structure' in line:
-            cinfo['has_LSurf'] = True if 'CortexLeft' in line else False
-            cinfo['has_RSurf'] = True if 'CortexRight' in line else False
-        if 'Maps to Surface' in line:
-            cinfo['maps_to_surf'] = True if "true" in line else False
-        if 'Maps to Volume' in line:
-            cinfo['maps_to_volume'] = True if "true" in line else False
+    cinfo['structures'] = structures
+    cinfo['has_LSurf'] = 'CORTEX_LEFT' in structures
+    cinfo['has_RSurf'] = 'CORTEX_RIGHT' in structures
+    cinfo['maps_to_surf'] = len(surface_vertices) > 0
+    cinfo['maps_to_volume'] = has_volume
+    cinfo['num_maps'] = int(cifti.shape[0])
+    cinfo['volume_dims'] = tuple(int(dim) for dim in volume_shape) \
+            if has_volume else None
+    cinfo['surface_vertices'] = surface_vertices
     return cinfo
 
 def determine_filetype(filename):
@@ -66,12 +130,13 @@ def voxel_spacing(filename):
     spacing = nib.load(filename).header.get_zooms()[0:3]
     return spacing
 
-def load_nifti(filename):
+def load_nifti(filename, dtype=None):
     """
     Usage:
         nifti, affine, header, dims = load_nifti(filename)
 
-    Loads a Nifti file (3 or 4 dimensions).
+    Loads a Nifti file (3 or 4 dimensions). Floating point data is returned
+    in the precision setting (see get_precision) unless a dtype is given.
 
     Returns:
         a 2D matrix of voxels x timepoints,
@@ -111,60 +176,229 @@ def load_nifti(filename):
     if len(dims) == 3:
         dims.append(1)
     nifti = nifti.reshape(dims[0]*dims[1]*dims[2], dims[3])
+    nifti = as_precision(nifti, dtype)
 
     return nifti, affine, header, dims
 
-def load_cifti(filename):
+def load_nifti_voxels(filename, voxels=None, mask=None, dtype=None):
     """
     Usage:
-        cifti, affine, header, dims = load_cifti(filename)
+        data = load_nifti_voxels(filename, voxels=indices)
+        data = load_nifti_voxels(filename, mask=mask_data)
 
-    Loads a Cifti file (6 dimensions).
+    Reads only the chosen voxels of a 3D or 4D nifti, without loading the
+    whole volume. The voxels are either indices into the flattened volume
+    (the rows of load_nifti) or the non-zero entries of a mask with one value
+    per voxel (a volume or a load_nifti style column). If neither is given,
+    all voxels are read.
+
+    Uncompressed files are read a few slices at a time, skipping slices with
+    no chosen voxels. Gzipped files cannot seek cheaply, so they are read a
+    block of TRs at a time instead. Either way peak memory follows the number
+    of voxels asked for rather than the size of the image.
 
     Returns:
-        a 2D matrix of voxels x timepoints,
-        the input file affine transform,
-        the input file header,
-        and input file dimensions.
+        a 2D matrix of the chosen voxels x timepoints (in the order given,
+        or in load_nifti order for a mask), cast to dtype if given
+        (floating point data is in the precision setting otherwise).
     """
     logger = logging.getLogger(__name__)
 
-    # load everything in
     try:
-        cifti = nib.load(filename)
+        ## keeping the file open lets gzipped files be read in one pass
+        nifti = nib.load(filename, keep_file_open=True)
     except:
         logger.error("Cannot read {}".format(filename))
         sys.exit(1)
+    dims = list(nifti.shape)
+    if len(dims) not in (3, 4):
+        raise Exception("{} is not a 3D or 4D nifti".format(filename))
+    num_trs = dims[3] if len(dims) == 4 else 1
+    voxels = nifti_voxel_indices(filename, dims[:3], voxels, mask)
+
+    dtype = precision_dtype(
+            np.asanyarray(nifti.dataobj[(0,) * len(dims)]).dtype, dtype)
+    data = np.empty((len(voxels), num_trs), dtype=dtype)
+    x, y, z = np.unravel_index(voxels, dims[:3])
+
+    if len(dims) == 3:
+        data[:, 0] = np.asanyarray(nifti.dataobj)[x, y, z]
+        return data
 
-    ## separate the cifti file into left and right surfaces
-    with TempDir() as tempdir:
-        L_data_surf=os.path.join(tempdir, 'Ldata.func.gii')
-        R_data_surf=os.path.join(tempdir, 'Rdata.func.gii')
-        vol_data_nii=os.path.join(tempdir,'vol.nii.gz')
-        run(['wb_command','-cifti-separate', filename, 'COLUMN',
-            '-metric', 'CORTEX_LEFT', L_data_surf,
-            '-metric', 'CORTEX_RIGHT', R_data_surf,
-            '-volume-all', vol_data_nii])
+    if filename.endswith('.gz'):
+        chunk_trs = 100
+        for start in range(0, num_trs, chunk_trs):
+            stop = min(start + chunk_trs, num_trs)
+            block = np.asanyarray(nifti.dataobj[..., start:stop])
+            data[:, start:stop] = block[x, y, z]
+        return data
+
+    ## read about 64MB of slices at a time
+    slice_bytes = dims[0] * dims[1] * num_trs * nifti.get_data_dtype().itemsize
+    num_slices = max(1, (64 * 1024 ** 2) // slice_bytes)
+    for start in range(0, dims[2], num_slices):
+        in_slab = np.where((z >= start) & (z < start + num_slices))[0]
+        if not in_slab.size:
+            continue
+        slab = np.asanyarray(nifti.dataobj[:, :, start:start + num_slices])
+        data[in_slab, :] = slab[x[in_slab], y[in_slab], z[in_slab] - start]
+    return data
+
+def nifti_voxel_indices(filename, volume_dims, voxels=None, mask=None):
+    '''returns the flattened voxel indices asked for in load_nifti_voxels'''
+    logger = logging.getLogger(__name__)
+    num_voxels = volume_dims[0] * volume_dims[1] * volume_dims[2]
+    if mask is not None:
+        mask = np.ravel(mask)
+        if mask.shape[0] != num_voxels:
+            logger.error("The mask has {} voxels but {} has {}".format(
+                    mask.shape[0], filename, num_voxels))
+            sys.exit(1)
+        return np.flatnonzero(mask)
+    if voxels is None:
+        return np.arange(num_voxels)
+    voxels = np.asarray(voxels, dtype=np.int64).ravel()
+    if voxels.size and (voxels.min() < 0 or voxels.max() >= num_voxels):
+        logger.error("Voxel indices are outside the {} voxels of {}".format(
+                num_voxels, filename))
+        sys.exit(1)
+    return voxels
+
+def load_cifti(filename, return_brain_models=False, dtype=None):
+    """
+    Usage:
+        cifti = load_cifti(filename)
+        cifti, brain_models = load_cifti(filename, return_brain_models=True)
 
-        ## load both surfaces and concatenate them together
-        Ldata = load_gii_data(L_data_surf)
-        Rdata = load_gii_data(R_data_surf)
-        voldata, _,_,_ = load_nifti(vol_data_nii)
+    Loads a dense Cifti file (dtseries, dscalar or dlabel) straight from its
+    data block, without a wb_command -cifti-separate round trip.
 
-        cifti_data = np.vstack((Ldata, Rdata, voldata))
+    Returns:
+        a 2D matrix of greyordinates x timepoints, stacked as all left
+        surface vertices, all right surface vertices and then all voxels of
+        the volume (the layout that load_gii_data and load_nifti produce
+        for the outputs of wb_command -cifti-separate),
+        in the precision setting (see get_precision) unless a dtype is given,
+        and, if return_brain_models is set, the nibabel BrainModelAxis
+        describing the greyordinates of the file.
+    """
+    dense_array = DenseArray(filename)
+    cifti_data = cached_load(filename, 'stacked', dense_array.stacked, dtype)
 
+    if return_brain_models:
+        return cifti_data, dense_array.brain_models
     return cifti_data
 
-def load_gii_data(filename, intent='NIFTI_INTENT_NORMAL'):
+def read_cifti(filename):
+    '''loads the cifti image with nibabel, exits if this is impossible'''
+    logger = logging.getLogger(__name__)
+    try:
+        cifti = nib.load(filename)
+    except:
+        logger.error("Cannot read {}".format(filename))
+        sys.exit(1)
+    return cifti
+
+def cifti_brain_models(cifti, filename):
+    '''returns the BrainModelAxis that describes the greyordinates (columns)
+    of a loaded dense cifti image'''
+    logger = logging.getLogger(__name__)
+    try:
+        brain_models = cifti.header.get_axis(1)
+    except:
+        logger.error("Cannot read the cifti header of {}".format(filename))
+        sys.exit(1)
+    if not isinstance(brain_models, nib.cifti2.BrainModelAxis):
+        logger.error("{} is not a dense cifti file".format(filename))
+        sys.exit(1)
+    return brain_models
+
+def cifti_stacked_rows(brain_models, surfaces=('CORTEX_LEFT', 'CORTEX_RIGHT'),
+                       volume=True, filename=''):
+    '''
+    Works out where each greyordinate lands when the cifti is separated into
+    full surfaces (one row per vertex, in the order given) followed by the
+    full volume (one row per voxel, flattened as in load_nifti).
+
+    Returns the number of rows of that stacked array and, for every
+    greyordinate, its row in it (-1 if the greyordinate is left out).
+    '''
+    logger = logging.getLogger(__name__)
+    rows = np.zeros(len(brain_models), dtype=np.int64) - 1
+    size = 0
+    for structure in surfaces:
+        cifti_name = brain_models.to_cifti_brain_structure_name(structure)
+        if cifti_name not in brain_models.nvertices:
+            logger.error("{} not found in {}".format(structure, filename))
+            sys.exit(1)
+        in_structure = brain_models.name == cifti_name
+        rows[in_structure] = size + brain_models.vertex[in_structure]
+        size += brain_models.nvertices[cifti_name]
+    if volume:
+        if brain_models.volume_shape is None:
+            logger.error("{} does not map to a volume".format(filename))
+            sys.exit(1)
+        in_volume = brain_models.volume_mask
+        rows[in_volume] = size + np.ravel_multi_index(
+                brain_models.voxel[in_volume].T, brain_models.volume_shape)
+        size += int(np.prod(brain_models.volume_shape))
+    return size, rows
+
+def scatter_greyordinates(dense_data, size, rows):
+    '''
+    copies the rows of a greyordinates x maps array into a zero filled
+    array of size rows, using the row indices from cifti_stacked_rows
+    '''
+    keep = rows >= 0
+    out_data = np.zeros((size, dense_data.shape[1]), dtype=dense_data.dtype)
+    out_data[rows[keep], :] = dense_data[keep, :]
+    return out_data
+
+def load_gii_data(filename, intent='NIFTI_INTENT_NORMAL', darrays=None,
+                  dtype=None):
     """
     Usage:
         data = load_gii_data(filename)
+        data = load_gii_data(filename, darrays=range(10), dtype=np.float32)
 
     Loads a gifti surface file (".shape.gii" or ".func.gii").
 
+    Optional arguments:
+        darrays: indices of the data arrays (i.e. TRs) to read, default is all
+        dtype:   the dtype of the output, default is the dtype of the file
+                 (or the precision setting for floating point data)
+
     Returns:
         a 2D matrix of vertices x timepoints,
     """
+    arrays = read_gii_arrays(filename, intent)
+    if darrays is not None:
+        try:
+            arrays = [arrays[DA] for DA in darrays]
+        except IndexError:
+            logger = logging.getLogger(__name__)
+            logger.error("{} has only {} data arrays".format(filename,
+                    len(arrays)))
+            sys.exit(1)
+    data = stack_gii_arrays(arrays, dtype)
+
+    return data
+
+def save_gii_data(data, filename, intent='NIFTI_INTENT_NORMAL'):
+    '''
+    writes a vertices (x maps) array to a gifti file (i.e. a .shape.gii),
+    one data array per column
+    '''
+    data = np.asanyarray(data, dtype=np.float32)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    darrays = [nib.gifti.GiftiDataArray(np.ascontiguousarray(data[:, i]),
+            intent=intent, datatype='NIFTI_TYPE_FLOAT32')
+            for i in range(data.shape[1])]
+    nib.save(nib.gifti.GiftiImage(darrays=darrays), filename)
+
+def read_gii_arrays(filename, intent='NIFTI_INTENT_NORMAL'):
+    '''reads a gifti file and returns its data arrays with this intent'''
     logger = logging.getLogger(__name__)
 
     ## use nibabel to load surface image
@@ -174,89 +408,1284 @@ def load_gii_data(filename, intent='NIFTI_INTENT_NORMAL'):
         logger.error("Cannot read {}".format(filename))
         sys.exit(1)
 
-    ## gets number of arrays (i.e. TRs)
-    numDA = surf_dist_nib.numDA
-
-    ## read all arrays and concatenate in numpy
-    try:
-        array1 = surf_dist_nib.getArraysFromIntent(intent)[0]
-    except IndexError:
+    ## get the data arrays (i.e. TRs) with this intent once
+    arrays = surf_dist_nib.getArraysFromIntent(intent)
+    if not arrays:
         logger.error("Invalid intent: {}".format(intent))
         sys.exit(1)
+    return arrays
+
+def stack_gii_arrays(arrays, dtype=None):
+    '''
+    allocates the vertices by TR output once, then fills it column by column
+    from the gifti data arrays
+    '''
+    num_vertices = arrays[0].data.shape[0] if arrays else 0
+    file_dtype = np.result_type(*[DA.data.dtype for DA in arrays]) \
+            if arrays else np.float32
+    dtype = precision_dtype(file_dtype, dtype)
+    data = np.empty((num_vertices, len(arrays)), dtype=dtype)
+    for column, DA in enumerate(arrays):
+        data[:, column] = np.ravel(DA.data)
+    return data
 
-    data = array1.data
-    if numDA >= 1:
-        for DA in range(1,numDA):
-            data = np.vstack((data, surf_dist_nib.getArraysFromIntent(intent)[
-                    DA].data))
+def iter_timeseries(filename, chunk_trs=100, layout='dense', dtype=None):
+    '''
+    Usage:
+        for block in iter_timeseries(filename, chunk_trs=100):
+            ...
 
-    ## transpose the data so that it is vertices by TR
-    data = np.transpose(data)
+    Reads a cifti, nifti or gifti timeseries chunk_trs timepoints at a time,
+    so that files larger than memory can be reduced block by block.
 
-    ## if the output is one dimensional, make it 2D
-    if len(data.shape) == 1:
-        data = data.reshape(data.shape[0],1)
+    For cifti files, layout picks the rows of each block:
+        'dense'     the greyordinates in the order they are in the file
+        'stacked'   full surfaces then the full volume (as load_cifti)
+        'surfaces'  the full left then right surfaces (as
+                    load_concat_cifti_surfaces)
+        'volume'    all voxels of the volume (as -cifti-separate -volume-all)
+        or a surface structure name (as load_hemisphere_data)
+    Nifti blocks are voxels x timepoints (as load_nifti), gifti blocks are
+    vertices x timepoints (as load_gii_data). Blocks are cast to dtype, or
+    to the precision setting if they are floating point.
 
-    return data
+    Yields:
+        2D blocks of rows x (up to) chunk_trs timepoints
+    '''
+    file_type, _ = determine_filetype(filename)
+    if file_type == 'cifti':
+        blocks = iter_cifti_timeseries(filename, chunk_trs, layout)
+    elif file_type == 'nifti':
+        blocks = iter_nifti_timeseries(filename, chunk_trs)
+    else:
+        blocks = iter_gifti_timeseries(filename, chunk_trs)
+    for block in blocks:
+        yield as_precision(block, dtype)
+
+def iter_cifti_timeseries(filename, chunk_trs, layout='dense'):
+    '''yields blocks of the cifti timeseries, see iter_timeseries'''
+    dense_array = DenseArray(filename)
+    for start in range(0, dense_array.num_timepoints, chunk_trs):
+        trs = slice(start, min(start + chunk_trs, dense_array.num_timepoints))
+        if layout == 'dense':
+            yield dense_array.dense(trs)
+        elif layout == 'stacked':
+            yield dense_array.stacked(trs=trs)
+        elif layout == 'surfaces':
+            yield dense_array.stacked(volume=False, trs=trs)
+        elif layout == 'volume':
+            yield dense_array.volume(trs)
+        else:
+            yield dense_array.surface(layout, trs)
+
+def iter_nifti_timeseries(filename, chunk_trs):
+    '''yields voxels x timepoints blocks of a 3D or 4D nifti'''
+    logger = logging.getLogger(__name__)
+    try:
+        ## keeping the file open lets gzipped files be read in one pass
+        nifti = nib.load(filename, keep_file_open=True)
+    except:
+        logger.error("Cannot read {}".format(filename))
+        sys.exit(1)
+    dims = list(nifti.shape)
+    if len(dims) == 3:
+        yield np.asanyarray(nifti.dataobj).reshape(-1, 1)
+        return
+    if len(dims) != 4:
+        raise Exception("{} is not a 3D or 4D nifti".format(filename))
+    num_voxels = dims[0] * dims[1] * dims[2]
+    for start in range(0, dims[3], chunk_trs):
+        block = np.asanyarray(nifti.dataobj[..., start:start + chunk_trs])
+        yield block.reshape(num_voxels, block.shape[3])
 
-def load_surfaces(filename, suppress_echo = False):
+def iter_gifti_timeseries(filename, chunk_trs):
+    '''yields vertices x timepoints blocks of a gifti file'''
+    arrays = read_gii_arrays(filename)
+    for start in range(0, len(arrays), chunk_trs):
+        yield stack_gii_arrays(arrays[start:start + chunk_trs])
+
+def load_surfaces(filename, suppress_echo = False, dtype = None):
     '''
-    separate a cifti file into surfaces,
-    then loads the surface data
+    loads the left and right surface data of a dense cifti file as
+    two vertices x timepoints arrays (zeros at vertices without data)
     '''
-    ## separate the cifti file into left and right surfaces
-    with TempDir() as tempdir:
-        L_data_surf=os.path.join(tempdir, 'Ldata.func.gii')
-        R_data_surf=os.path.join(tempdir, 'Rdata.func.gii')
-        run(['wb_command','-cifti-separate', filename, 'COLUMN',
-            '-metric', 'CORTEX_LEFT', L_data_surf,
-            '-metric', 'CORTEX_RIGHT', R_data_surf],
-            suppress_echo = suppress_echo)
-
-        ## load both surfaces and concatenate them together
-        Ldata = load_gii_data(L_data_surf)
-        Rdata = load_gii_data(R_data_surf)
+    Ldata = load_hemisphere_data(filename, 'CORTEX_LEFT', dtype = dtype)
+    Rdata = load_hemisphere_data(filename, 'CORTEX_RIGHT', dtype = dtype)
 
     return Ldata, Rdata
 
-def load_concat_cifti_surfaces(filename, suppress_echo = False):
+def load_concat_cifti_surfaces(filename, suppress_echo = False, dtype = None):
     '''
-    separate a cifti file into surfaces,
-    then loads and concatenates the surface data
+    loads and concatenates the left and right surface data of a cifti file
     '''
-
-    Ldata, Rdata = load_surfaces(filename, suppress_echo)
+    Ldata, Rdata = load_surfaces(filename, suppress_echo, dtype)
     data = np.vstack((Ldata, Rdata))
 
     ## return the 2D concatenated surface data
     return data
 
-def load_hemisphere_data(filename, wb_structure, suppress_echo = False):
+def load_hemisphere_data(filename, wb_structure, suppress_echo = False,
+        dtype = None):
     '''loads data from one hemisphere of dscalar,nii file'''
+    data = cached_load(filename, wb_structure,
+            lambda: DenseArray(filename).surface(wb_structure), dtype)
+    return data
+
+class DenseArray(object):
+    '''
+    Lazy access to the data matrix of a dense cifti file (dtseries, dscalar
+    or dlabel), by structure and by timepoint.
+
+    The data matrix of an uncompressed, unscaled cifti is memory mapped, so
+    only the greyordinates and timepoints that are asked for are read from
+    disk. Otherwise slices are read through the nibabel array proxy.
+
+    All methods return greyordinates x timepoints arrays. The trs argument
+    can be None (all timepoints), a slice or an array of timepoint indices.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        cifti = read_cifti(filename)
+        self.brain_models = cifti_brain_models(cifti, filename)
+        self.maps_axis = cifti.header.get_axis(0)
+        self.num_timepoints, self.num_greyordinates = cifti.shape
+        self.dtype = cifti.get_data_dtype()
+        self.__dataobj = cifti.dataobj
+        self.__matrix = self.__map_matrix(cifti.dataobj)
+
+    def __map_matrix(self, dataobj):
+        '''memory maps the (timepoints x greyordinates) data matrix if the
+        file allows it, returns None otherwise'''
+        if not nib.is_proxy(dataobj):
+            return np.asanyarray(dataobj)
+        if dataobj.slope != 1.0 or dataobj.inter != 0.0:
+            return None
+        try:
+            matrix = np.memmap(dataobj.file_like, dtype=dataobj.dtype,
+                    mode='r', offset=dataobj.offset, shape=dataobj.shape,
+                    order=dataobj.order)
+        except (TypeError, ValueError, IOError):
+            return None
+        return matrix
+
+    @property
+    def is_memmap(self):
+        return isinstance(self.__matrix, np.memmap)
+
+    @property
+    def structures(self):
+        '''the structures in the file, with wb_command style names'''
+        return [name.replace('CIFTI_STRUCTURE_', '') for name, _, _ in
+                self.brain_models.iter_structures()]
+
+    def dense(self, trs=None):
+        '''all greyordinates in the order they are stored in the file'''
+        return self.__read(slice(0, self.num_greyordinates), trs)
+
+    def structure(self, wb_structure, trs=None):
+        '''only the greyordinates of one structure (i.e. CORTEX_LEFT or
+        THALAMUS_RIGHT), in the order they are stored in the file'''
+        return self.__read(self.structure_slice(wb_structure), trs)
+
+    def structure_slice(self, wb_structure):
+        '''the slice of greyordinates that belong to one structure'''
+        logger = logging.getLogger(__name__)
+        cifti_name = self.brain_models.to_cifti_brain_structure_name(
+                wb_structure)
+        for name, greyordinates, _ in self.brain_models.iter_structures():
+            if name == cifti_name:
+                start, stop, _ = greyordinates.indices(self.num_greyordinates)
+                return slice(start, stop)
+        logger.error("{} not found in {}".format(wb_structure, self.filename))
+        sys.exit(1)
+
+    def surface(self, wb_structure, trs=None):
+        '''
+        one surface structure as a full vertices x timepoints array (with
+        zeros for vertices without data), like load_hemisphere_data
+        '''
+        greyordinates = self.structure_slice(wb_structure)
+        size, rows = cifti_stacked_rows(self.brain_models[greyordinates],
+                surfaces=[wb_structure], volume=False, filename=self.filename)
+        return scatter_greyordinates(self.__read(greyordinates, trs),
+                size, rows)
+
+    def volume(self, trs=None):
+        '''all voxels of the volume, flattened as in load_nifti'''
+        return self.stacked(surfaces=(), volume=True, trs=trs)
+
+    def stacked(self, surfaces=('CORTEX_LEFT', 'CORTEX_RIGHT'), volume=True,
+                trs=None):
+        '''the full surfaces then full volume layout of load_cifti'''
+        size, rows = cifti_stacked_rows(self.brain_models, surfaces=surfaces,
+                volume=volume, filename=self.filename)
+        included = np.where(rows >= 0)[0]
+        if not included.size:
+            return np.zeros((size, self.__num_trs(trs)), dtype=self.dtype)
+        greyordinates = slice(included.min(), included.max() + 1)
+        return scatter_greyordinates(self.__read(greyordinates, trs),
+                size, rows[greyordinates])
 
-    with TempDir() as little_tempdir:
-        ## separate the cifti file into left and right surfaces
-        data_gii = os.path.join(little_tempdir, 'data.func.gii')
-        run(['wb_command','-cifti-separate', filename, 'COLUMN',
-            '-metric', wb_structure, data_gii], suppress_echo)
+    def __num_trs(self, trs):
+        if trs is None:
+            return self.num_timepoints
+        return len(np.arange(self.num_timepoints)[trs])
 
-        # loads label table as dict and data as numpy array
-        data = load_gii_data(data_gii)
+    def __read(self, greyordinates, trs):
+        '''reads a contiguous block of greyordinates at the given trs'''
+        if trs is None:
+            trs = slice(0, self.num_timepoints)
+        if self.__matrix is not None:
+            return self.__matrix[trs, greyordinates].T
+        if isinstance(trs, slice):
+            return np.asanyarray(self.__dataobj[trs, greyordinates]).T
+        ## the proxy only takes slices, so read the span of trs asked for
+        trs = np.arange(self.num_timepoints)[trs]
+        if not trs.size:
+            return np.zeros((greyordinates.stop - greyordinates.start, 0),
+                    dtype=self.dtype)
+        span = np.asanyarray(self.__dataobj[trs.min():trs.max() + 1,
+                greyordinates])
+        return span[trs - trs.min(), :].T
+
+def save_cifti(data, template_axes, filename, map_names=None):
+    '''
+    Usage:
+        save_cifti(data, template_axes, filename)
+
+    Writes a greyordinates x maps array straight to a dense cifti file. The
+    type of file (dscalar, dtseries or dlabel) is taken from the extension
+    of filename.
+
+    template_axes gives the greyordinates to write the data on. It can be a
+    BrainModelAxis, a (maps axis, BrainModelAxis) tuple, a DenseArray or the
+    path of a dense cifti file. The rows of data must be in the order of its
+    greyordinates (i.e. DenseArray.dense()). A dtseries keeps the timing of
+    the template's series axis if it has one.
+
+    map_names (optional) names the maps of a dscalar or dlabel file. A
+    dlabel gets a label table with one label for each integer in data.
+    '''
+    logger = logging.getLogger(__name__)
+    maps_axis, brain_models = cifti_template_axes(template_axes)
+
+    data = np.asanyarray(data)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    if data.shape[0] != len(brain_models):
+        logger.error("Cannot write {}, the data has {} rows but the template "
+                "has {} greyordinates".format(filename, data.shape[0],
+                len(brain_models)))
+        sys.exit(1)
+    num_maps = data.shape[1]
+    if map_names is None:
+        map_names = ['#{}'.format(i + 1) for i in range(num_maps)]
+
+    if filename.endswith('.dtseries.nii'):
+        if isinstance(maps_axis, nib.cifti2.SeriesAxis):
+            row_axis = nib.cifti2.SeriesAxis(maps_axis.start, maps_axis.step,
+                    num_maps, unit=maps_axis.unit)
+        else:
+            row_axis = nib.cifti2.SeriesAxis(0, 1, num_maps)
+        intent = 'ConnDenseSeries'
+    elif filename.endswith('.dlabel.nii'):
+        labels = [cifti_label_table(data[:, i]) for i in range(num_maps)]
+        row_axis = nib.cifti2.LabelAxis(map_names, labels)
+        intent = 'ConnDenseLabel'
+    elif filename.endswith('.dscalar.nii'):
+        row_axis = nib.cifti2.ScalarAxis(map_names)
+        intent = 'ConnDenseScalar'
+    else:
+        logger.error("Cannot write {}, it is not a .dscalar.nii, "
+                ".dtseries.nii or .dlabel.nii file".format(filename))
+        sys.exit(1)
+
+    cifti = nib.Cifti2Image(data.T.astype(np.float32),
+            header=(row_axis, brain_models))
+    cifti.nifti_header.set_intent(intent)
+    cifti.to_filename(filename)
+
+def cifti_template_axes(template_axes):
+    '''returns the (maps axis, BrainModelAxis) for save_cifti'''
+    if isinstance(template_axes, nib.cifti2.BrainModelAxis):
+        return None, template_axes
+    if isinstance(template_axes, DenseArray):
+        return template_axes.maps_axis, template_axes.brain_models
+    if isinstance(template_axes, tuple):
+        return template_axes
+    cifti = read_cifti(template_axes)
+    return cifti.header.get_axis(0), cifti_brain_models(cifti, template_axes)
+
+def cifti_label_table(label_data):
+    '''
+    makes a cifti label table ({key: (name, rgba)}) with a label for every
+    integer in label_data, with colours spread around the colour wheel
+    '''
+    label_table = {0: ('???', (0.0, 0.0, 0.0, 0.0))}
+    keys = [int(key) for key in np.unique(label_data) if int(key) != 0]
+    for i, key in enumerate(keys):
+        red, green, blue = colorsys.hsv_to_rgb(float(i) / max(len(keys), 1),
+                0.8, 0.9)
+        label_table[key] = ('LABEL_{}'.format(key), (red, green, blue, 1.0))
+    return label_table
+
+def cached_load(filename, part, loader, dtype=None):
+    '''
+    returns the array from loader() for this part (i.e. a structure) of
+    filename in dtype (or the precision setting), reading it from the array
+    cache when caching is switched on (see get_array_cache) and storing it
+    there after a miss
+    '''
+    cache = get_array_cache()
+    if cache is None:
+        return as_precision(loader(), dtype)
+    precision = np.dtype(dtype).name if dtype is not None \
+            else get_precision().name
+    key = cache.key(filename, part, precision)
+    data = cache.get(key)
+    if data is None:
+        data = as_precision(loader(), dtype)
+        cache.put(key, data)
     return data
 
+def get_precision():
+    '''
+    returns the numpy dtype that floating point data is read in, set with
+    set_precision or the CIFTIFY_PRECISION shell variable (default float32).
+    Calculations on the data should still accumulate in float64.
+    '''
+    return np.dtype(ciftify.config.find_precision())
+
+def set_precision(precision):
+    '''
+    sets the precision (float32, float16 or float64) floating point data is
+    read in, for this process and any ciftify commands it runs
+    '''
+    logger = logging.getLogger(__name__)
+    if precision not in ('float32', 'float16', 'float64'):
+        logger.error("Precision {} is not one of float32, float16 or "
+                "float64".format(precision))
+        sys.exit(1)
+    os.environ['CIFTIFY_PRECISION'] = precision
+
+def precision_dtype(data_dtype, dtype=None):
+    '''
+    the dtype to return data of data_dtype in: dtype if given, otherwise the
+    precision setting for floating point data and data_dtype for the rest
+    '''
+    if dtype is not None:
+        return np.dtype(dtype)
+    if np.issubdtype(data_dtype, np.floating):
+        return get_precision()
+    return np.dtype(data_dtype)
+
+def as_precision(data, dtype=None):
+    '''casts data to precision_dtype (without a copy if it already is)'''
+    return data.astype(precision_dtype(data.dtype, dtype), copy=False)
+
+def get_array_cache():
+    '''
+    returns the ArrayCache in the directory set by CIFTIFY_CACHE_DIR (with
+    a size cap from CIFTIFY_CACHE_SIZE), or None if caching is off
+    '''
+    cache_dir = ciftify.config.find_cache_dir()
+    if cache_dir is None:
+        return None
+    return ArrayCache(cache_dir, ciftify.config.find_cache_size())
+
+class ArrayCache(object):
+    '''
+    An on-disk cache of decoded arrays.
+
+    Arrays are stored as .npy files so that a hit is a memory mapped read
+    (copy-on-write, the cache file itself is never changed). Keys are made
+    from the path, modification time and size of the source file, so an
+    edited file is never served stale data. Once the cache is larger than
+    max_size bytes, the least recently used arrays are removed.
+    '''
+    VERSION = 1
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        make_dir(cache_dir)
+
+    def key(self, filename, *parts):
+        '''the cache key for parts (i.e. a structure name) of filename'''
+        stat = os.stat(filename)
+        return self.parts_key(os.path.realpath(filename), stat.st_mtime,
+                stat.st_size, *parts)
+
+    def parts_key(self, *parts):
+        '''the cache key for arrays that are not read from one file'''
+        source = '|'.join(str(item) for item in [self.VERSION] + list(parts))
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{}.npy'.format(key))
+
+    def get(self, key):
+        '''returns the cached array for key, or None after a miss'''
+        logger = logging.getLogger(__name__)
+        cached = self.path(key)
+        if not os.path.exists(cached):
+            return None
+        try:
+            data = np.load(cached, mmap_mode='c')
+            ## the modification time of an entry records when it was last used
+            os.utime(cached, None)
+        except (IOError, OSError, ValueError):
+            logger.debug("Dropping unreadable cache entry {}".format(cached))
+            self.remove(cached)
+            return None
+        return data
+
+    def put(self, key, data, evict=True):
+        '''stores data under key, then evicts old entries if needed (pass
+        evict=False when storing many entries, and call evict once after)'''
+        logger = logging.getLogger(__name__)
+        cached = self.path(key)
+        ## write to a temporary name first, so concurrent jobs never read a
+        ## half written entry
+        tmp_cached = '{}.{}.tmp'.format(cached, os.getpid())
+        try:
+            with open(tmp_cached, 'wb') as cache_file:
+                np.save(cache_file, np.asanyarray(data))
+            os.rename(tmp_cached, cached)
+        except (IOError, OSError):
+            logger.warning("Could not write to the array cache in "
+                    "{}".format(self.cache_dir))
+            self.remove(tmp_cached)
+            return
+        if evict:
+            self.evict()
+
+    def evict(self):
+        '''removes the least recently used entries until the cache fits in
+        max_size'''
+        if self.max_size is None:
+            return
+        entries = []
+        for cached in glob.glob(os.path.join(self.cache_dir, '*.npy')):
+            try:
+                stat = os.stat(cached)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, cached))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, cached in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self.remove(cached)
+            total_size -= size
+
+    def remove(self, cached):
+        try:
+            os.remove(cached)
+        except OSError:
+            pass
+
+class SurfaceMesh(object):
+    '''
+    A triangulated surface (.surf.gii) held in memory for native geometric
+    calculations.
+
+    Attributes:
+        coords:       vertices x 3 array of coordinates (mm)
+        triangles:    triangles x 3 array of vertex indices
+        adjacency:    vertices x vertices scipy.sparse CSR matrix, holding
+                      the length of the edge between each pair of
+                      neighbouring vertices
+        vertex_areas: the area of each vertex, one third of the area of each
+                      triangle it is part of (as wb_command
+                      -surface-vertex-areas)
+
+    Use SurfaceMesh.load to read a surface, which keeps the decoded mesh in
+    a compact .npz cache next to the surface file.
+    '''
+    VERSION = 1
+
+    def __init__(self, coords, triangles, filename=None):
+        self.filename = filename
+        self.coords = np.asarray(coords)
+        self.triangles = np.asarray(triangles, dtype=np.int32)
+        self.adjacency = self.__edge_lengths()
+        self.vertex_areas = self.__vertex_areas()
+
+    @property
+    def num_vertices(self):
+        return self.coords.shape[0]
+
+    def content_hash(self):
+        '''a sha1 of the coordinates and triangles, the same for every copy
+        of a surface'''
+        if getattr(self, '_content_hash', None) is None:
+            content = hashlib.sha1()
+            content.update(np.ascontiguousarray(self.coords,
+                    dtype=np.float32).tobytes())
+            content.update(np.ascontiguousarray(self.triangles,
+                    dtype=np.int32).tobytes())
+            self._content_hash = content.hexdigest()
+        return self._content_hash
+
+    def geodesic_distances(self, sources, limit=None):
+        '''
+        returns a vertices x sources array of the geodesic distance from each
+        source vertex to every vertex, or -1 where that is more than limit mm
+
+        Distances are shortest paths through the distance_graph, a close
+        approximation of the exact geodesic (it is never shorter).
+        '''
+        sources = np.atleast_1d(np.asarray(sources, dtype=np.int64))
+        distances = scipy.sparse.csgraph.dijkstra(self.distance_graph(),
+                directed=False, indices=sources,
+                limit=np.inf if limit is None else float(limit))
+        distances[np.isinf(distances)] = -1
+        return distances.T
+
+    def distance_graph(self):
+        '''
+        the edge graph of the mesh, plus a "face corrected" edge joining the
+        far corners of each pair of triangles that share an edge, as long as
+        the straight line between them stays inside the two triangles once
+        they are unfolded into a plane. Paths can then cut across triangles
+        instead of zig-zagging along edges.
+        '''
+        if getattr(self, '_distance_graph', None) is None:
+            corners, lengths = self.__face_corrected_edges()
+            rows = np.concatenate((corners[:, 0], corners[:, 1]))
+            columns = np.concatenate((corners[:, 1], corners[:, 0]))
+            corrections = scipy.sparse.csr_matrix((np.concatenate((lengths,
+                    lengths)), (rows, columns)), shape=self.adjacency.shape)
+            self._distance_graph = (self.adjacency + corrections).tocsr()
+        return self._distance_graph
+
+    def __face_corrected_edges(self):
+        '''returns the (far corner, far corner) pairs of triangles that share
+        an edge, and the unfolded distance between them'''
+        triangles = self.triangles
+        ## each triangle edge, with the corner of the triangle opposite it
+        edges = np.vstack((triangles[:, [0, 1, 2]], triangles[:, [1, 2, 0]],
+                triangles[:, [2, 0, 1]]))
+        edges[:, :2] = np.sort(edges[:, :2], axis=1)
+        edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+        shared = np.where((edges[:-1, 0] == edges[1:, 0]) &
+                (edges[:-1, 1] == edges[1:, 1]))[0]
+        a, b = edges[shared, 0], edges[shared, 1]
+        c, d = edges[shared, 2], edges[shared + 1, 2]
+
+        ## unfold both triangles about the shared edge a-b: a is the origin,
+        ## b is on the x axis, c is above it and d below it
+        coords = self.coords.astype(np.float64)
+        edge_length = np.linalg.norm(coords[b] - coords[a], axis=1)
+        axis = (coords[b] - coords[a]) / edge_length[:, np.newaxis]
+        def unfold(corner):
+            offset = coords[corner] - coords[a]
+            x = np.sum(offset * axis, axis=1)
+            y = np.linalg.norm(offset - x[:, np.newaxis] * axis, axis=1)
+            return x, y
+        x_c, y_c = unfold(c)
+        x_d, y_d = unfold(d)
+        y_d = -y_d
+        ## where the straight line from c to d crosses the shared edge
+        crossing = x_c + y_c * (x_d - x_c) / (y_c - y_d)
+        inside = (crossing >= 0) & (crossing <= edge_length) & (c != d)
+        lengths = np.hypot(x_c - x_d, y_c - y_d)
+
+        corners = np.sort(np.column_stack((c, d))[inside], axis=1)
+        lengths = lengths[inside]
+        ## drop pairs that are already joined by an edge (which is shorter)
+        ## and keep one (the shortest) of any repeated pairs
+        is_edge = np.asarray(self.adjacency[corners[:, 0],
+                corners[:, 1]]).ravel() > 0
+        corners, lengths = corners[~is_edge], lengths[~is_edge]
+        order = np.lexsort((lengths, corners[:, 1], corners[:, 0]))
+        corners, lengths = corners[order], lengths[order]
+        first = np.ones(len(corners), dtype=bool)
+        first[1:] = np.any(corners[1:] != corners[:-1], axis=1)
+        return corners[first], lengths[first]
+
+    def neighbours(self, vertex):
+        '''returns the vertices sharing an edge with vertex, and the edge
+        lengths'''
+        start, stop = self.adjacency.indptr[vertex:vertex + 2]
+        return (self.adjacency.indices[start:stop],
+                self.adjacency.data[start:stop])
+
+    def __edge_lengths(self):
+        edges = np.vstack((self.triangles[:, [0, 1]], self.triangles[:, [1, 2]],
+                self.triangles[:, [2, 0]]))
+        ## each edge is shared by two triangles, so keep one copy of it
+        edges = np.unique(np.sort(edges, axis=1), axis=0)
+        coords = self.coords.astype(np.float64)
+        lengths = np.linalg.norm(coords[edges[:, 0]] - coords[edges[:, 1]],
+                axis=1)
+        rows = np.concatenate((edges[:, 0], edges[:, 1]))
+        columns = np.concatenate((edges[:, 1], edges[:, 0]))
+        return scipy.sparse.csr_matrix((np.concatenate((lengths, lengths)),
+                (rows, columns)), shape=(self.num_vertices, self.num_vertices))
+
+    def __vertex_areas(self):
+        coords = self.coords.astype(np.float64)
+        corners = [coords[self.triangles[:, i]] for i in range(3)]
+        areas = 0.5 * np.linalg.norm(np.cross(corners[1] - corners[0],
+                corners[2] - corners[0]), axis=1)
+        return np.bincount(self.triangles.ravel(),
+                weights=np.repeat(areas / 3.0, 3),
+                minlength=self.num_vertices)
+
+    @classmethod
+    def load(cls, filename, use_cache=True):
+        '''
+        reads the mesh of a .surf.gii file, from its .npz cache when that is
+        up to date, writing the cache after a miss (see cache_path)
+        '''
+        logger = logging.getLogger(__name__)
+        if use_cache:
+            mesh = cls.__read_cache(filename)
+            if mesh is not None:
+                return mesh
+        try:
+            surface = nibabel.gifti.giftiio.read(filename)
+            coords = surface.getArraysFromIntent('NIFTI_INTENT_POINTSET')[0].data
+            triangles = surface.getArraysFromIntent(
+                    'NIFTI_INTENT_TRIANGLE')[0].data
+        except:
+            logger.error("Cannot read surface {}".format(filename))
+            sys.exit(1)
+        mesh = cls(coords, triangles, filename)
+        if use_cache:
+            mesh.save(filename)
+        return mesh
+
+    @classmethod
+    def cache_path(cls, filename):
+        '''
+        the .npz cache of a surface is kept next to it, or in the
+        CIFTIFY_CACHE_DIR when the surface's directory is not writable
+        '''
+        surface_dir = os.path.dirname(os.path.abspath(filename))
+        cache_name = '{}.mesh.npz'.format(os.path.basename(filename))
+        cache_dir = ciftify.config.find_cache_dir()
+        if os.access(surface_dir, os.W_OK) or cache_dir is None:
+            return os.path.join(surface_dir, cache_name)
+        path_hash = hashlib.sha1(os.path.realpath(filename).encode('utf-8'))
+        return os.path.join(cache_dir, '{}.{}'.format(path_hash.hexdigest(),
+                cache_name))
+
+    @classmethod
+    def __source_stamp(cls, filename):
+        stat = os.stat(filename)
+        return np.array([cls.VERSION, stat.st_mtime, stat.st_size])
+
+    @classmethod
+    def __read_cache(cls, filename):
+        logger = logging.getLogger(__name__)
+        cached = cls.cache_path(filename)
+        if not os.path.exists(cached):
+            return None
+        try:
+            with np.load(cached) as npz:
+                if not np.array_equal(npz['source'],
+                        cls.__source_stamp(filename)):
+                    return None
+                mesh = cls.__new__(cls)
+                mesh.filename = filename
+                mesh.coords = npz['coords']
+                mesh.triangles = npz['triangles']
+                mesh.adjacency = scipy.sparse.csr_matrix((npz['edge_lengths'],
+                        npz['indices'], npz['indptr']),
+                        shape=(len(mesh.coords), len(mesh.coords)))
+                mesh.vertex_areas = npz['vertex_areas']
+        except (IOError, OSError, ValueError, KeyError):
+            logger.debug("Ignoring unreadable surface cache {}".format(cached))
+            return None
+        return mesh
+
+    def save(self, filename):
+        '''writes the mesh to the .npz cache of the surface filename'''
+        logger = logging.getLogger(__name__)
+        cached = self.cache_path(filename)
+        ## write to a temporary name first, so concurrent jobs never read a
+        ## half written cache
+        tmp_cached = '{}.{}.tmp.npz'.format(cached, os.getpid())
+        try:
+            np.savez(tmp_cached, source=self.__source_stamp(filename),
+                    coords=self.coords, triangles=self.triangles,
+                    indptr=self.adjacency.indptr,
+                    indices=self.adjacency.indices,
+                    edge_lengths=self.adjacency.data,
+                    vertex_areas=self.vertex_areas)
+            os.rename(tmp_cached, cached)
+        except (IOError, OSError):
+            logger.debug("Could not write the surface cache {}".format(cached))
+            if os.path.exists(tmp_cached):
+                os.remove(tmp_cached)
+
 ## measuring distance
-def get_surf_distances(surf, orig_vertex, radius_search=100,
-                        dryrun = False, suppress_echo = False):
+def load_surface_mesh(filename):
+    '''
+    returns the SurfaceMesh of a .surf.gii file, kept in memory for the rest
+    of the process (until the file changes) so it is only read once
+    '''
+    stat = os.stat(filename)
+    key = (os.path.realpath(filename), stat.st_mtime, stat.st_size)
+    if key not in _SURFACE_MESH_CACHE:
+        _SURFACE_MESH_CACHE[key] = SurfaceMesh.load(filename)
+    return _SURFACE_MESH_CACHE[key]
+
+def geodesic_neighbourhoods(surf, radius):
+    '''
+    Usage:
+        neighbours = geodesic_neighbourhoods(surf, radius)
+
+    An index of the vertices within radius mm (geodesic distance, see
+    SurfaceMesh.geodesic_distances) of every vertex of the surface.
+
+    Returns a vertices x vertices scipy.sparse CSR matrix, where row v holds
+    the neighbours of v and their distances. v is its own neighbour, stored
+    as an explicit 0.
+
+    Indices are built once per surface content and radius (so subjects that
+    share a surface share an index), then kept in memory and, if
+    CIFTIFY_CACHE_DIR is set, on disk. An index for a smaller radius is cut
+    from any larger one already built.
+    '''
+    surface = load_surface_mesh(surf)
+    surface_hash = surface.content_hash()
+    radius = float(radius)
+    key = (surface_hash, radius)
+    if key in _NEIGHBOURHOOD_CACHE:
+        return _NEIGHBOURHOOD_CACHE[key]
+
+    neighbours = read_neighbourhoods(surface_hash, radius)
+    if neighbours is None:
+        larger = larger_neighbourhoods(surface_hash, radius)
+        if larger is not None:
+            neighbours = trim_neighbourhoods(larger, radius)
+        else:
+            neighbours = build_neighbourhoods(surface, radius)
+        write_neighbourhoods(neighbours, surface_hash, radius)
+    _NEIGHBOURHOOD_CACHE[key] = neighbours
+    return neighbours
+
+def build_neighbourhoods(surface, radius, batch_size=256):
+    '''runs the distance search from every vertex, a batch of sources at a
+    time, keeping the vertices within radius as CSR rows'''
+    indptr = [0]
+    indices = []
+    distances = []
+    for start in range(0, surface.num_vertices, batch_size):
+        sources = np.arange(start, min(start + batch_size,
+                surface.num_vertices))
+        batch = surface.geodesic_distances(sources, limit=radius).T
+        rows, columns = np.nonzero(batch >= 0)
+        indices.append(columns)
+        distances.append(batch[rows, columns])
+        indptr.extend(indptr[-1] + np.cumsum(np.bincount(rows,
+                minlength=len(sources))))
+    return scipy.sparse.csr_matrix((np.concatenate(distances),
+            np.concatenate(indices), np.array(indptr)),
+            shape=(surface.num_vertices, surface.num_vertices))
+
+def trim_neighbourhoods(neighbours, radius):
+    '''cuts an index down to the neighbours within a smaller radius'''
+    keep = neighbours.data <= radius
+    rows = np.repeat(np.arange(neighbours.shape[0]), np.diff(neighbours.indptr))
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[keep],
+            minlength=neighbours.shape[0]))))
+    return scipy.sparse.csr_matrix((neighbours.data[keep],
+            neighbours.indices[keep], indptr), shape=neighbours.shape)
+
+def neighbourhoods_path(cache_dir, surface_hash, radius):
+    return os.path.join(cache_dir, '{}.r{:g}.neighbours.npz'.format(
+            surface_hash, radius))
+
+def neighbourhoods_cache_dir():
+    cache_dir = ciftify.config.find_cache_dir()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, 'geodesic')
+
+def larger_neighbourhoods(surface_hash, radius):
+    '''returns the smallest index for this surface with a radius above
+    radius (from memory, then disk), or None'''
+    radii = [cached_radius for cached_hash, cached_radius in
+            _NEIGHBOURHOOD_CACHE if cached_hash == surface_hash and
+            cached_radius > radius]
+    if radii:
+        return _NEIGHBOURHOOD_CACHE[(surface_hash, min(radii))]
+    cache_dir = neighbourhoods_cache_dir()
+    if cache_dir is None:
+        return None
+    pattern = neighbourhoods_path(cache_dir, surface_hash, 0).replace(
+            '.r0.', '.r*.')
+    for cached in glob.glob(pattern):
+        try:
+            cached_radius = float(cached.split('.r')[-1].replace(
+                    '.neighbours.npz', ''))
+        except ValueError:
+            continue
+        if cached_radius > radius:
+            radii.append(cached_radius)
+    for cached_radius in sorted(radii):
+        neighbours = read_neighbourhoods(surface_hash, cached_radius)
+        if neighbours is not None:
+            return neighbours
+    return None
+
+def read_neighbourhoods(surface_hash, radius):
+    logger = logging.getLogger(__name__)
+    cache_dir = neighbourhoods_cache_dir()
+    if cache_dir is None:
+        return None
+    cached = neighbourhoods_path(cache_dir, surface_hash, radius)
+    if not os.path.exists(cached):
+        return None
+    try:
+        return scipy.sparse.load_npz(cached).tocsr()
+    except (IOError, OSError, ValueError, KeyError):
+        logger.debug("Ignoring unreadable neighbourhood index {}".format(
+                cached))
+        return None
+
+def write_neighbourhoods(neighbours, surface_hash, radius):
+    logger = logging.getLogger(__name__)
+    cache_dir = neighbourhoods_cache_dir()
+    if cache_dir is None:
+        return
+    cached = neighbourhoods_path(cache_dir, surface_hash, radius)
+    ## write to a temporary name first, so concurrent jobs never read a
+    ## half written index
+    tmp_cached = '{}.{}.tmp.npz'.format(cached, os.getpid())
+    try:
+        make_dir(cache_dir)
+        scipy.sparse.save_npz(tmp_cached, neighbours, compressed=False)
+        os.rename(tmp_cached, cached)
+    except (IOError, OSError):
+        logger.warning("Could not write the neighbourhood index {}".format(
+                cached))
+        if os.path.exists(tmp_cached):
+            os.remove(tmp_cached)
+
+def geodesic_rois(surf, vertices, radius, overlap_logic='ALLOW',
+        gaussian=None):
+    '''
+    Usage:
+        rois = geodesic_rois(surf, vertices, radius)
+
+    Builds a geodesic ROI of radius mm around each of vertices, in the same
+    way as wb_command -surface-geodesic-rois but in process (from the
+    geodesic_neighbourhoods index).
+
+    overlap_logic decides what happens to vertices in range of more than
+    one ROI:
+        ALLOW     ROIs are independent and may overlap
+        CLOSEST   the vertex only belongs to the ROI with the nearest seed
+        EXCLUDE   the vertex does not belong to any ROI
+    If gaussian (a sigma in mm) is given, ROI values are a gaussian kernel
+    of the distance to the seed instead of 1.
+
+    Returns a vertices x ROIs scipy.sparse CSR matrix of ROI values.
+    '''
+    logger = logging.getLogger(__name__)
+    if overlap_logic not in ('ALLOW', 'CLOSEST', 'EXCLUDE'):
+        logger.error("Overlap logic {} is not one of ALLOW, CLOSEST or "
+                "EXCLUDE".format(overlap_logic))
+        sys.exit(1)
+    neighbours = geodesic_neighbourhoods(surf, radius)
+    vertices = np.asarray(vertices, dtype=np.int64).ravel()
+    num_vertices = neighbours.shape[0]
+
+    ## read each seed's neighbourhood straight from the index, so the seed
+    ## itself (stored as an explicit 0 mm) is kept
+    starts = neighbours.indptr[vertices]
+    stops = neighbours.indptr[vertices + 1]
+    entries = np.concatenate([np.arange(start, stop) for start, stop in
+            zip(starts, stops)] + [np.zeros(0, dtype=np.int64)])
+    roi_ids = np.repeat(np.arange(len(vertices)), stops - starts)
+    vertex_ids = neighbours.indices[entries]
+    distances = neighbours.data[entries]
+
+    if overlap_logic != 'ALLOW' and len(vertex_ids):
+        order = np.lexsort((distances, vertex_ids))
+        roi_ids, vertex_ids, distances = (roi_ids[order], vertex_ids[order],
+                distances[order])
+        first = np.ones(len(vertex_ids), dtype=bool)
+        first[1:] = vertex_ids[1:] != vertex_ids[:-1]
+        if overlap_logic == 'CLOSEST':
+            keep = first
+        else:
+            last = np.ones(len(vertex_ids), dtype=bool)
+            last[:-1] = first[1:]
+            keep = first & last
+        roi_ids, vertex_ids, distances = (roi_ids[keep], vertex_ids[keep],
+                distances[keep])
+
+    if gaussian:
+        sigma = float(gaussian)
+        values = np.exp(-distances ** 2 / (2 * sigma ** 2))
+    else:
+        values = np.ones(len(distances))
+    return scipy.sparse.csr_matrix((values, (vertex_ids, roi_ids)),
+            shape=(num_vertices, len(vertices)))
+
+def geodesic_roi_labels(surf, vertices, radius, labels,
+        overlap_logic='EXCLUDE'):
+    '''
+    builds geodesic_rois around vertices and collapses them to one label
+    vector, each vertex taking the (largest) label of the ROIs it is in, or
+    0 if it is in none
+    '''
+    rois = geodesic_rois(surf, vertices, radius, overlap_logic)
+    if not rois.shape[1]:
+        return np.zeros(rois.shape[0])
+    labels = np.asarray(labels, dtype=np.float64).reshape(1, -1)
+    return rois.multiply(labels).tocsr().max(axis=1).toarray().ravel()
+
+class LabelMeans(object):
+    '''
+    Usage:
+        label_means = LabelMeans(labels, rois=None, mask=None, rows=None,
+                weights=None)
+        meants = label_means.reduce(data)
+
+    The mean of the rows of data (e.g. greyordinates x timepoints) within
+    each roi of a label vector, for all rois in one sparse product.
+
+    rois are the label values to average (in this order, default all the
+    non-zero labels). Only the rows where mask (a boolean array, one per
+    label) is True, or only the rows (integer indices) given are used. If
+    weights (one per row) are given, each roi is the weighted average of its
+    rows instead.
+
+    An roi without any rows gives nan (as np.mean of nothing).
+    '''
+    def __init__(self, labels, rois=None, mask=None, rows=None, weights=None):
+        labels = np.asarray(labels).ravel()
+        if rois is None:
+            rois = np.unique(labels[labels != 0])
+        self.rois = np.asarray(rois).ravel()
+
+        include = np.ones(len(labels), dtype=bool)
+        if mask is not None:
+            mask = np.asarray(mask)
+            if mask.dtype != bool or mask.ndim != 1 or len(mask) != len(labels):
+                raise ValueError("mask must be a boolean array with one value "
+                        "per label ({}), not {} {}".format(len(labels),
+                        mask.dtype, mask.shape))
+            include &= mask
+        if rows is not None:
+            rows = np.asarray(rows)
+            if rows.ndim != 1 or (rows.size and
+                    not np.issubdtype(rows.dtype, np.integer)):
+                raise ValueError("rows must be a 1D array of integer indices, "
+                        "not {} {}".format(rows.dtype, rows.shape))
+            in_rows = np.zeros(len(labels), dtype=bool)
+            in_rows[rows.astype(np.int64)] = True
+            include &= in_rows
+
+        ## which roi (if any) each row belongs to
+        roi_of_row = np.zeros(len(labels), dtype=np.int64) - 1
+        if len(self.rois):
+            sorter = np.argsort(self.rois)
+            pos = np.searchsorted(self.rois, labels, sorter=sorter)
+            pos = sorter[np.minimum(pos, len(self.rois) - 1)]
+            matched = self.rois[pos] == labels
+            roi_of_row[matched] = pos[matched]
+        rows = np.where(include & (roi_of_row >= 0))[0]
+        roi_of_row = roi_of_row[rows]
+
+        if weights is None:
+            values = np.ones(len(rows))
+        else:
+            values = np.asarray(weights, dtype=np.float64).ravel()[rows]
+        totals = np.bincount(roi_of_row, weights=values,
+                minlength=len(self.rois))
+        self.empty = totals == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = values / totals[roi_of_row]
+        self.matrix = scipy.sparse.csr_matrix((values, (roi_of_row, rows)),
+                shape=(len(self.rois), len(labels)))
+
+    def reduce(self, data):
+        '''the rois x timepoints means of data (rows x timepoints), in
+        float64'''
+        means = np.asarray(self.matrix.dot(data), dtype=np.float64)
+        means[self.empty] = np.nan
+        return means
+
+class DistanceFieldCache(object):
+    '''
+    Keeps the most recently used geodesic distance fields (the distance
+    from one source vertex to every vertex) in memory, up to max_size bytes.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.fields = collections.OrderedDict()
+
+    def get(self, key):
+        field = self.fields.pop(key, None)
+        if field is not None:
+            self.fields[key] = field
+        return field
+
+    def put(self, key, field):
+        if key in self.fields:
+            self.size -= self.fields.pop(key).nbytes
+        self.fields[key] = field
+        self.size += field.nbytes
+        while self.size > self.max_size and len(self.fields) > 1:
+            _, oldest = self.fields.popitem(last=False)
+            self.size -= oldest.nbytes
+
+    def clear(self):
+        self.fields.clear()
+        self.size = 0
+
+_DISTANCE_FIELDS = DistanceFieldCache(256 * 1024 ** 2)
+
+def geodesic_distance_fields(surf, sources, limit=None, batch_size=256):
+    '''
+    returns a sources x vertices (float32) array of the geodesic distance
+    from each source vertex to every vertex of the surface, -1 past limit.
+
+    Fields are memoised for the rest of the run (and in the array cache if
+    CIFTIFY_CACHE_DIR is set), keyed by the surface content, the limit and
+    the source vertex. The sources that are not cached are measured
+    together, batch_size sources per Dijkstra call.
+    '''
+    surface = load_surface_mesh(surf)
+    surface_hash = surface.content_hash()
+    limit = None if limit is None else float(limit)
+    sources = np.asarray(sources, dtype=np.int64).ravel()
+    array_cache = get_array_cache()
+
+    fields = np.empty((len(sources), surface.num_vertices), dtype=np.float32)
+    missing = []
+    for i, source in enumerate(sources):
+        key = (surface_hash, limit, int(source))
+        field = _DISTANCE_FIELDS.get(key)
+        if field is None and array_cache is not None:
+            field = array_cache.get(array_cache.parts_key('geodesic', *key))
+            if field is not None:
+                _DISTANCE_FIELDS.put(key, np.array(field))
+        if field is None:
+            missing.append(i)
+        else:
+            fields[i] = field
+
+    to_measure = np.unique(sources[missing])
+    for start in range(0, len(to_measure), batch_size):
+        batch = to_measure[start:start + batch_size]
+        measured = surface.geodesic_distances(batch, limit=limit).T
+        for source, field in zip(batch, measured.astype(np.float32)):
+            key = (surface_hash, limit, int(source))
+            _DISTANCE_FIELDS.put(key, field)
+            if array_cache is not None:
+                array_cache.put(array_cache.parts_key('geodesic', *key), field,
+                        evict=False)
+            fields[sources == source] = field
+    if array_cache is not None and len(to_measure):
+        array_cache.evict()
+    return fields
+
+def geodesic_distance_matrix(surf, sources, targets=None, limit=None,
+        sparse=False):
+    '''
+    Usage:
+        distances = geodesic_distance_matrix(surf, vertices)
+        distances = geodesic_distance_matrix(surf, sources, targets, limit=30)
+
+    Returns the sources x targets matrix of geodesic distances (see
+    geodesic_distance_fields), among the sources themselves if no targets
+    are given. Distances past limit are -1, or, if sparse is set, are left
+    out of a scipy.sparse CSR matrix (where a 0 distance is stored
+    explicitly).
+    '''
+    sources = np.asarray(sources, dtype=np.int64).ravel()
+    targets = sources if targets is None else \
+            np.asarray(targets, dtype=np.int64).ravel()
+    unique_sources, inverse = np.unique(sources, return_inverse=True)
+    fields = geodesic_distance_fields(surf, unique_sources, limit)
+    distances = fields[inverse][:, targets]
+    if not sparse:
+        return distances
+    rows, columns = np.nonzero(distances >= 0)
+    return scipy.sparse.csr_matrix((distances[rows, columns], (rows, columns)),
+            shape=distances.shape)
+
+def geodesic_distance_pairs(surfaces, hemis, sources, targets, limit=None):
     '''
-    uses wb_command -surface-geodesic-distance command to measure
-    distance between two vertices on the surface
+    Usage:
+        distances = geodesic_distance_pairs({'L': surfL, 'R': surfR},
+                df.hemi, df.tvertex, df.ivertex)
+
+    Returns the geodesic distance from sources[i] to targets[i] on the
+    surface of hemis[i], for every i (-1 past limit). The distinct source
+    vertices of each hemisphere are measured in one batched pass.
     '''
+    hemis = np.asarray(hemis)
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    distances = np.zeros(len(sources)) - 1
+    for hemi in np.unique(hemis):
+        rows = np.where(hemis == hemi)[0]
+        unique_sources, inverse = np.unique(sources[rows], return_inverse=True)
+        fields = geodesic_distance_fields(surfaces[hemi], unique_sources, limit)
+        distances[rows] = fields[inverse, targets[rows]]
+    return distances
 
-    with TempDir() as tmpdir:
-        surf_distance = os.path.join(tmpdir, "distancecalc.shape.gii")
-        run(['wb_command', '-surface-geodesic-distance',
-                surf, str(orig_vertex), surf_distance,
-                '-limit', str(radius_search)],
-                dryrun=dryrun, suppress_echo = suppress_echo)
-        distances = load_gii_data(surf_distance)
+def get_surf_distances(surf, orig_vertex, radius_search=100,
+                        dryrun = None, suppress_echo = None):
+    '''
+    measures the geodesic distance from orig_vertex (one vertex or a list
+    of them) to every vertex of the surface, in the same way as
+    wb_command -surface-geodesic-distance but in process (see
+    SurfaceMesh.geodesic_distances).
+
+    Returns a vertices x sources array of distances, -1 for vertices
+    further than radius_search mm away. dryrun and suppress_echo are
+    deprecated, nothing is run in the shell so they are ignored (with a
+    warning if either is given).
+    '''
+    logger = logging.getLogger(__name__)
+    if dryrun is not None or suppress_echo is not None:
+        logger.warning("get_surf_distances no longer runs wb_command, the "
+                "dryrun and suppress_echo arguments are deprecated and ignored")
+    surface = load_surface_mesh(surf)
+    distances = surface.geodesic_distances(orig_vertex, limit=radius_search)
     return(distances)
+
+## the formats PINT tables (summaries) and meants can be written in, and
+## their file extensions
+PINT_OUTPUT_FORMATS = collections.OrderedDict([('csv', '.csv'),
+        ('npy', '.npy'), ('parquet', '.parquet'), ('hdf5', '.h5')])
+## the packages pandas needs for the optional formats
+PINT_FORMAT_PACKAGES = {'parquet': ['pyarrow', 'fastparquet'],
+        'hdf5': ['tables']}
+
+def pint_output_format(filename):
+    '''the PINT output format of filename, from its extension (csv if the
+    extension is not one of PINT_OUTPUT_FORMATS)'''
+    for output_format, ext in PINT_OUTPUT_FORMATS.items():
+        if filename.endswith(ext):
+            return output_format
+    return 'csv'
+
+def check_pint_output_format(output_format):
+    '''
+    exits if output_format is not a PINT output format, or if the package
+    pandas needs to read and write it is not installed
+    '''
+    logger = logging.getLogger(__name__)
+    if output_format not in PINT_OUTPUT_FORMATS:
+        logger.error("Output format {} is not one of {}".format(output_format,
+                ', '.join(PINT_OUTPUT_FORMATS.keys())))
+        sys.exit(1)
+    packages = PINT_FORMAT_PACKAGES.get(output_format, [])
+    for package in packages:
+        try:
+            __import__(package)
+            return
+        except ImportError:
+            pass
+    if packages:
+        logger.error("Reading and writing {} files needs the {} package "
+                "installed".format(output_format, ' or '.join(packages)))
+        sys.exit(1)
+
+def find_pint_output(filename):
+    '''
+    returns filename if it exists, or else the first file with the same name
+    but the extension of another PINT output format (so a summary given as
+    *_summary.csv is found when it was written as *_summary.npy)
+    '''
+    if os.path.exists(filename):
+        return filename
+    stem = filename
+    ext = PINT_OUTPUT_FORMATS[pint_output_format(filename)]
+    if filename.endswith(ext):
+        stem = filename[:-len(ext)]
+    for ext in PINT_OUTPUT_FORMATS.values():
+        if os.path.exists(stem + ext):
+            return stem + ext
+    return filename
+
+def save_pint_table(data_frame, filename, columns=None):
+    '''
+    writes a PINT table (e.g. a summary) in the format of its extension
+    (see PINT_OUTPUT_FORMATS), optionally only the given columns
+    '''
+    output_format = pint_output_format(filename)
+    check_pint_output_format(output_format)
+    if columns is not None:
+        data_frame = data_frame.loc[:, columns]
+    if output_format == 'npy':
+        ## text columns are stored as fixed width unicode, so the file can be
+        ## read without unpickling
+        arrays = [data_frame[col].values.astype(np.str_)
+                if data_frame[col].dtype == object else data_frame[col].values
+                for col in data_frame.columns]
+        records = np.rec.fromarrays(arrays,
+                names=[str(col) for col in data_frame.columns])
+        np.save(filename, records, allow_pickle=False)
+    elif output_format == 'parquet':
+        data_frame.to_parquet(filename, index=False)
+    elif output_format == 'hdf5':
+        data_frame.to_hdf(filename, key='table', mode='w')
+    else:
+        data_frame.to_csv(filename, index=False)
+
+def load_pint_table(filename):
+    '''
+    reads a PINT table written by save_pint_table (in any format, see
+    find_pint_output) as a pandas DataFrame
+    '''
+    filename = find_pint_output(filename)
+    output_format = pint_output_format(filename)
+    check_pint_output_format(output_format)
+    if output_format == 'npy':
+        return pd.DataFrame(np.load(filename, allow_pickle=False))
+    if output_format == 'parquet':
+        return pd.read_parquet(filename)
+    if output_format == 'hdf5':
+        return pd.read_hdf(filename, key='table')
+    return pd.read_csv(filename)
+
+def save_pint_meants(meants, filename):
+    '''
+    writes a rois x timepoints meants array in the format of its extension
+    (see PINT_OUTPUT_FORMATS), csv files have no header
+    '''
+    output_format = pint_output_format(filename)
+    check_pint_output_format(output_format)
+    if output_format == 'npy':
+        np.save(filename, meants, allow_pickle=False)
+        return
+    if output_format in ('parquet', 'hdf5'):
+        data_frame = pd.DataFrame(meants,
+                columns=[str(i) for i in range(meants.shape[1])])
+        if output_format == 'parquet':
+            data_frame.to_parquet(filename, index=False)
+        else:
+            data_frame.to_hdf(filename, key='meants', mode='w')
+        return
+    np.savetxt(filename, meants, delimiter=",")
+
+def load_pint_meants(filename):
+    '''
+    reads a meants array written by save_pint_meants (in any format, see
+    find_pint_output) as a rois x timepoints numpy array
+    '''
+    filename = find_pint_output(filename)
+    output_format = pint_output_format(filename)
+    check_pint_output_format(output_format)
+    if output_format == 'npy':
+        return np.load(filename, allow_pickle=False)
+    if output_format == 'parquet':
+        return pd.read_parquet(filename).values
+    if output_format == 'hdf5':
+        return pd.read_hdf(filename, key='meants').values
+    return pd.read_csv(filename, header=None).values
@@ -17,6 +17,17 @@ import yaml
 
 import ciftify
 
+## the number of commands started by run, get_stdout and check_output
+SUBPROCESS_COUNT = 0
+
+def subprocess_count():
+    '''the number of commands this process has run (dry runs excluded)'''
+    return SUBPROCESS_COUNT
+
+def count_subprocess():
+    global SUBPROCESS_COUNT
+    SUBPROCESS_COUNT += 1
+
 def get_subj(path, user_filter=None):
     """
     Gets all folder names (i.e., subjects) in a directory (of subjects).
@@ -251,6 +262,7 @@ def run(cmd, dryrun=False,
         logger.info('Doing a dryrun')
         return 0
 
+    count_subprocess()
     p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
     out, err = p.communicate()
@@ -301,6 +313,7 @@ def get_stdout(cmd_list, echo=True):
    Input: A command list'''
    logger = logging.getLogger(__name__)
    if echo: logger.info('Evaluating: {}'.format(' '.join(cmd_list)))
+   count_subprocess()
    stdout = subprocess.check_output(cmd_list)
    return stdout.decode('utf-8')
 
@@ -309,5 +322,6 @@ def check_output(command, stderr=None, shell = True):
     subprocess.check_output
 
     Input: A command string"""
+    count_subprocess()
     output = subprocess.check_output(command, shell=shell, stderr=stderr)
     return output.decode('utf-8')
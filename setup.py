@@ -38,6 +38,7 @@ setup(
             'ciftify_groupmask=ciftify.bin.ciftify_groupmask:main',
             'ciftify_meants=ciftify.bin.ciftify_meants:main',
             'ciftify_peaktable=ciftify.bin.ciftify_peaktable:main',
+            'ciftify_PINT_batch=ciftify.bin.ciftify_PINT_batch:main',
             'ciftify_PINT_vertices=ciftify.bin.ciftify_PINT_vertices:main',
             'ciftify_postPINT1_concat=ciftify.bin.ciftify_postPINT1_concat:main',
             'ciftify_postPINT2_sub2sub=ciftify.bin.ciftify_postPINT2_sub2sub:main',
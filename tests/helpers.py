@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+Test data shared by the PINT, meants and seed_corr tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+
+def make_grid_surface(path, size=10):
+    '''
+    writes a flat size x size grid of vertices (1mm apart) cut into
+    triangles
+    '''
+    x, y = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    coords = np.column_stack((x.ravel(), y.ravel(),
+            np.zeros(size * size))).astype(np.float32)
+    triangles = []
+    for i in range(size - 1):
+        for j in range(size - 1):
+            corner = i * size + j
+            triangles.append([corner, corner + size, corner + size + 1])
+            triangles.append([corner, corner + size + 1, corner + 1])
+    nib.save(nib.gifti.GiftiImage(darrays=[
+            nib.gifti.GiftiDataArray(coords, intent='NIFTI_INTENT_POINTSET'),
+            nib.gifti.GiftiDataArray(np.array(triangles, dtype=np.int32),
+                    intent='NIFTI_INTENT_TRIANGLE')]), path)
+
+def make_func(path, num_vertices=100, num_timepoints=20, seed=0):
+    '''writes a random dtseries on two full surfaces of num_vertices'''
+    data = np.random.RandomState(seed).randn(num_timepoints,
+            2 * num_vertices).astype(np.float32) + 100
+    save_surface_cifti(path, data.T)
+
+def save_surface_cifti(path, data, map_names=None):
+    '''
+    writes greyordinates x maps data on two full surfaces (half of the rows
+    each), as a dscalar if map_names are given or else as a dtseries
+    '''
+    num_vertices = data.shape[0] // 2
+    brain_models = (nib.cifti2.BrainModelAxis.from_mask(
+            np.ones(num_vertices, dtype=bool), name='CORTEX_LEFT') +
+            nib.cifti2.BrainModelAxis.from_mask(
+            np.ones(num_vertices, dtype=bool), name='CORTEX_RIGHT'))
+    if map_names is None:
+        maps = nib.cifti2.SeriesAxis(start=0, step=2, size=data.shape[1])
+    else:
+        maps = nib.cifti2.ScalarAxis(map_names)
+    nib.Cifti2Image(data.T, header=(maps, brain_models)).to_filename(path)
+
+def save_nifti(path, data):
+    '''writes data (a 3D or 4D array) as a nifti with 1mm voxels'''
+    nib.Nifti1Image(data, np.eye(4)).to_filename(path)
+
+class GridSurfaceTestCase(unittest.TestCase):
+    '''
+    A test case with a tmpdir holding a grid surface (self.surf) and, if
+    with_func is set, a func on two of those surfaces (self.func)
+    '''
+    with_func = False
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.surf = os.path.join(self.tmpdir, 'mid.surf.gii')
+        make_grid_surface(self.surf)
+        if self.with_func:
+            self.func = os.path.join(self.tmpdir, 'func.dtseries.nii')
+            make_func(self.func)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
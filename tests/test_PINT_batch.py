@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import importlib
+import logging
+import os
+import signal
+
+import pandas as pd
+from mock import patch
+
+from tests.helpers import GridSurfaceTestCase
+
+logging.disable(logging.CRITICAL)
+
+batch = importlib.import_module('ciftify.bin.ciftify_PINT_batch')
+
+class TestRunBatch(GridSurfaceTestCase):
+    with_func = True
+
+    def setUp(self):
+        super(TestRunBatch, self).setUp()
+        self.settings = {
+                'template_df': pd.DataFrame({'hemi': ['L', 'L', 'R', 'R'],
+                    'NETWORK': [1, 2, 1, 2], 'tvertex': [11, 66, 33, 88]}),
+                'arguments': {'<input-vertices.csv>': 'template.csv',
+                    '--pcorr': False, '--outputall': False,
+                    '--output-format': 'csv',
+                    '--sampling-radius': '2', '--search-radius': '3',
+                    '--padding-radius': '4', '--roi-limits': None,
+                    '--precision': None, '--resume': False,
+                    '--update-mode': 'sequential', '--n-threads': None}}
+
+    def subject(self, name, func=None):
+        return {'func': func or self.func, 'surfL': self.surf,
+                'surfR': self.surf,
+                'outputprefix': os.path.join(self.tmpdir, name, name)}
+
+    def test_a_failed_subject_does_not_stop_the_others(self):
+        manifest = pd.DataFrame([self.subject('sub-01'),
+                self.subject('sub-02', func='missing.dtseries.nii'),
+                self.subject('sub-03')])
+
+        report = batch.run_batch(manifest, self.settings, 1)
+
+        assert report.status.tolist() == ['done', 'failed', 'done']
+        assert report.error[1]
+        for name in ['sub-01', 'sub-03']:
+            summary = pd.read_csv(os.path.join(self.tmpdir, name,
+                    '{}_summary.csv'.format(name)))
+            assert summary.tvertex.tolist() == [11, 66, 33, 88]
+        assert os.path.exists(os.path.join(self.tmpdir, 'sub-02',
+                'sub-02_pint.log'))
+
+    def test_a_killed_worker_is_reported_as_failed(self):
+        manifest = pd.DataFrame([self.subject('sub-01'),
+                self.subject('sub-02'), self.subject('sub-03')])
+        run_subject = batch.run_subject
+        def run_or_die(job):
+            if job[0]['outputprefix'].endswith('sub-02'):
+                os.kill(os.getpid(), signal.SIGKILL)
+            return run_subject(job)
+
+        with patch.object(batch, 'run_subject', run_or_die):
+            report = batch.run_batch(manifest, self.settings, 2)
+
+        assert report.status.tolist() == ['done', 'failed', 'done']
+        assert 'signal 9' in report.error[1]
+        for name in ['sub-01', 'sub-03']:
+            assert os.path.exists(os.path.join(self.tmpdir, name,
+                    '{}_summary.csv'.format(name)))
+
+    def test_the_template_is_not_changed_between_subjects(self):
+        manifest = pd.DataFrame([self.subject('sub-01')])
+
+        batch.run_batch(manifest, self.settings, 1)
+
+        assert self.settings['template_df'].columns.tolist() == \
+                ['hemi', 'NETWORK', 'tvertex']
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+import unittest
+import importlib
+import logging
+import os
+import json
+
+import numpy as np
+import pandas as pd
+from mock import patch
+
+import ciftify
+
+from tests.helpers import GridSurfaceTestCase
+
+logging.disable(logging.CRITICAL)
+
+PINT = importlib.import_module('ciftify.bin.ciftify_PINT_vertices')
+
+def make_pint_inputs(num_vertices=40, num_timepoints=30, seed=2):
+    '''
+    random func data for a left hemisphere of num_vertices with one network
+    of three rois, whose search and padding rois split the vertices
+    '''
+    rng = np.random.RandomState(seed)
+    func_data = rng.randn(num_vertices, num_timepoints).astype(np.float32)
+    df = pd.DataFrame({'hemi': ['L', 'L', 'L'], 'NETWORK': [1, 1, 1],
+            'roiidx': [1, 2, 3], 'tvertex': [3, 17, 30]})
+    sampling_meants = rng.randn(3, num_timepoints)
+    search_rois = np.repeat([1, 2, 3, 0], num_vertices // 4)
+    padding_rois = search_rois.copy()
+    return df, func_data, sampling_meants, search_rois, padding_rois
+
+class TestCorrelationKernel(unittest.TestCase):
+
+    def test_matches_corrcoef_for_each_row(self):
+        _, func_data, sampling_meants, _, _ = make_pint_inputs()
+        kernel = PINT.CorrelationKernel(func_data)
+        rows = np.array([0, 5, 7, 39])
+
+        corrs = kernel.correlate(sampling_meants[0], rows)
+
+        expected = [np.corrcoef(sampling_meants[0], func_data[row])[0][1]
+                for row in rows]
+        assert np.allclose(corrs, expected)
+
+    def test_rows_are_only_scaled_once(self):
+        _, func_data, sampling_meants, _, _ = make_pint_inputs()
+        kernel = PINT.CorrelationKernel(func_data)
+        kernel.correlate(sampling_meants[0], np.arange(10))
+        func_data[:10] = 0
+
+        corrs = kernel.correlate(sampling_meants[0], np.arange(10))
+
+        assert np.all(corrs != 0)
+
+    def test_rows_without_variance_score_nan(self):
+        _, func_data, sampling_meants, _, _ = make_pint_inputs()
+        func_data[4] = 7
+        kernel = PINT.CorrelationKernel(func_data)
+
+        corrs = kernel.correlate(sampling_meants[0], np.array([3, 4]))
+
+        assert not np.isnan(corrs[0])
+        assert np.isnan(corrs[1])
+
+    def test_only_rows_asked_for_are_kept_in_the_func_dtype(self):
+        _, func_data, sampling_meants, _, _ = make_pint_inputs()
+        func_data = func_data.astype(np.float32)
+        kernel = PINT.CorrelationKernel(func_data)
+        kernel.correlate(sampling_meants[0], np.array([9, 2, 9]))
+
+        zscores = kernel.zscores(np.array([2, 5, 9]))
+
+        assert kernel.num_cached == 3
+        assert zscores.dtype == np.float32
+        expected = [np.corrcoef(sampling_meants[0], func_data[row])[0][1]
+                for row in [2, 5, 9]]
+        assert np.allclose(kernel.correlate(sampling_meants[0],
+                np.array([2, 5, 9])), expected, atol=1e-5)
+
+class TestPintMoveVertex(unittest.TestCase):
+
+    def test_picks_the_same_vertex_as_corrcoef(self):
+        df, func_data, sampling_meants, search_rois, padding_rois = \
+                make_pint_inputs()
+        kernel = PINT.CorrelationKernel(func_data)
+
+        for idx in df.index:
+            df = PINT.pint_move_vertex(df, idx, 'tvertex', 'vertex_0',
+                    func_data, sampling_meants, search_rois, padding_rois,
+                    False, 40, corr_kernel=kernel)
+
+        for idx in df.index:
+            others = [i for i in df.index if i != idx]
+            meants = sampling_meants[others].mean(axis=0)
+            candidates = np.where(search_rois == df.loc[idx, 'roiidx'])[0]
+            corrs = [np.corrcoef(meants, func_data[v])[0][1]
+                    for v in candidates]
+            assert df.loc[idx, 'vertex_0'] == candidates[np.argmax(corrs)]
+
+    def test_vertex_stays_put_without_a_search_space(self):
+        df, func_data, sampling_meants, search_rois, padding_rois = \
+                make_pint_inputs()
+        padding_rois[:] = 0
+
+        df = PINT.pint_move_vertex(df, 1, 'tvertex', 'vertex_0', func_data,
+                sampling_meants, search_rois, padding_rois, False, 40)
+
+        assert df.loc[1, 'vertex_0'] == 17
+
+class TestPartialCorrelationKernel(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(4)
+        self.func_data = rng.randn(12, 40)
+        self.netmeants = pd.DataFrame(rng.randn(40, 3), columns=[2, 3, 4])
+        self.meants = rng.randn(40)
+
+    def test_matches_partial_corr_for_each_row(self):
+        kernel = PINT.PartialCorrelationKernel(self.netmeants)
+
+        pcorrs = kernel.correlate(self.meants, 3, self.func_data)
+
+        expected = [PINT.partial_corr(self.meants, row,
+                self.netmeants.loc[:, [2, 4]].values) for row in self.func_data]
+        assert np.allclose(pcorrs, expected)
+
+    def test_collinear_covariates_give_the_same_result(self):
+        self.netmeants[5] = self.netmeants[2] * 2
+        kernel = PINT.PartialCorrelationKernel(self.netmeants)
+
+        pcorrs = kernel.correlate(self.meants, 3, self.func_data)
+
+        expected = [PINT.partial_corr(self.meants, row,
+                self.netmeants.loc[:, [2, 4]].values) for row in self.func_data]
+        assert kernel.basis(3).shape == (40, 2)
+        assert np.allclose(pcorrs, expected)
+
+class TestPintRois(GridSurfaceTestCase):
+    def setUp(self):
+        super(TestPintRois, self).setUp()
+        PINT.RADIUS_SAMPLING = 2
+        PINT.RADIUS_SEARCH = 3
+        PINT.RADIUS_PADDING = 4
+        rng = np.random.RandomState(3)
+        self.func_data = rng.randn(200, 20).astype(np.float32)
+        self.func_zeros = np.array([11, 150])
+        self.df = pd.DataFrame({'hemi': ['L', 'L', 'R', 'R'],
+                'NETWORK': [1, 2, 1, 2], 'roiidx': [1, 2, 3, 4],
+                'vertex_0': [11, 14, 33, 36]})
+
+    def check_matches_rebuilt_rois(self, pint_rois, vertex_col):
+        for radius, rois, zeros in [
+                (PINT.RADIUS_SAMPLING, pint_rois.sampling, True),
+                (PINT.RADIUS_SEARCH, pint_rois.search, True),
+                (PINT.RADIUS_PADDING, pint_rois.padding, False)]:
+            expected = PINT.rois_bilateral(self.df, vertex_col, radius,
+                    self.surf, self.surf)
+            if zeros:
+                expected[self.func_zeros] = 0
+            assert np.array_equal(rois.data, expected)
+        sampling_rois = PINT.rois_bilateral(self.df, vertex_col,
+                PINT.RADIUS_SAMPLING, self.surf, self.surf)
+        sampling_rois[self.func_zeros] = 0
+        sampling_meants = PINT.calc_sampling_meants(self.func_data,
+                sampling_rois)
+        assert np.allclose(pint_rois.sampling_meants, sampling_meants)
+        netmeants = PINT.calc_network_meants(sampling_meants, self.df)
+        assert np.allclose(pint_rois.network_meants().values,
+                netmeants.values)
+
+    def test_matches_rebuilt_rois_when_made(self):
+        pint_rois = PINT.PintRois(self.df, 'vertex_0', self.func_data,
+                self.func_zeros, self.surf, self.surf, 100)
+
+        self.check_matches_rebuilt_rois(pint_rois, 'vertex_0')
+
+    def test_matches_rebuilt_rois_after_moves(self):
+        pint_rois = PINT.PintRois(self.df, 'vertex_0', self.func_data,
+                self.func_zeros, self.surf, self.surf, 100)
+        pint_rois.network_meants()
+        self.df['vertex_1'] = [12, 14, 43, 37]
+        self.df['vertex_2'] = [12, 24, 43, 37]
+
+        assert pint_rois.move(self.df, 'vertex_1') == 3
+        self.check_matches_rebuilt_rois(pint_rois, 'vertex_1')
+        assert pint_rois.move(self.df, 'vertex_2') == 1
+        self.check_matches_rebuilt_rois(pint_rois, 'vertex_2')
+        assert pint_rois.move(self.df, 'vertex_2') == 0
+
+class TestMaxRss(unittest.TestCase):
+
+    @patch('resource.getrusage')
+    def test_linux_reports_kilobytes(self, mock_getrusage):
+        mock_getrusage.return_value.ru_maxrss = 2048
+
+        with patch('sys.platform', 'linux'):
+            assert PINT.max_rss_mb() == 2
+
+    @patch('resource.getrusage')
+    def test_macos_reports_bytes(self, mock_getrusage):
+        mock_getrusage.return_value.ru_maxrss = 2 * 1024 * 1024
+
+        with patch('sys.platform', 'darwin'):
+            assert PINT.max_rss_mb() == 2
+
+class TestRunPINT(GridSurfaceTestCase):
+    with_func = True
+
+    def setUp(self):
+        super(TestRunPINT, self).setUp()
+        self.template = os.path.join(self.tmpdir, 'template.csv')
+        pd.DataFrame({'hemi': ['L', 'L', 'R', 'R'], 'NETWORK': [1, 2, 1, 2],
+                'tvertex': [11, 66, 33, 88]}).to_csv(self.template,
+                index=False)
+        self.write_pint_state = PINT.write_pint_state
+
+    def tearDown(self):
+        PINT.write_pint_state = self.write_pint_state
+        super(TestRunPINT, self).tearDown()
+
+    def run_pint(self, name, resume=False, update_mode='sequential',
+                 output_format='csv'):
+        output_prefix = os.path.join(self.tmpdir, name)
+        arguments = {'<func.dtseries.nii>': self.func,
+                '<left-surface.gii>': self.surf,
+                '<right-surface.gii>': self.surf,
+                '<input-vertices.csv>': self.template,
+                '<outputprefix>': output_prefix, '--pcorr': False,
+                '--outputall': True, '--output-format': output_format,
+                '--sampling-radius': '2',
+                '--search-radius': '3', '--padding-radius': '4',
+                '--roi-limits': None, '--precision': None,
+                '--resume': resume, '--update-mode': update_mode,
+                '--n-threads': '3'}
+        PINT.run_PINT(arguments, self.tmpdir)
+        return ciftify.io.load_pint_table('{}_summary.csv'.format(output_prefix))
+
+    def interrupt_after(self, num_iterations):
+        written = []
+        def write_pint_state(checkpoint, state, df):
+            if len(written) == num_iterations:
+                raise KeyboardInterrupt
+            self.write_pint_state(checkpoint, state, df)
+            written.append(state['iter_num'])
+        PINT.write_pint_state = write_pint_state
+
+    def test_resumed_run_matches_an_uninterrupted_run(self):
+        expected = self.run_pint('uninterrupted')
+        assert len(expected.columns) > 10
+
+        self.interrupt_after(3)
+        self.assertRaises(KeyboardInterrupt, self.run_pint, 'resumed')
+        PINT.write_pint_state = self.write_pint_state
+        checkpoint = os.path.join(self.tmpdir, 'resumed_pint_state')
+        assert os.path.exists(checkpoint)
+        resumed = self.run_pint('resumed', resume=True)
+
+        pd.testing.assert_frame_equal(resumed, expected)
+        assert not os.path.exists(checkpoint)
+
+    def test_checkpoint_is_removed_after_a_finished_run(self):
+        self.run_pint('finished')
+
+        assert not os.path.exists(os.path.join(self.tmpdir,
+                'finished_pint_state'))
+
+    def test_resume_without_a_checkpoint_starts_from_the_beginning(self):
+        expected = self.run_pint('uninterrupted')
+
+        resumed = self.run_pint('resumed', resume=True)
+
+        pd.testing.assert_frame_equal(resumed, expected)
+
+    def test_jacobi_mode_matches_sequential_mode(self):
+        expected = self.run_pint('sequential')
+
+        jacobi = self.run_pint('jacobi', update_mode='jacobi')
+
+        pd.testing.assert_frame_equal(jacobi, expected)
+
+    def test_timings_are_written_for_every_iteration(self):
+        self.run_pint('timed')
+
+        timings = pd.read_csv(os.path.join(self.tmpdir,
+                'timed_pint_timings.csv'))
+        summary = pd.read_csv(os.path.join(self.tmpdir, 'timed_summary.csv'))
+        assert len(timings) == len([col for col in summary.columns
+                if col.startswith('dist_')])
+        assert (timings.correlation_seconds > 0).all()
+        assert (timings.vertices_scored > 0).all()
+        with open(os.path.join(self.tmpdir, 'timed_pint_timings.json')) as f:
+            run = json.load(f)['run']
+        assert run['iterations'] == len(timings)
+        assert run['load_func_seconds'] > 0
+
+    def test_npy_outputs_match_csv_outputs(self):
+        expected = self.run_pint('csv')
+
+        summary = self.run_pint('npy', output_format='npy')
+
+        assert os.path.exists(os.path.join(self.tmpdir, 'npy_summary.npy'))
+        pd.testing.assert_frame_equal(summary, expected)
+        for vertex in ['tvertex', 'ivertex']:
+            meants = ciftify.io.load_pint_meants(os.path.join(self.tmpdir,
+                    'npy_{}_meants.npy'.format(vertex)))
+            expected_meants = np.loadtxt(os.path.join(self.tmpdir,
+                    'csv_{}_meants.csv'.format(vertex)), delimiter=',')
+            assert np.allclose(meants, expected_meants)
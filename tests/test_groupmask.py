@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+import unittest
+import importlib
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+import ciftify
+
+logging.disable(logging.CRITICAL)
+
+groupmask = importlib.import_module('ciftify.bin.ciftify_groupmask')
+
+def make_dscalar(path, data):
+    '''writes a greyordinates x maps dscalar on a left surface'''
+    brain_models = nib.cifti2.BrainModelAxis.from_mask(
+            np.ones(data.shape[0], dtype=bool), name='CORTEX_LEFT')
+    scalars = nib.cifti2.ScalarAxis(['map{}'.format(i + 1)
+            for i in range(data.shape[1])])
+    nib.Cifti2Image(data.T, header=(scalars, brain_models)).to_filename(path)
+
+class TestGetCiftiPercentile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'func.dscalar.nii')
+        rng = np.random.RandomState(6)
+        self.data = (rng.rand(37, 2) * 100).astype(np.float32)
+        self.data[:10, 1] = np.arange(10, 0, -1)
+        self.data[10:, 1] = 20
+        make_dscalar(self.path, self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_interpolates_between_the_sorted_values(self):
+        ## the 5th percentile of 37 values is at index 0.05 * 36 = 1.8 of
+        ## the sorted column (1, 2, 3, ...), 2 + 0.8 * (3 - 2)
+        pctl = groupmask.get_cifti_percentile(self.path, '5', '2')
+
+        assert np.isclose(pctl, 2.8)
+
+    @unittest.skipUnless(ciftify.config.find_workbench(),
+            'wb_command is not installed')
+    def test_matches_wb_command(self):
+        for column in ['1', '2']:
+            expected = float(ciftify.utils.get_stdout(['wb_command',
+                    '-cifti-stats', self.path, '-percentile', '5',
+                    '-column', column]))
+
+            pctl = groupmask.get_cifti_percentile(self.path, '5', column)
+
+            assert np.isclose(pctl, expected, rtol=1e-5)
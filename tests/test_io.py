@@ -0,0 +1,744 @@
+#!/usr/bin/env python
+import os
+import unittest
+import logging
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import pytest
+from mock import patch
+
+import ciftify.io
+
+logging.disable(logging.CRITICAL)
+
+def make_dense_cifti(path, num_maps=4):
+    '''
+    writes a small dtseries with a partial left surface, a full right surface
+    and three voxels, returns the data matrix (greyordinates x maps)
+    '''
+    left = nib.cifti2.BrainModelAxis.from_mask(
+            np.array([1, 0, 1, 1, 0], dtype=bool), name='CORTEX_LEFT')
+    right = nib.cifti2.BrainModelAxis.from_mask(
+            np.ones(4, dtype=bool), name='CORTEX_RIGHT')
+    volume_mask = np.zeros((2, 3, 2), dtype=bool)
+    volume_mask[0, 1, 1] = True
+    volume_mask[1, 0, 0] = True
+    volume_mask[1, 2, 1] = True
+    volume = nib.cifti2.BrainModelAxis.from_mask(volume_mask, name='THALAMUS_LEFT',
+            affine=np.eye(4))
+    brain_models = left + right + volume
+    series = nib.cifti2.SeriesAxis(start=0, step=2, size=num_maps)
+    data = np.arange(len(brain_models) * num_maps, dtype=np.float32).reshape(
+            len(brain_models), num_maps) + 1
+    nib.Cifti2Image(data.T, header=(series, brain_models)).to_filename(path)
+    return data
+
+class CiftiFixture(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'func.dtseries.nii')
+        self.data = make_dense_cifti(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class TestLoadCifti(CiftiFixture):
+
+    def test_surfaces_are_padded_to_full_vertex_count(self):
+        Ldata, Rdata = ciftify.io.load_surfaces(self.path)
+
+        assert Ldata.shape == (5, 4)
+        assert Rdata.shape == (4, 4)
+        assert np.array_equal(Ldata[[0, 2, 3]], self.data[0:3])
+        assert not Ldata[[1, 4]].any()
+        assert np.array_equal(Rdata, self.data[3:7])
+
+    def test_volume_is_flattened_like_load_nifti(self):
+        cifti_data = ciftify.io.load_cifti(self.path)
+
+        assert cifti_data.shape == (5 + 4 + 12, 4)
+        volume = cifti_data[9:].reshape(2, 3, 2, 4)
+        # voxels are stored in the cifti in index order
+        assert np.array_equal(volume[0, 1, 1], self.data[7])
+        assert np.array_equal(volume[1, 0, 0], self.data[8])
+        assert np.array_equal(volume[1, 2, 1], self.data[9])
+        assert np.count_nonzero(volume.any(axis=3)) == 3
+
+    def test_returns_brain_models_when_asked(self):
+        cifti_data, brain_models = ciftify.io.load_cifti(self.path,
+                return_brain_models=True)
+
+        assert isinstance(brain_models, nib.cifti2.BrainModelAxis)
+        assert len(brain_models) == self.data.shape[0]
+
+    def test_hemisphere_data_matches_load_surfaces(self):
+        Ldata, Rdata = ciftify.io.load_surfaces(self.path)
+
+        right = ciftify.io.load_hemisphere_data(self.path, 'CORTEX_RIGHT')
+
+        assert np.array_equal(right, Rdata)
+
+    def test_exits_when_structure_is_missing(self):
+        with self.assertRaises(SystemExit):
+            ciftify.io.load_hemisphere_data(self.path, 'CEREBELLUM')
+
+class TestDenseArray(CiftiFixture):
+
+    def test_uncompressed_data_is_memory_mapped(self):
+        dense_array = ciftify.io.DenseArray(self.path)
+
+        assert dense_array.is_memmap
+        assert dense_array.structures == ['CORTEX_LEFT', 'CORTEX_RIGHT',
+                'THALAMUS_LEFT']
+
+    def test_structure_view_is_sliced_by_trs(self):
+        dense_array = ciftify.io.DenseArray(self.path)
+
+        right = dense_array.structure('CORTEX_RIGHT', trs=slice(1, 3))
+        picked = dense_array.structure('THALAMUS_LEFT', trs=np.array([0, 3]))
+
+        assert np.array_equal(right, self.data[3:7, 1:3])
+        assert np.array_equal(picked, self.data[7:10][:, [0, 3]])
+
+    def test_stacked_matches_load_cifti(self):
+        dense_array = ciftify.io.DenseArray(self.path)
+
+        stacked = dense_array.stacked(trs=slice(2, 4))
+
+        assert np.array_equal(stacked, ciftify.io.load_cifti(self.path)[:, 2:4])
+        assert np.array_equal(dense_array.dense(), self.data)
+
+class TestLoadGiiData(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'func.func.gii')
+        self.data = np.arange(30, dtype=np.float32).reshape(6, 5)
+        darrays = [nib.gifti.GiftiDataArray(self.data[:, i],
+                intent='NIFTI_INTENT_NORMAL') for i in range(5)]
+        nib.save(nib.gifti.GiftiImage(darrays=darrays), self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_returns_vertices_by_timepoints(self):
+        data = ciftify.io.load_gii_data(self.path)
+
+        assert data.shape == (6, 5)
+        assert data.dtype == np.float32
+        assert np.array_equal(data, self.data)
+
+    def test_reads_a_subset_of_arrays_with_a_new_dtype(self):
+        data = ciftify.io.load_gii_data(self.path, darrays=[1, 3],
+                dtype=np.float64)
+
+        assert data.dtype == np.float64
+        assert np.array_equal(data, self.data[:, [1, 3]])
+
+    def test_exits_on_invalid_intent(self):
+        with self.assertRaises(SystemExit):
+            ciftify.io.load_gii_data(self.path, intent='NIFTI_INTENT_LABEL')
+
+class TestCiftiInfo(CiftiFixture):
+
+    def test_reads_structures_and_dimensions_from_header(self):
+        cinfo = ciftify.io.cifti_info(self.path)
+
+        assert cinfo['has_LSurf'] and cinfo['has_RSurf']
+        assert cinfo['maps_to_surf'] and cinfo['maps_to_volume']
+        assert cinfo['structures'] == ['CORTEX_LEFT', 'CORTEX_RIGHT',
+                'THALAMUS_LEFT']
+        assert cinfo['num_maps'] == 4
+        assert cinfo['volume_dims'] == (2, 3, 2)
+        assert cinfo['surface_vertices'] == {'CORTEX_LEFT': 5,
+                'CORTEX_RIGHT': 4}
+
+    @patch('ciftify.io.read_cifti_info')
+    def test_repeated_calls_on_unchanged_file_are_cached(self, mock_read):
+        mock_read.return_value = {'maps_to_volume': True}
+
+        ciftify.io.cifti_info(self.path)
+        cinfo = ciftify.io.cifti_info(self.path)
+        cinfo['maps_to_volume'] = False
+
+        assert mock_read.call_count == 1
+        assert ciftify.io.cifti_info(self.path)['maps_to_volume']
+
+class TestArrayCache(CiftiFixture):
+    def setUp(self):
+        CiftiFixture.setUp(self)
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        os.environ['CIFTIFY_CACHE_DIR'] = self.cache_dir
+
+    def tearDown(self):
+        del os.environ['CIFTIFY_CACHE_DIR']
+        CiftiFixture.tearDown(self)
+
+    def test_second_load_is_read_from_cache(self):
+        first = ciftify.io.load_hemisphere_data(self.path, 'CORTEX_LEFT')
+
+        with patch('ciftify.io.DenseArray') as mock_dense:
+            second = ciftify.io.load_hemisphere_data(self.path, 'CORTEX_LEFT')
+
+        assert mock_dense.call_count == 0
+        assert isinstance(second, np.memmap)
+        assert np.array_equal(first, second)
+
+    def test_edited_file_is_not_served_stale_data(self):
+        ciftify.io.load_cifti(self.path)
+        new_data = make_dense_cifti(self.path, num_maps=2)
+        os.utime(self.path, (1, 1))
+
+        cifti_data = ciftify.io.load_cifti(self.path)
+
+        assert cifti_data.shape[1] == 2
+        ## the full right surface follows the five vertex left surface
+        assert np.array_equal(cifti_data[5:9], new_data[3:7])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ciftify.io.ArrayCache(self.cache_dir, max_size=500)
+        cache.put('old', np.zeros(10))
+        cache.put('used', np.zeros(10))
+        os.utime(cache.path('old'), (1, 1))
+        os.utime(cache.path('used'), (2, 2))
+        cache.get('used')
+
+        cache.put('new', np.zeros(10))
+
+        assert cache.get('old') is None
+        assert cache.get('used') is not None
+        assert cache.get('new') is not None
+
+class TestIterTimeseries(CiftiFixture):
+
+    def test_cifti_blocks_concatenate_to_the_loaded_data(self):
+        blocks = list(ciftify.io.iter_timeseries(self.path, chunk_trs=3,
+                layout='stacked'))
+
+        assert [block.shape[1] for block in blocks] == [3, 1]
+        assert np.array_equal(np.hstack(blocks),
+                ciftify.io.load_cifti(self.path))
+
+    def test_nifti_blocks_are_flattened_like_load_nifti(self):
+        nifti_path = os.path.join(self.tmpdir, 'func.nii.gz')
+        volume = np.random.rand(3, 4, 2, 7).astype(np.float32)
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), nifti_path)
+
+        blocks = list(ciftify.io.iter_timeseries(nifti_path, chunk_trs=2,
+                dtype=np.float64))
+
+        assert len(blocks) == 4
+        assert blocks[0].dtype == np.float64
+        assert np.allclose(np.hstack(blocks), volume.reshape(24, 7))
+
+class TestSaveCifti(CiftiFixture):
+
+    def test_dscalar_is_written_on_the_template_greyordinates(self):
+        output = os.path.join(self.tmpdir, 'out.dscalar.nii')
+        dense_array = ciftify.io.DenseArray(self.path)
+
+        ciftify.io.save_cifti(self.data[:, 0], dense_array, output,
+                map_names=['first'])
+
+        cifti = nib.load(output)
+        assert cifti.nifti_header.get_intent()[0] == 'ConnDenseScalar'
+        assert cifti.header.get_axis(0).name[0] == 'first'
+        assert cifti.header.get_axis(1) == dense_array.brain_models
+        assert np.array_equal(ciftify.io.DenseArray(output).dense()[:, 0],
+                self.data[:, 0])
+
+    def test_dtseries_keeps_the_template_timing(self):
+        output = os.path.join(self.tmpdir, 'out.dtseries.nii')
+
+        ciftify.io.save_cifti(self.data[:, :2], self.path, output)
+
+        series = nib.load(output).header.get_axis(0)
+        assert series.step == 2
+        assert series.size == 2
+
+    def test_dlabel_gets_a_label_for_each_value(self):
+        output = os.path.join(self.tmpdir, 'out.dlabel.nii')
+        labels = np.array([0, 1, 1, 2, 0, 0, 3, 3, 0, 2])
+
+        ciftify.io.save_cifti(labels, self.path, output)
+
+        label_table = nib.load(output).header.get_axis(0).label[0]
+        assert sorted(label_table.keys()) == [0, 1, 2, 3]
+
+    def test_exits_when_rows_do_not_match_the_template(self):
+        output = os.path.join(self.tmpdir, 'out.dscalar.nii')
+        with self.assertRaises(SystemExit):
+            ciftify.io.save_cifti(np.zeros(3), self.path, output)
+
+class TestLoadNiftiVoxels(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.volume = np.random.rand(3, 4, 5, 6).astype(np.float32)
+        self.mask = np.zeros((3, 4, 5))
+        self.mask[0, 1, 0] = 1
+        self.mask[2, 3, 4] = 1
+        self.mask[1, 2, 2] = 1
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def save(self, name, volume):
+        path = os.path.join(self.tmpdir, name)
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), path)
+        return path
+
+    def test_all_voxels_are_read_without_voxels_or_a_mask(self):
+        path = self.save('func.nii', self.volume)
+
+        data = ciftify.io.load_nifti_voxels(path)
+
+        assert np.array_equal(data, ciftify.io.load_nifti(path)[0])
+
+    def test_masked_voxels_match_load_nifti(self):
+        for name in ['func.nii', 'func.nii.gz']:
+            path = self.save(name, self.volume)
+            expected = ciftify.io.load_nifti(path)[0][self.mask.ravel() > 0]
+
+            data = ciftify.io.load_nifti_voxels(path, mask=self.mask)
+
+            assert np.array_equal(data, expected)
+
+    def test_voxels_are_returned_in_the_order_given(self):
+        path = self.save('func.nii', self.volume)
+        flat = self.volume.reshape(60, 6)
+
+        data = ciftify.io.load_nifti_voxels(path, voxels=[59, 3, 20],
+                dtype=np.float64)
+
+        assert data.dtype == np.float64
+        assert np.array_equal(data, flat[[59, 3, 20]])
+
+    def test_3D_image_gives_one_column(self):
+        path = self.save('anat.nii.gz', self.volume[..., 0])
+
+        data = ciftify.io.load_nifti_voxels(path, mask=self.mask.ravel())
+
+        assert data.shape == (3, 1)
+
+    def test_exits_when_mask_does_not_match_the_image(self):
+        path = self.save('func.nii', self.volume)
+        with self.assertRaises(SystemExit):
+            ciftify.io.load_nifti_voxels(path, mask=np.ones(10))
+
+class TestPrecision(CiftiFixture):
+    def tearDown(self):
+        os.environ.pop('CIFTIFY_PRECISION', None)
+        os.environ.pop('CIFTIFY_CACHE_DIR', None)
+        CiftiFixture.tearDown(self)
+
+    def test_float_data_is_read_in_the_precision_setting(self):
+        ciftify.io.set_precision('float16')
+
+        blocks = list(ciftify.io.iter_timeseries(self.path, chunk_trs=2))
+        seed = ciftify.io.load_cifti(self.path, dtype=np.float64)
+
+        assert ciftify.io.get_precision() == np.float16
+        assert all(block.dtype == np.float16 for block in blocks)
+        assert seed.dtype == np.float64
+
+    def test_integer_data_keeps_its_dtype(self):
+        labels = np.arange(10, dtype=np.int16)
+
+        assert ciftify.io.as_precision(labels).dtype == np.int16
+        assert ciftify.io.as_precision(labels.astype(np.float64)).dtype == \
+                np.float32
+
+    def test_cached_arrays_are_kept_per_precision(self):
+        os.environ['CIFTIFY_CACHE_DIR'] = os.path.join(self.tmpdir, 'cache')
+        ciftify.io.load_cifti(self.path)
+
+        ciftify.io.set_precision('float16')
+        cifti_data = ciftify.io.load_cifti(self.path)
+
+        assert cifti_data.dtype == np.float16
+
+    def test_exits_on_unknown_precision(self):
+        with self.assertRaises(SystemExit):
+            ciftify.io.set_precision('int8')
+
+def make_surface(path):
+    '''
+    writes a flat 3 x 3 grid of vertices (1mm apart) cut into 8 triangles,
+    returns the coordinates and triangles
+    '''
+    x, y = np.meshgrid(np.arange(3), np.arange(3), indexing='ij')
+    coords = np.column_stack((x.ravel(), y.ravel(),
+            np.zeros(9))).astype(np.float32)
+    triangles = []
+    for i in range(2):
+        for j in range(2):
+            corner = i * 3 + j
+            triangles.append([corner, corner + 3, corner + 4])
+            triangles.append([corner, corner + 4, corner + 1])
+    triangles = np.array(triangles, dtype=np.int32)
+    nib.save(nib.gifti.GiftiImage(darrays=[
+            nib.gifti.GiftiDataArray(coords, intent='NIFTI_INTENT_POINTSET'),
+            nib.gifti.GiftiDataArray(triangles,
+                    intent='NIFTI_INTENT_TRIANGLE')]), path)
+    return coords, triangles
+
+class TestSurfaceMesh(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'mid.surf.gii')
+        self.coords, self.triangles = make_surface(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_adjacency_holds_edge_lengths(self):
+        surface = ciftify.io.SurfaceMesh.load(self.path, use_cache=False)
+
+        neighbours, lengths = surface.neighbours(4)
+
+        ## the centre vertex has 4 straight and 2 diagonal edges
+        assert sorted(neighbours) == [0, 1, 3, 5, 7, 8]
+        assert np.allclose(sorted(lengths), [1, 1, 1, 1, np.sqrt(2),
+                np.sqrt(2)])
+        assert (surface.adjacency != surface.adjacency.T).nnz == 0
+
+    def test_vertex_areas_are_a_third_of_each_triangle(self):
+        surface = ciftify.io.SurfaceMesh.load(self.path, use_cache=False)
+
+        assert np.isclose(surface.vertex_areas.sum(), 4)
+        assert np.isclose(surface.vertex_areas[4], 6 * 0.5 / 3)
+        assert np.isclose(surface.vertex_areas[2], 0.5 / 3)
+
+    def test_geodesic_distances_cut_across_triangles(self):
+        surface = ciftify.io.SurfaceMesh.load(self.path, use_cache=False)
+
+        distances = surface.geodesic_distances([0, 8])
+
+        assert distances.shape == (9, 2)
+        assert np.allclose(distances[:, 0], np.linalg.norm(self.coords -
+                self.coords[0], axis=1))
+        ## (0, 0) to (1, 2) crosses the hinge between two triangles, along
+        ## the edges it would be 1 + sqrt(2)
+        assert np.isclose(distances[5, 0], np.sqrt(5))
+
+    def test_vertices_past_the_limit_are_minus_one(self):
+        surface = ciftify.io.SurfaceMesh.load(self.path, use_cache=False)
+
+        distances = surface.geodesic_distances(0, limit=1.5)[:, 0]
+
+        assert distances[8] == -1
+        assert np.isclose(distances[4], np.sqrt(2))
+
+    @patch('ciftify.utils.run')
+    def test_get_surf_distances_runs_nothing_in_the_shell(self, mock_run):
+        distances = ciftify.io.get_surf_distances(self.path, 4)
+
+        assert mock_run.call_count == 0
+        assert distances.shape == (9, 1)
+        assert distances[4, 0] == 0
+
+    def test_get_surf_distances_warns_that_dryrun_is_ignored(self):
+        with patch.object(logging.Logger, 'warning') as mock_warning:
+            distances = ciftify.io.get_surf_distances(self.path, 4,
+                    dryrun=True)
+
+        assert mock_warning.call_count == 1
+        assert distances[4, 0] == 0
+
+    def test_mesh_is_read_back_from_its_cache(self):
+        first = ciftify.io.SurfaceMesh.load(self.path)
+        assert os.path.exists(ciftify.io.SurfaceMesh.cache_path(self.path))
+
+        with patch('nibabel.gifti.giftiio.read') as mock_read:
+            second = ciftify.io.SurfaceMesh.load(self.path)
+
+        assert mock_read.call_count == 0
+        assert (first.adjacency != second.adjacency).nnz == 0
+        assert np.array_equal(first.vertex_areas, second.vertex_areas)
+
+    def test_edited_surface_is_not_read_from_a_stale_cache(self):
+        ciftify.io.SurfaceMesh.load(self.path)
+        nib.save(nib.gifti.GiftiImage(darrays=[
+                nib.gifti.GiftiDataArray(self.coords * 2,
+                        intent='NIFTI_INTENT_POINTSET'),
+                nib.gifti.GiftiDataArray(self.triangles,
+                        intent='NIFTI_INTENT_TRIANGLE')]), self.path)
+        os.utime(self.path, (1, 1))
+
+        surface = ciftify.io.SurfaceMesh.load(self.path)
+
+        assert np.isclose(surface.vertex_areas.sum(), 16)
+
+class TestGeodesicNeighbourhoods(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'mid.surf.gii')
+        self.coords, _ = make_surface(self.path)
+        os.environ['CIFTIFY_CACHE_DIR'] = os.path.join(self.tmpdir, 'cache')
+        ciftify.io._NEIGHBOURHOOD_CACHE.clear()
+
+    def tearDown(self):
+        del os.environ['CIFTIFY_CACHE_DIR']
+        ciftify.io._NEIGHBOURHOOD_CACHE.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_rows_hold_the_vertices_within_the_radius(self):
+        neighbours = ciftify.io.geodesic_neighbourhoods(self.path, 1.2)
+
+        row = neighbours[4]
+        assert sorted(row.indices) == [1, 3, 4, 5, 7]
+        assert row[0, 4] == 0 and 4 in row.indices
+        assert np.allclose(sorted(row.data), [0, 1, 1, 1, 1])
+
+    def test_index_is_shared_by_copies_of_a_surface(self):
+        ciftify.io.geodesic_neighbourhoods(self.path, 1.5)
+        ciftify.io._NEIGHBOURHOOD_CACHE.clear()
+        copied = os.path.join(self.tmpdir, 'copy.surf.gii')
+        shutil.copy(self.path, copied)
+
+        with patch('ciftify.io.build_neighbourhoods') as mock_build:
+            ciftify.io.geodesic_neighbourhoods(copied, 1.5)
+
+        assert mock_build.call_count == 0
+
+    def test_smaller_radius_is_cut_from_a_larger_index(self):
+        large = ciftify.io.geodesic_neighbourhoods(self.path, 3)
+
+        with patch('ciftify.io.build_neighbourhoods') as mock_build:
+            small = ciftify.io.geodesic_neighbourhoods(self.path, 1.2)
+
+        assert mock_build.call_count == 0
+        assert small.nnz == 9 + 2 * 12
+        assert (small.data <= 1.2).all()
+        assert large.nnz == 81
+
+class TestGeodesicRois(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'mid.surf.gii')
+        make_surface(self.path)
+        ciftify.io._NEIGHBOURHOOD_CACHE.clear()
+
+    def tearDown(self):
+        ciftify.io._NEIGHBOURHOOD_CACHE.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_allow_keeps_overlapping_rois(self):
+        rois = ciftify.io.geodesic_rois(self.path, [0, 2], 1.2)
+
+        assert rois.shape == (9, 2)
+        assert sorted(rois[:, 0].nonzero()[0]) == [0, 1, 3]
+        assert sorted(rois[:, 1].nonzero()[0]) == [1, 2, 5]
+
+    def test_exclude_drops_shared_vertices(self):
+        rois = ciftify.io.geodesic_rois(self.path, [0, 2], 1.2,
+                overlap_logic='EXCLUDE')
+
+        assert rois[1].nnz == 0
+        assert sorted(rois[:, 0].nonzero()[0]) == [0, 3]
+
+    def test_closest_gives_shared_vertices_to_the_nearest_seed(self):
+        rois = ciftify.io.geodesic_rois(self.path, [0, 5], 1.5,
+                overlap_logic='CLOSEST')
+
+        ## vertex 1 is 1mm from vertex 0 and sqrt(2)mm from vertex 5
+        assert rois[1, 0] == 1 and rois[1, 1] == 0
+        assert (rois.sum(axis=1) <= 1).all()
+
+    def test_gaussian_values_fall_off_with_distance(self):
+        rois = ciftify.io.geodesic_rois(self.path, [4], 1.5, gaussian=1)
+
+        assert rois[4, 0] == 1
+        assert np.isclose(rois[1, 0], np.exp(-0.5))
+
+    def test_labels_are_collapsed_into_one_vector(self):
+        labels = ciftify.io.geodesic_roi_labels(self.path, [0, 8], 1.2, [3, 7])
+
+        assert np.array_equal(labels, [3, 3, 0, 3, 0, 7, 0, 7, 7])
+
+class TestGeodesicDistanceMatrices(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'mid.surf.gii')
+        self.coords, _ = make_surface(self.path)
+        ciftify.io._DISTANCE_FIELDS.clear()
+
+    def tearDown(self):
+        ciftify.io._DISTANCE_FIELDS.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_matrix_among_sources(self):
+        distances = ciftify.io.geodesic_distance_matrix(self.path, [0, 4, 8])
+
+        assert distances.shape == (3, 3)
+        assert np.allclose(np.diag(distances), 0)
+        assert np.allclose(distances, distances.T)
+        assert np.isclose(distances[0, 2], np.sqrt(8))
+
+    def test_sparse_matrix_leaves_out_distances_past_the_limit(self):
+        distances = ciftify.io.geodesic_distance_matrix(self.path, [0, 8],
+                targets=[0, 1, 8], limit=1.5, sparse=True)
+
+        assert distances.nnz == 3
+        assert distances[0, 0] == 0 and distances[0, 1] == 1
+        assert distances[1, 2] == 0
+
+    def test_fields_are_measured_once_per_source(self):
+        surface = ciftify.io.load_surface_mesh(self.path)
+        with patch.object(surface, 'geodesic_distances',
+                wraps=surface.geodesic_distances) as mock_distances:
+            ciftify.io.geodesic_distance_fields(self.path, [0, 4, 0])
+            ciftify.io.geodesic_distance_fields(self.path, [4, 8])
+
+        assert mock_distances.call_count == 2
+        assert list(mock_distances.call_args_list[0][0][0]) == [0, 4]
+        assert list(mock_distances.call_args_list[1][0][0]) == [8]
+
+    def test_cache_is_evicted_once_per_batch(self):
+        os.environ['CIFTIFY_CACHE_DIR'] = os.path.join(self.tmpdir, 'cache')
+        try:
+            with patch.object(ciftify.io.ArrayCache, 'evict') as mock_evict:
+                ciftify.io.geodesic_distance_fields(self.path, [0, 4, 8])
+        finally:
+            del os.environ['CIFTIFY_CACHE_DIR']
+
+        assert mock_evict.call_count == 1
+
+    def test_pairs_are_measured_on_their_own_hemisphere(self):
+        surfaces = {'L': self.path, 'R': self.path}
+
+        distances = ciftify.io.geodesic_distance_pairs(surfaces,
+                ['L', 'R', 'L'], [0, 8, 0], [2, 6, 0])
+
+        assert np.allclose(distances, [2, 2, 0])
+
+class TestPintOutputs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.summary = pd.DataFrame({'hemi': ['L', 'R'], 'NETWORK': [2, 3],
+                'roiidx': [1, 2], 'distance': [0.0, 2.5]},
+                columns=['hemi', 'NETWORK', 'roiidx', 'distance'])
+        self.meants = np.arange(12, dtype=np.float64).reshape(2, 6) / 7
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_tables_read_back_the_same_in_each_format(self):
+        for ext in ['.csv', '.npy']:
+            path = os.path.join(self.tmpdir, 'sub_summary' + ext)
+            ciftify.io.save_pint_table(self.summary, path)
+
+            pd.testing.assert_frame_equal(ciftify.io.load_pint_table(path),
+                    self.summary)
+
+    def test_meants_read_back_the_same_in_each_format(self):
+        for ext in ['.csv', '.npy']:
+            path = os.path.join(self.tmpdir, 'sub_tvertex_meants' + ext)
+            ciftify.io.save_pint_meants(self.meants, path)
+
+            assert np.allclose(ciftify.io.load_pint_meants(path), self.meants)
+
+    def test_csv_meants_have_no_header(self):
+        path = os.path.join(self.tmpdir, 'sub_tvertex_meants.csv')
+        ciftify.io.save_pint_meants(self.meants, path)
+
+        assert np.allclose(np.loadtxt(path, delimiter=','), self.meants)
+
+    def test_outputs_are_found_in_another_format(self):
+        path = os.path.join(self.tmpdir, 'sub_summary.npy')
+        ciftify.io.save_pint_table(self.summary, path)
+
+        found = ciftify.io.find_pint_output(os.path.join(self.tmpdir,
+                'sub_summary.csv'))
+
+        assert found == path
+
+    def test_hdf5_tables_read_back_the_same(self):
+        pytest.importorskip('tables')
+        path = os.path.join(self.tmpdir, 'sub_summary.h5')
+        ciftify.io.save_pint_table(self.summary, path)
+
+        pd.testing.assert_frame_equal(ciftify.io.load_pint_table(path),
+                self.summary)
+
+    @patch.dict('ciftify.io.PINT_FORMAT_PACKAGES',
+            {'hdf5': ['not_an_installed_package']})
+    def test_exits_without_the_package_for_an_optional_format(self):
+        path = os.path.join(self.tmpdir, 'sub_summary.h5')
+
+        self.assertRaises(SystemExit, ciftify.io.save_pint_table,
+                self.summary, path)
+
+class TestLabelMeans(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        self.data = rng.randn(12, 7).astype(np.float32)
+        self.labels = np.array([0, 1, 1, 2, 2, 2, 0, 3, 3, 1, 0, 2],
+                dtype=np.float64)
+
+    def test_matches_the_mean_of_each_label(self):
+        means = ciftify.io.LabelMeans(self.labels).reduce(self.data)
+
+        expected = [self.data[self.labels == roi].mean(axis=0)
+                for roi in [1, 2, 3]]
+        assert np.allclose(means, expected)
+
+    def test_rois_are_given_in_the_order_asked(self):
+        label_means = ciftify.io.LabelMeans(self.labels, rois=[3, 1])
+
+        means = label_means.reduce(self.data)
+
+        assert np.allclose(means[0], self.data[self.labels == 3].mean(axis=0))
+        assert np.allclose(means[1], self.data[self.labels == 1].mean(axis=0))
+
+    def test_only_the_given_rows_are_used(self):
+        rows = np.array([1, 2, 3, 4, 7])
+
+        means = ciftify.io.LabelMeans(self.labels, rows=rows).reduce(self.data)
+
+        assert np.allclose(means[0], self.data[[1, 2]].mean(axis=0))
+        assert np.allclose(means[1], self.data[[3, 4]].mean(axis=0))
+        assert np.allclose(means[2], self.data[7])
+
+    def test_only_masked_rows_are_used(self):
+        mask = np.zeros(12, dtype=bool)
+        mask[[1, 2, 3, 4, 7]] = True
+
+        means = ciftify.io.LabelMeans(self.labels, mask=mask).reduce(self.data)
+
+        assert np.allclose(means[0], self.data[[1, 2]].mean(axis=0))
+        assert np.allclose(means[1], self.data[[3, 4]].mean(axis=0))
+        assert np.allclose(means[2], self.data[7])
+
+    def test_a_mask_that_is_not_boolean_is_refused(self):
+        mask = (self.labels > 1).astype(np.float64)
+
+        with self.assertRaises(ValueError):
+            ciftify.io.LabelMeans(self.labels, mask=mask)
+
+    def test_a_mask_of_the_wrong_length_is_refused(self):
+        with self.assertRaises(ValueError):
+            ciftify.io.LabelMeans(self.labels, mask=np.ones(5, dtype=bool))
+
+    def test_rows_that_are_not_integers_are_refused(self):
+        with self.assertRaises(ValueError):
+            ciftify.io.LabelMeans(self.labels, rows=np.array([1.0, 2.0]))
+
+    def test_weighted_average(self):
+        weights = np.linspace(0, 1, 12)
+        label_means = ciftify.io.LabelMeans(np.ones(12), weights=weights)
+
+        means = label_means.reduce(self.data)
+
+        assert np.allclose(means[0], np.average(self.data, axis=0,
+                weights=weights))
+
+    def test_rois_without_rows_are_nan(self):
+        means = ciftify.io.LabelMeans(self.labels, rois=[1, 4]).reduce(
+                self.data)
+
+        assert not np.isnan(means[0]).any()
+        assert np.isnan(means[1]).all()
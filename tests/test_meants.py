@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+import unittest
+import importlib
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from mock import patch
+
+from tests.helpers import save_surface_cifti, save_nifti
+
+logging.disable(logging.CRITICAL)
+
+meants = importlib.import_module('ciftify.bin.ciftify_meants')
+
+def expected_means(data, labels, mask=None):
+    '''the mean of the non-zero rows of data for each label, with numpy'''
+    valid = (data.std(axis=1) > 0) & (data.mean(axis=1) != 0)
+    if mask is not None:
+        valid &= mask > 0
+    return np.array([data[valid & (labels == label)].astype(np.float64).mean(
+            axis=0) for label in np.unique(labels[labels != 0])])
+
+def expected_weighted_mean(data, weights, mask=None):
+    '''the weighted mean of the non-zero rows of data, with numpy'''
+    valid = (data.std(axis=1) > 0) & (data.mean(axis=1) != 0)
+    if mask is not None:
+        valid &= mask > 0
+    return np.average(data[valid].astype(np.float64), axis=0,
+            weights=weights[valid])
+
+class MeantsFixture(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmpdir, 'meants.csv')
+        rng = np.random.RandomState(7)
+        self.data = rng.randn(20, 12).astype(np.float32) + 100
+        self.data[3] = 0
+        self.data[14] = 5
+        self.labels = np.array([1, 1, 1, 2, 2, 2, 0, 0, 3, 3] * 2,
+                dtype=np.float64)
+        self.weights = rng.rand(20) * (self.labels > 0)
+        self.mask = np.ones(20)
+        self.mask[[0, 9, 15]] = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_meants(self, func, seed, mask=None, weighted=False):
+        arguments = {'<func>': func, '<seed>': seed,
+                '--outputcsv': self.output, '--outputlabels': None,
+                '--mask': mask, '--roi-label': None, '--weighted': weighted,
+                '--hemi': None}
+        settings = meants.UserSettings(arguments)
+        ## small blocks, so the means are built up over several of them
+        with patch.object(meants.FuncChunks, 'chunk_trs', 5):
+            func_chunks, seed_data, mask_data = \
+                    meants.load_data_as_numpy_arrays(settings, self.tmpdir)
+            meants.calc_meants_with_numpy(func_chunks, seed_data, mask_data,
+                    settings)
+        return np.loadtxt(self.output, delimiter=',')
+
+class TestMeantsCifti(MeantsFixture):
+    def setUp(self):
+        MeantsFixture.setUp(self)
+        self.func = os.path.join(self.tmpdir, 'func.dtseries.nii')
+        save_surface_cifti(self.func, self.data)
+        self.seed = os.path.join(self.tmpdir, 'seed.dscalar.nii')
+        save_surface_cifti(self.seed, self.labels[:, np.newaxis], ['seed'])
+
+    def test_matches_the_numpy_mean_of_each_roi(self):
+        out = self.run_meants(self.func, self.seed)
+
+        assert np.allclose(out, expected_means(self.data, self.labels))
+
+    def test_masked_rows_are_left_out(self):
+        mask = os.path.join(self.tmpdir, 'mask.dscalar.nii')
+        save_surface_cifti(mask, self.mask[:, np.newaxis], ['mask'])
+
+        out = self.run_meants(self.func, self.seed, mask=mask)
+
+        assert np.allclose(out, expected_means(self.data, self.labels,
+                self.mask))
+
+    def test_weighted_mean_matches_numpy(self):
+        seed = os.path.join(self.tmpdir, 'weights.dscalar.nii')
+        save_surface_cifti(seed, self.weights[:, np.newaxis], ['weights'])
+
+        out = self.run_meants(self.func, seed, weighted=True)
+
+        assert np.allclose(out, expected_weighted_mean(self.data,
+                self.weights))
+
+class TestMeantsNifti(MeantsFixture):
+    def setUp(self):
+        MeantsFixture.setUp(self)
+        ## a 2 x 5 x 2 volume, in the (C ordered) voxel order of load_nifti
+        self.func = os.path.join(self.tmpdir, 'func.nii.gz')
+        save_nifti(self.func, self.data.reshape(2, 5, 2, 12))
+        self.seed = os.path.join(self.tmpdir, 'seed.nii.gz')
+        save_nifti(self.seed, self.labels.reshape(2, 5, 2))
+
+    def test_matches_the_numpy_mean_of_each_roi(self):
+        out = self.run_meants(self.func, self.seed)
+
+        assert np.allclose(out, expected_means(self.data, self.labels))
+
+    def test_masked_voxels_are_left_out(self):
+        mask = os.path.join(self.tmpdir, 'mask.nii.gz')
+        save_nifti(mask, self.mask.reshape(2, 5, 2))
+
+        out = self.run_meants(self.func, self.seed, mask=mask)
+
+        assert np.allclose(out, expected_means(self.data, self.labels,
+                self.mask))
+
+    def test_weighted_mean_matches_numpy(self):
+        seed = os.path.join(self.tmpdir, 'weights.nii.gz')
+        save_nifti(seed, self.weights.reshape(2, 5, 2))
+
+        out = self.run_meants(self.func, seed, weighted=True)
+
+        assert np.allclose(out, expected_weighted_mean(self.data,
+                self.weights))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import unittest
+import importlib
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from mock import patch
+
+from tests.helpers import GridSurfaceTestCase
+
+logging.disable(logging.CRITICAL)
+
+concat = importlib.import_module('ciftify.bin.ciftify_postPINT1_concat')
+
+def write_summary(path, ivertices):
+    '''writes a two roi PINT summary'''
+    pd.DataFrame({'hemi': ['L', 'R'], 'NETWORK': [2, 3], 'roiidx': [1, 2],
+            'tvertex': [10, 20], 'ivertex': ivertices,
+            'distance': [0.0, 0.0]}).to_csv(path, index=False)
+
+class TestConcat(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmpdir, 'concatenated.csv')
+        self.summaries = []
+        for i, ivertices in enumerate([[10, 20], [11, 22], [12, 24]]):
+            path = os.path.join(self.tmpdir, 'sub-0{}_summary.csv'.format(i))
+            write_summary(path, ivertices)
+            self.summaries.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_concat(self, summaries, *options):
+        argv = (['ciftify_postPINT1_concat', '--no-distance-calc'] +
+                list(options) + [self.output] + summaries)
+        with patch('sys.argv', argv):
+            concat.main()
+        return pd.read_csv(self.output)
+
+    def test_no_distance_calc_skips_the_distances(self):
+        result = self.run_concat(self.summaries)
+
+        assert 'std_distance' not in result.columns
+        assert result.subid.tolist() == ['sub-00', 'sub-00', 'sub-01',
+                'sub-01', 'sub-02', 'sub-02']
+
+    def test_append_only_adds_new_subjects(self):
+        expected = self.run_concat(self.summaries)
+        os.remove(self.output)
+        self.run_concat(self.summaries[:2])
+        ## a summary that was already concatenated is not read again
+        os.remove(self.summaries[0])
+
+        result = self.run_concat(self.summaries, '--append')
+
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_summaries_are_read_on_a_pool(self):
+        expected = self.run_concat(self.summaries)
+
+        result = self.run_concat(self.summaries, '--n-workers', '2')
+
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_only_a_trailing_summary_is_left_out_of_the_subid(self):
+        assert concat.summary_subid('/out/sub-01_summary.csv') == 'sub-01'
+        assert concat.summary_subid('sub-01_summary_run2_summary.parquet') == \
+                'sub-01_summary_run2'
+        assert concat.summary_subid('sub-01_summary_run2.csv') == \
+                'sub-01_summary_run2'
+
+class TestConcatDistances(GridSurfaceTestCase):
+    def setUp(self):
+        super(TestConcatDistances, self).setUp()
+        self.output = os.path.join(self.tmpdir, 'concatenated.csv')
+        self.summaries = []
+        for i, ivertices in enumerate([[10, 20], [11, 22], [12, 24]]):
+            path = os.path.join(self.tmpdir, 'sub-0{}_summary.csv'.format(i))
+            write_summary(path, ivertices)
+            self.summaries.append(path)
+
+    def run_concat(self, summaries, *options):
+        argv = (['ciftify_postPINT1_concat', '--surfL', self.surf,
+                '--surfR', self.surf] + list(options) + [self.output] +
+                summaries)
+        with patch('sys.argv', argv):
+            concat.main()
+        return pd.read_csv(self.output)
+
+    def test_distances_from_the_template_vertex(self):
+        result = self.run_concat(self.summaries)
+
+        ## the ivertices are 0, 1 or 2 grid steps along from tvertex 10 on
+        ## the left and 0, 2 or 4 along from tvertex 20 on the right
+        assert result.columns.tolist()[-1] == 'std_distance'
+        assert np.allclose(result.std_distance.values, [0, 0, 1, 2, 2, 4])
+
+    def test_rows_at_the_template_vertex_are_zero(self):
+        result = self.run_concat(self.summaries)
+
+        at_tvertex = result.ivertex == result.tvertex
+        assert at_tvertex.sum() == 2
+        assert (result.loc[at_tvertex, 'std_distance'] == 0).all()
+
+    def test_append_keeps_the_distances(self):
+        expected = self.run_concat(self.summaries)
+        os.remove(self.output)
+        self.run_concat(self.summaries[:2])
+
+        result = self.run_concat(self.summaries, '--append')
+
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_append_without_the_distances_is_refused(self):
+        self.run_concat(self.summaries[:2])
+
+        with self.assertRaises(SystemExit):
+            self.run_concat(self.summaries, '--append', '--no-distance-calc')
+
+        result = pd.read_csv(self.output)
+        assert 'std_distance' in result.columns
+        assert len(result) == 4
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import importlib
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from mock import patch
+from scipy.spatial.distance import squareform
+
+from tests.helpers import GridSurfaceTestCase
+
+logging.disable(logging.CRITICAL)
+
+sub2sub = importlib.import_module('ciftify.bin.ciftify_postPINT2_sub2sub')
+
+class TestSub2SubDistances(GridSurfaceTestCase):
+    def setUp(self):
+        super(TestSub2SubDistances, self).setUp()
+        self.vertices_df = pd.DataFrame({
+                'subid': ['sub-01', 'sub-02', 'sub-03', 'sub-04'] * 2,
+                'hemi': ['L'] * 4 + ['R'] * 4,
+                'roiidx': [1] * 4 + [2] * 4,
+                'ivertex': [11, 14, 11, 17, 5, 5, 5, 5]})
+
+    def test_distances_along_a_row_of_the_grid(self):
+        result = sub2sub.calc_allroiidx_distances(self.vertices_df, 1,
+                self.surf, self.surf)
+
+        ## vertices 11, 14 and 17 are 3mm apart along one row of the grid
+        expected = np.array([[0, 3, 0, 6],
+                             [3, 0, 3, 3],
+                             [0, 3, 0, 6],
+                             [6, 3, 6, 0]])
+        assert result.subid1.tolist()[:4] == ['sub-01'] * 4
+        assert result.subid2.tolist()[:4] == \
+                ['sub-01', 'sub-02', 'sub-03', 'sub-04']
+        assert (result.roiidx == 1).all()
+        assert np.allclose(result.distance.values, expected.ravel())
+
+    def test_distinct_ivertices_are_measured_once(self):
+        subids, ivertices, subject_ivertex, unique_distances = \
+                sub2sub.calc_roi_distance_matrix(self.vertices_df, 1,
+                        self.surf, self.surf)
+
+        assert ivertices.tolist() == [11, 14, 17]
+        assert subject_ivertex.tolist() == [0, 1, 0, 2]
+        assert unique_distances.shape == (3, 3)
+
+    def test_condensed_matrices_expand_to_the_table(self):
+        output = os.path.join(self.tmpdir, 'sub2sub.npz')
+        matrices = (sub2sub.calc_roi_distance_matrix(self.vertices_df, roi,
+                self.surf, self.surf) for roi in [1, 2])
+
+        sub2sub.write_condensed_matrices(output, [1, 2], matrices)
+
+        npz = np.load(output)
+        for roi in [1, 2]:
+            table = sub2sub.calc_allroiidx_distances(self.vertices_df, roi,
+                    self.surf, self.surf)
+            distances = squareform(npz['roi{}_distances'.format(roi)])
+            assert npz['roi{}_subids'.format(roi)].tolist() == \
+                    ['sub-01', 'sub-02', 'sub-03', 'sub-04']
+            assert np.allclose(distances.ravel(), table.distance.values)
+
+    def test_csv_is_written_one_roi_at_a_time(self):
+        output = os.path.join(self.tmpdir, 'sub2sub.csv')
+        tables = [sub2sub.calc_allroiidx_distances(self.vertices_df, roi,
+                self.surf, self.surf) for roi in [1, 2]]
+
+        sub2sub.write_sub2sub_table(output, iter(tables))
+
+        result = pd.read_csv(output)
+        assert result.columns.tolist() == \
+                ['subid1', 'subid2', 'roiidx', 'distance']
+        assert len(result) == 32
+        assert result.roiidx.tolist() == [1] * 16 + [2] * 16
+        assert np.allclose(result.distance.values,
+                pd.concat(tables).distance.values)
+
+    def test_condensed_output_must_be_named_npz(self):
+        output = os.path.join(self.tmpdir, 'sub2sub.csv')
+
+        with patch('sys.argv', ['ciftify_postPINT2_sub2sub', '--condensed',
+                'concatenated.csv', output]):
+            self.assertRaises(SystemExit, sub2sub.main)
+
+        assert not os.path.exists(output)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+import unittest
+import importlib
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import nibabel as nib
+from mock import patch
+
+import ciftify
+
+from tests.helpers import save_surface_cifti, save_nifti
+
+logging.disable(logging.CRITICAL)
+
+seed_corr = importlib.import_module('ciftify.bin.ciftify_seed_corr')
+meants = importlib.import_module('ciftify.bin.ciftify_meants')
+
+def expected_corrs(data, seed_ts, TRs, mask=None):
+    '''the correlation of each non-zero row of data with seed_ts, with
+    np.corrcoef'''
+    valid = (data.std(axis=1) > 0) & (data.mean(axis=1) != 0)
+    if mask is not None:
+        valid &= mask > 0
+    out = np.zeros(data.shape[0])
+    for row in np.where(valid)[0]:
+        out[row] = np.corrcoef(seed_ts[TRs], data[row, TRs])[0][1]
+    return out
+
+class SeedCorrFixture(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(8)
+        self.data = rng.randn(20, 12).astype(np.float32) + 100
+        self.data[3] = 0
+        self.data[14] = 5
+        self.seed_rows = np.zeros(20)
+        self.seed_rows[[0, 1, 2, 3, 11, 12]] = 1
+        self.weights = rng.rand(20) * self.seed_rows
+        self.mask = np.ones(20)
+        self.mask[[0, 9, 15]] = 0
+        self.TR_file = os.path.join(self.tmpdir, 'TRs.txt')
+        self.TRs = np.array([0, 1, 2, 4, 7, 8, 10, 11])
+        np.savetxt(self.TR_file, self.TRs + 1, fmt='%d')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def seed_ts(self, weights, mask=None):
+        '''the seed timeseries, as a numpy (weighted) mean'''
+        valid = (self.data.std(axis=1) > 0) & (self.data.mean(axis=1) != 0)
+        if mask is not None:
+            valid &= mask > 0
+        return np.average(self.data[valid].astype(np.float64), axis=0,
+                weights=weights[valid])
+
+    def run_seed_corr(self, func, seed, output, *options):
+        '''
+        runs ciftify_seed_corr with ciftify_meants run in process, and the
+        func read 5 TRs at a time
+        '''
+        def run(cmd):
+            if cmd[0] == 'ciftify_meants':
+                with patch('sys.argv', cmd):
+                    meants.run_ciftify_meants(self.tmpdir)
+            else:
+                ciftify.utils.run(cmd)
+        iter_timeseries = ciftify.io.iter_timeseries
+        def iter_small_blocks(filename, chunk_trs=100, **kwargs):
+            return iter_timeseries(filename, 5, **kwargs)
+        argv = (['ciftify_seed_corr', '--outputname', output] +
+                list(options) + [func, seed])
+        with patch.object(seed_corr, 'run', side_effect=run), \
+                patch('ciftify.io.iter_timeseries', iter_small_blocks), \
+                patch('sys.argv', argv):
+            seed_corr.main()
+
+class TestSeedCorrCifti(SeedCorrFixture):
+    def setUp(self):
+        SeedCorrFixture.setUp(self)
+        self.func = os.path.join(self.tmpdir, 'func.dtseries.nii')
+        save_surface_cifti(self.func, self.data)
+        self.seed = os.path.join(self.tmpdir, 'seed.dscalar.nii')
+        save_surface_cifti(self.seed, self.seed_rows[:, np.newaxis], ['seed'])
+        self.output = os.path.join(self.tmpdir, 'corr.dscalar.nii')
+
+    def read_output(self):
+        return ciftify.io.DenseArray(self.output).dense()[:, 0]
+
+    def test_matches_corrcoef(self):
+        self.run_seed_corr(self.func, self.seed, self.output)
+
+        expected = expected_corrs(self.data, self.seed_ts(self.seed_rows),
+                np.arange(12))
+        assert np.allclose(self.read_output(), expected, atol=1e-5)
+
+    def test_only_the_TRs_given_are_correlated(self):
+        self.run_seed_corr(self.func, self.seed, self.output,
+                '--use-TRs', self.TR_file)
+
+        expected = expected_corrs(self.data, self.seed_ts(self.seed_rows),
+                self.TRs)
+        assert np.allclose(self.read_output(), expected, atol=1e-5)
+
+    def test_masked_rows_are_left_out(self):
+        mask = os.path.join(self.tmpdir, 'mask.dscalar.nii')
+        save_surface_cifti(mask, self.mask[:, np.newaxis], ['mask'])
+
+        self.run_seed_corr(self.func, self.seed, self.output, '--mask', mask)
+
+        expected = expected_corrs(self.data,
+                self.seed_ts(self.seed_rows, self.mask), np.arange(12),
+                self.mask)
+        assert np.allclose(self.read_output(), expected, atol=1e-5)
+
+    def test_weighted_seed_matches_corrcoef(self):
+        seed = os.path.join(self.tmpdir, 'weights.dscalar.nii')
+        save_surface_cifti(seed, self.weights[:, np.newaxis], ['weights'])
+
+        self.run_seed_corr(self.func, seed, self.output, '--weighted')
+
+        expected = expected_corrs(self.data, self.seed_ts(self.weights),
+                np.arange(12))
+        assert np.allclose(self.read_output(), expected, atol=1e-5)
+
+class TestSeedCorrNifti(SeedCorrFixture):
+    def setUp(self):
+        SeedCorrFixture.setUp(self)
+        ## a 2 x 5 x 2 volume, in the (C ordered) voxel order of load_nifti
+        self.func = os.path.join(self.tmpdir, 'func.nii.gz')
+        save_nifti(self.func, self.data.reshape(2, 5, 2, 12))
+        self.seed = os.path.join(self.tmpdir, 'seed.nii.gz')
+        save_nifti(self.seed, self.seed_rows.reshape(2, 5, 2))
+        self.output = os.path.join(self.tmpdir, 'corr.nii.gz')
+
+    def read_output(self):
+        return np.asanyarray(nib.load(self.output).dataobj).reshape(-1)
+
+    def test_matches_corrcoef(self):
+        self.run_seed_corr(self.func, self.seed, self.output)
+
+        expected = expected_corrs(self.data, self.seed_ts(self.seed_rows),
+                np.arange(12))
+        assert np.allclose(self.read_output(), expected, atol=1e-5)
+
+    def test_only_the_TRs_given_are_correlated(self):
+        self.run_seed_corr(self.func, self.seed, self.output,
+                '--use-TRs', self.TR_file)
+
+        expected = expected_corrs(self.data, self.seed_ts(self.seed_rows),
+                self.TRs)
+        assert np.allclose(self.read_output(), expected, atol=1e-5)
+
+    def test_masked_voxels_are_left_out(self):
+        mask = os.path.join(self.tmpdir, 'mask.nii.gz')
+        save_nifti(mask, self.mask.reshape(2, 5, 2))
+
+        self.run_seed_corr(self.func, self.seed, self.output, '--mask', mask)
+
+        expected = expected_corrs(self.data,
+                self.seed_ts(self.seed_rows, self.mask), np.arange(12),
+                self.mask)
+        assert np.allclose(self.read_output(), expected, atol=1e-5)
+
+    def test_weighted_seed_matches_corrcoef(self):
+        seed = os.path.join(self.tmpdir, 'weights.nii.gz')
+        save_nifti(seed, self.weights.reshape(2, 5, 2))
+
+        self.run_seed_corr(self.func, seed, self.output, '--weighted')
+
+        expected = expected_corrs(self.data, self.seed_ts(self.weights),
+                np.arange(12))
+        assert np.allclose(self.read_output(), expected, atol=1e-5)